@@ -1,37 +1,90 @@
 # admin_session.py
-# Simple in-memory per-admin reply session with max reply limit
-KEY = "reply_sessions"
-
-def _get_store(chat_data):
-    if KEY not in chat_data:
-        chat_data[KEY] = {}
-    return chat_data[KEY]
-
-def start(chat_data, admin_id: int, target_uid: int, max_replies: int = 3):
-    store = _get_store(chat_data)
-    store[admin_id] = {"target": target_uid, "left": max_replies}
-
-def stop(chat_data, admin_id: int):
-    store = _get_store(chat_data)
-    store.pop(admin_id, None)
-
-def is_active(chat_data, admin_id: int) -> bool:
-    store = _get_store(chat_data)
-    s = store.get(admin_id)
-    return bool(s and s.get("left", 0) > 0)
-
-def target(chat_data, admin_id: int):
-    store = _get_store(chat_data)
-    s = store.get(admin_id)
-    return s.get("target") if s else None
-
-def record_send_and_check(chat_data, admin_id: int) -> bool:
-    """Return False if session should be closed (limit hit)."""
-    store = _get_store(chat_data)
-    s = store.get(admin_id)
-    if not s: return False
-    s["left"] = max(0, s.get("left", 0) - 1)
-    if s["left"] <= 0:
-        store.pop(admin_id, None)
+# In-memory routing for the admin group's inquiry relay. Every admin has their
+# own reply session, so several users can be answered in parallel; each group
+# message costs a dict lookup, never a DB read.
+#
+#   - session: admin_id -> (target user, replies left, expiry)
+#   - mute:    user_id -> expiry; relays to a muted user are dropped
+#   - inquiry: forwarded message_id -> user_id, so replying to a forwarded
+#              inquiry goes straight to its sender (bounded, oldest evicted)
+#
+# State is per process and lost on restart, like the reply window itself.
+import os, time
+from collections import OrderedDict
+
+REPLY_LIMIT = int(os.getenv("REPLY_LIMIT", "3"))
+REPLY_MINUTES = int(os.getenv("REPLY_MINUTES", "10"))
+INQUIRY_MAP_SIZE = int(os.getenv("INQUIRY_MAP_SIZE", "5000"))
+
+_sessions = {}              # admin_id -> [user_id, left, until]
+_muted = {}                 # user_id -> until
+_inquiries = OrderedDict()  # group message_id -> user_id
+
+def _now() -> float:
+    return time.monotonic()
+
+# ---------- reply sessions ----------
+def start(admin_id: int, user_id: int, max_replies: int = REPLY_LIMIT, minutes: int = REPLY_MINUTES):
+    _sessions[admin_id] = [user_id, max_replies, _now() + minutes * 60]
+
+def stop(admin_id: int):
+    _sessions.pop(admin_id, None)
+
+def stop_user(user_id: int) -> int:
+    """End every admin's session with user_id; returns how many were open."""
+    admins = [a for a, s in _sessions.items() if s[0] == user_id]
+    for a in admins:
+        del _sessions[a]
+    return len(admins)
+
+def target(admin_id: int):
+    """User the admin is replying to, or None (no session, expired, used up or muted)."""
+    s = _sessions.get(admin_id)
+    if s is None:
+        return None
+    if s[1] <= 0 or _now() > s[2]:
+        del _sessions[admin_id]
+        return None
+    return None if is_muted(s[0]) else s[0]
+
+def record_send(admin_id: int) -> int:
+    """Count one relayed message; returns replies left (the session ends at 0)."""
+    s = _sessions.get(admin_id)
+    if s is None:
+        return 0
+    s[1] -= 1
+    if s[1] <= 0:
+        del _sessions[admin_id]
+    return max(0, s[1])
+
+# ---------- mutes ----------
+def mute(user_id: int, minutes: int = REPLY_MINUTES):
+    _muted[user_id] = _now() + minutes * 60
+
+def is_muted(user_id: int) -> bool:
+    until = _muted.get(user_id)
+    if until is None:
+        return False
+    if _now() > until:
+        del _muted[user_id]
         return False
     return True
+
+# ---------- forwarded inquiries ----------
+def remember(message_id: int, user_id: int):
+    _inquiries[message_id] = user_id
+    if len(_inquiries) > INQUIRY_MAP_SIZE:
+        _inquiries.popitem(last=False)
+
+def sender_of(message_id: int):
+    return _inquiries.get(message_id)
+
+def route(admin_id: int, reply_to_id=None):
+    """Where an admin's group message should go: the sender of the inquiry it
+    replies to, else the admin's session target. (user_id, via_session) or None."""
+    if reply_to_id is not None:
+        uid = _inquiries.get(reply_to_id)
+        if uid is not None:
+            return (None if is_muted(uid) else (uid, False))
+    uid = target(admin_id)
+    return (uid, True) if uid is not None else None
@@ -0,0 +1,107 @@
+# async_db.py
+# Awaitable mirror of db.py. Blocking SQLite calls run off the event loop so a
+# slow disk never blocks it (and other users' updates):
+#
+#   - the writer thread runs every write and everything that must stay in
+#     order with writes: read-through cached readers (a read racing a write
+#     could re-cache a stale value), the session write-through, round_robin's
+#     _rr_last, persistence, auto-Q/A index rebuilds
+#   - the reader thread has its own read-only WAL connection and serves plain
+#     uncached reads (a day's bookings, booking lookups, listings), so they
+#     don't queue behind writes
+#
+# Cached / indexed reads are answered on the loop, and so is pure-CPU work
+# such as the slot scan. The thread hop still costs a DB-bound handler some
+# latency next to calling SQLite on the loop; `python bench.py loop` has the
+# numbers, with and without a slow disk (--io-ms).
+import asyncio, functools, contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import metrics
+
+# One writer, on purpose: everything on it runs in submission order on one
+# connection, so the worker count is not configurable.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+_reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-read", initializer=db.read_only_thread)
+
+def _call(fn, args, kwargs):
+    metrics.DB_OP.set(fn.__name__)  # label for booking_db_seconds
+    return fn(*args, **kwargs)
+
+async def _submit(executor, fn, args, kwargs):
+    loop = asyncio.get_running_loop()
+    # carry the caller's context (metrics.HANDLER) over to the DB thread
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(executor, ctx.run, _call, fn, args, kwargs)
+
+async def run(fn, *args, **kwargs):
+    """Run any blocking callable (usually a conn_ctx block) on the writer thread."""
+    return await _submit(_executor, fn, args, kwargs)
+
+async def read(fn, *args, **kwargs):
+    """Run a read-only callable that touches no cache on the reader thread."""
+    return await _submit(_reader, fn, args, kwargs)
+
+def _wrap(fn, reader: bool = False):
+    peek = getattr(fn, "peek", None)  # db._read_through readers
+    executor = _reader if reader else _executor
+    @functools.wraps(fn)
+    async def inner(*args, **kwargs):
+        if peek is not None:
+            hit, value = peek(*args, **kwargs)
+            if hit:  # served from the in-process cache: no thread hop, no SQLite
+                return value
+        return await _submit(executor, fn, args, kwargs)
+    return inner
+
+def shutdown():
+    _executor.shutdown(wait=True)
+    _reader.shutdown(wait=True)
+
+get_kv = _wrap(db.get_kv)
+set_kv = _wrap(db.set_kv)
+upsert_user = _wrap(db.upsert_user)
+list_services = _wrap(db.list_services)
+get_service = _wrap(db.get_service)
+list_resources = _wrap(db.list_resources)
+get_resource = _wrap(db.get_resource)
+upsert_service = _wrap(db.upsert_service)
+upsert_resource = _wrap(db.upsert_resource)
+count_overlapping = _wrap(db.count_overlapping, reader=True)
+
+async def available_slots(res_id, day_start, day_end, duration_min, step_min, capacity):
+    # only the query leaves the loop, on the reader; the per-slot scan is pure
+    # CPU and would just queue behind other SQLite work on a DB thread
+    hit, value = db.available_slots.peek(res_id, day_start, day_end, duration_min, step_min, capacity)
+    if hit:
+        return value
+    starts, ends = await read(db.day_bookings, res_id, day_start, day_end)
+    return db.slots_from_bookings(starts, ends, day_start, day_end, duration_min, step_min, capacity)
+
+month_full_days = _wrap(db.month_full_days)
+month_full_days_any = _wrap(db.month_full_days_any)
+earliest_slots = _wrap(db.earliest_slots)
+available_slots_any = _wrap(db.available_slots_any)
+create_pending_booking = _wrap(db.create_pending_booking)
+create_pending_booking_any = _wrap(db.create_pending_booking_any)
+mark_paid = _wrap(db.mark_paid)
+cancel_booking = _wrap(db.cancel_booking)
+expire_holds = _wrap(db.expire_holds)
+count_live_holds = _wrap(db.count_live_holds, reader=True)
+load_availability = _wrap(db.load_availability)
+check_availability = _wrap(db.check_availability)
+get_booking = _wrap(db.get_booking, reader=True)
+list_bookings = _wrap(db.list_bookings, reader=True)
+count_paid = _wrap(db.count_paid)
+upcoming_paid = _wrap(db.upcoming_paid, reader=True)
+user_bookings = _wrap(db.user_bookings, reader=True)
+add_autoqa = _wrap(db.add_autoqa)
+all_autoqa = _wrap(db.all_autoqa)
+clear_autoqa = _wrap(db.clear_autoqa)
+match_autoqa = _wrap(db.match_autoqa)
+load_user_data = _wrap(db.load_user_data)
+mute_user = _wrap(db.mute_user)
+active_mutes = _wrap(db.active_mutes)
+load_conversations = _wrap(db.load_conversations)
+save_persistence = _wrap(db.save_persistence)
@@ -0,0 +1,167 @@
+# availability.py
+# In-process index of live bookings per resource, kept in step with db.py's
+# writes so date taps and overlap checks never touch SQLite.
+#
+# Per resource: sorted starts_ts[] and ends_ts[]. Bookings overlapping [s, e)
+# = #(starts < e) - #(ends <= s), two bisects. Pending holds also sit in one
+# expiry heap and drop out lazily once expires_ts <= now, like the SQL filter.
+import heapq, threading
+from bisect import bisect_left, bisect_right, insort
+
+def _discard(xs: list, x: int):
+    i = bisect_left(xs, x)
+    if i < len(xs) and xs[i] == x:
+        del xs[i]
+
+class AvailabilityIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, horizon):
+        self._starts = {}   # resource_id -> sorted starts_ts
+        self._ends = {}     # resource_id -> sorted ends_ts
+        self._live = {}     # booking_id -> (resource_id, starts_ts, ends_ts, expires_ts | None)
+        self._holds = []    # heap (expires_ts, booking_id); stale entries skipped
+        # bookings ending at or before horizon are not indexed, so only slots
+        # starting at/after it can be answered here. None = not loaded.
+        self.horizon = horizon
+
+    # ---------- loading ----------
+    def load(self, rows, horizon: int):
+        """rows: (id, resource_id, starts_ts, ends_ts, expires_ts|None) of live bookings ending after horizon."""
+        with self._lock:
+            self._reset(horizon)
+            for bid, res_id, s, e, exp in rows:
+                self._live[bid] = (res_id, s, e, exp)
+                self._starts.setdefault(res_id, []).append(s)
+                self._ends.setdefault(res_id, []).append(e)
+                if exp is not None:
+                    self._holds.append((exp, bid))
+            for xs in (*self._starts.values(), *self._ends.values()):
+                xs.sort()
+            heapq.heapify(self._holds)
+
+    def covers(self, start_ts: int) -> bool:
+        h = self.horizon
+        return h is not None and start_ts >= h
+
+    def size(self) -> int:
+        return len(self._live)
+
+    # ---------- writes (called by db.py after COMMIT) ----------
+    def add(self, bid: int, res_id: int, s: int, e: int, expires_ts=None):
+        with self._lock:
+            if self.horizon is None or bid in self._live or e <= self.horizon:
+                return
+            self._live[bid] = (res_id, s, e, expires_ts)
+            insort(self._starts.setdefault(res_id, []), s)
+            insort(self._ends.setdefault(res_id, []), e)
+            if expires_ts is not None:
+                heapq.heappush(self._holds, (expires_ts, bid))
+
+    def mark_paid(self, bid: int, res_id: int, s: int, e: int):
+        # a lapsed hold may already have been purged here while still 'pending'
+        # in SQLite; paying it makes it live again
+        with self._lock:
+            b = self._live.get(bid)
+            if b is not None:
+                self._live[bid] = (b[0], b[1], b[2], None)
+                return
+        self.add(bid, res_id, s, e)
+
+    def remove(self, bid: int):
+        with self._lock:
+            self._remove(bid)
+
+    def _remove(self, bid: int):
+        b = self._live.pop(bid, None)
+        if b is None:
+            return
+        res_id, s, e, _ = b
+        _discard(self._starts[res_id], s)
+        _discard(self._ends[res_id], e)
+
+    def _purge(self, now_ts: int):
+        h = self._holds
+        while h and h[0][0] <= now_ts:
+            exp, bid = heapq.heappop(h)
+            b = self._live.get(bid)
+            if b is not None and b[3] == exp:
+                self._remove(bid)
+
+    def prune(self, before_ts: int):
+        """Forget bookings that ended by before_ts and raise the horizon to it."""
+        with self._lock:
+            if self.horizon is None or before_ts <= self.horizon:
+                return
+            for bid in [bid for bid, b in self._live.items() if b[2] <= before_ts]:
+                self._remove(bid)
+            self.horizon = before_ts
+
+    # ---------- reads ----------
+    def count_overlapping(self, res_id: int, s: int, e: int, now_ts: int) -> int:
+        with self._lock:
+            self._purge(now_ts)
+            starts = self._starts.get(res_id, ())
+            ends = self._ends.get(res_id, ())
+            return bisect_left(starts, e) - bisect_right(ends, s)
+
+    def free_starts(self, res_id: int, first_ts: int, last_ts: int, duration_sec: int,
+                    step_sec: int, capacity: int, now_ts: int) -> list:
+        """Slot start times in [first_ts, last_ts] with fewer than capacity overlaps."""
+        if capacity <= 0:
+            return []
+        with self._lock:
+            self._purge(now_ts)
+            starts = self._starts.get(res_id)
+            ends = self._ends.get(res_id)
+            slots = range(first_ts, last_ts + 1, step_sec)
+            if not starts:
+                return list(slots)
+            # bisect the day's window once; per slot only the short slices are searched
+            lo_s = bisect_left(starts, first_ts + duration_sec)
+            starts = starts[lo_s:bisect_left(starts, last_ts + duration_sec)]
+            lo_e = bisect_left(ends, first_ts)
+            ends = ends[lo_e:bisect_right(ends, last_ts)]
+            base = lo_s - lo_e
+            return [s for s in slots
+                    if base + bisect_left(starts, s + duration_sec) - bisect_right(ends, s) < capacity]
+
+    def timeline(self, res_id: int, now_ts: int):
+        """Copies of (starts, ends) for one resource, safe to scan without the lock."""
+        with self._lock:
+            self._purge(now_ts)
+            return list(self._starts.get(res_id, ())), list(self._ends.get(res_id, ()))
+
+    def snapshot(self, now_ts: int) -> set:
+        """{(id, resource_id, starts_ts, ends_ts)} currently live, for consistency checks."""
+        with self._lock:
+            self._purge(now_ts)
+            return {(bid, b[0], b[1], b[2]) for bid, b in self._live.items()}
+
+
+def free_slots(starts: list, ends: list, windows, duration_sec: int, step_sec: int,
+               capacity: int, not_before: int = 0):
+    """Yield free slot starts, ascending, over (open_ts, close_ts) windows.
+
+    starts/ends are the sorted times of every live booking that can overlap the
+    windows. A blocked slot stays blocked until one of its bookings ends (new
+    starts only add to the count), so the scan jumps straight to the next grid
+    point at or after the earliest end instead of probing each step.
+    A capacity of 0 (a closed resource) has no free slots.
+    """
+    if capacity <= 0:
+        return
+    for open_ts, close_ts in windows:
+        t = open_ts
+        if t < not_before:
+            t += -(-(not_before - t) // step_sec) * step_sec
+        while t + duration_sec <= close_ts:
+            done = bisect_right(ends, t)
+            if bisect_left(starts, t + duration_sec) - done < capacity:
+                yield t
+                t += step_sec
+            else:
+                # ends[done] is the first end after t; there is one, since the count is > 0
+                t += -(-(ends[done] - t) // step_sec) * step_sec
@@ -0,0 +1,756 @@
+# bench.py
+# Micro-benchmarks against a throwaway SQLite file.
+# Usage: python bench.py {availability,conn,loop,epoch,autoqa,cache,outbox,metrics,index,calendar,next,any,persist,sessions,relay,reminders} [--repeat N] [--users N] [--rows N] [--resources N]
+import os, re, time, random, sqlite3, asyncio, tempfile, argparse, statistics
+from contextlib import contextmanager
+from datetime import datetime, timedelta, date
+
+_tmpdir = tempfile.mkdtemp(prefix="booking-bench-")
+os.environ["DB_PATH"] = os.path.join(_tmpdir, "bench.db")
+
+import db
+from utils import TZ, parse_hhmm, normalize_text
+
+def _timeit(fn, repeat: int) -> float:
+    """Best-of-3 mean seconds per call."""
+    best = None
+    for _ in range(3):
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        dt = (time.perf_counter() - t0) / repeat
+        best = dt if best is None else min(best, dt)
+    return best
+
+def _seed_catalog(capacity: int = 2, open_t: str = "00:00", close_t: str = "23:59"):
+    db.init_db()
+    with db.conn_ctx() as conn:
+        conn.execute("INSERT OR IGNORE INTO services(id,name,default_duration_min,price,step_min) VALUES(1,'Bench',30,100,15)")
+        conn.execute("INSERT OR IGNORE INTO resources(id,service_id,name,capacity,open_time,close_time) VALUES(1,1,'Room',?,?,?)",
+                     (capacity, open_t, close_t))
+        conn.commit()
+
+def _seed_day(d: date, every_min: int = 45, duration_min: int = 30):
+    """Paid bookings spread over the whole day (plus neighbours) for resource 1."""
+    rows = []
+    for day in (d - timedelta(days=1), d, d + timedelta(days=1)):
+        cur = TZ.localize(datetime.combine(day, parse_hhmm("00:00")))
+        end = cur + timedelta(days=1)
+        while cur < end:
+            e = cur + timedelta(minutes=duration_min)
+            rows.append((1, 1, 1, "bench", cur.isoformat(), e.isoformat(), 100, "paid",
+                         int(cur.timestamp()), int(e.timestamp())))
+            cur += timedelta(minutes=every_min)
+    with db.conn_ctx() as conn:
+        conn.executemany("""INSERT INTO bookings(service_id,resource_id,tg_user_id,user_full_name,
+                            starts_at,ends_at,amount,status,starts_ts,ends_ts) VALUES(?,?,?,?,?,?,?,?,?,?)""", rows)
+        conn.commit()
+    db.load_availability()  # rows went in behind db.py's back
+
+# ---------- availability: per-slot count_overlapping vs available_slots ----------
+def _slots_per_slot_query(res_id, start_dt, end_dt, duration, step, capacity):
+    # The pre-engine loop from on_date_picked: one query per candidate slot.
+    options = []
+    cur = start_dt
+    while cur + timedelta(minutes=duration) <= end_dt:
+        e = cur + timedelta(minutes=duration)
+        if db.count_overlapping(res_id, cur.isoformat(), e.isoformat()) < capacity:
+            options.append((cur, e))
+        cur += timedelta(minutes=step)
+    return options
+
+def bench_availability(args):
+    db.AVAILABILITY_INDEX = False  # SQL paths only; `bench.py index` covers the in-memory one
+    _seed_catalog(capacity=2)
+    d = date(2030, 1, 15)
+    _seed_day(d)
+    print(f"{'hours':>12} {'step':>5} {'slots':>6} {'per-slot ms':>12} {'engine ms':>10} {'speedup':>8}")
+    for open_t, close_t in (("10:00", "18:00"), ("08:00", "22:00"), ("00:00", "23:59")):
+        for step in (30, 15, 5):
+            start_dt = TZ.localize(datetime.combine(d, parse_hhmm(open_t)))
+            end_dt = TZ.localize(datetime.combine(d, parse_hhmm(close_t)))
+            old = _slots_per_slot_query(1, start_dt, end_dt, 30, step, 2)
+            new = db.available_slots(1, start_dt, end_dt, 30, step, 2)
+            assert old == new, "engine diverged from per-slot loop"
+            t_old = _timeit(lambda: _slots_per_slot_query(1, start_dt, end_dt, 30, step, 2), args.repeat)
+            t_new = _timeit(lambda: db.available_slots(1, start_dt, end_dt, 30, step, 2), args.repeat)
+            print(f"{open_t + '-' + close_t:>12} {step:>5} {len(new):>6} {t_old*1e3:>12.2f} {t_new*1e3:>10.2f} {t_old/t_new:>7.1f}x")
+
+# ---------- conn: connect-per-call vs pooled WAL connection ----------
+@contextmanager
+def _connect_per_call():
+    # The original conn_ctx: fresh connection + PRAGMA on every helper call.
+    conn = sqlite3.connect(db.DB_PATH)
+    conn.execute("PRAGMA foreign_keys=ON;")
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def bench_conn(args):
+    _seed_catalog()
+    db.set_kv("welcome_text", "hello")
+    # __wrapped__: bypass the read cache, this bench is about connections
+    ops = {
+        "get_kv": lambda: db.get_kv.__wrapped__("welcome_text"),
+        "get_service": lambda: db.get_service.__wrapped__(1),
+        "list_resources": lambda: db.list_resources.__wrapped__(1),
+        "set_kv": lambda: db.set_kv("bench", 1),
+    }
+    n = args.repeat * 50
+    print(f"{'op':>15} {'per-call ops/s':>15} {'pooled ops/s':>13} {'speedup':>8}")
+    pooled_ctx = db.conn_ctx
+    for name, op in ops.items():
+        db.conn_ctx = _connect_per_call
+        try:
+            t_old = _timeit(op, n)
+        finally:
+            db.conn_ctx = pooled_ctx
+        t_new = _timeit(op, n)
+        print(f"{name:>15} {1/t_old:>15,.0f} {1/t_new:>13,.0f} {t_old/t_new:>7.1f}x")
+
+# ---------- loop: handler latency with DB calls on vs off the event loop ----------
+def _pct(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+async def _load(users: int, rounds: int, mode: str):
+    import async_db
+    d = date(2030, 1, 15)
+    start_dt = TZ.localize(datetime.combine(d, parse_hhmm("00:00")))
+    end_dt = TZ.localize(datetime.combine(d, parse_hhmm("23:59")))
+    lat = {"date_tap": [], "start": [], "menu_tap": []}
+
+    async def date_tap(uid):
+        # on_date_picked-like: catalog reads + a full day's slots, no write
+        if mode == "on-loop":
+            db.get_service(1); db.get_resource(1)
+            db.available_slots(1, start_dt, end_dt, 30, 5, 2)
+        else:
+            await async_db.get_service(1); await async_db.get_resource(1)
+            if mode == "writer":  # the query queued on the one DB thread, as before the reader
+                hit, _ = db.available_slots.peek(1, start_dt, end_dt, 30, 5, 2)
+                if not hit:
+                    starts, ends = await async_db.run(db.day_bookings, 1, start_dt, end_dt)
+                    db.slots_from_bookings(starts, ends, start_dt, end_dt, 30, 5, 2)
+            else:
+                await async_db.available_slots(1, start_dt, end_dt, 30, 5, 2)
+        await asyncio.sleep(0.002)  # Bot API round trip
+
+    async def start(uid):
+        # cmd_start-like: one write
+        if mode == "on-loop":
+            db.upsert_user(uid, "bench", None)
+        else:
+            await async_db.upsert_user(uid, "bench", None)
+        await asyncio.sleep(0.002)
+
+    async def menu_tap(uid):
+        await asyncio.sleep(0.002)  # no DB at all, only waits for the loop
+
+    handlers = {"date_tap": date_tap, "start": start, "menu_tap": menu_tap}
+    kinds = list(handlers)
+    async def user(uid):
+        for i in range(rounds):
+            kind = kinds[(uid + i) % 3]
+            t0 = time.perf_counter()
+            await handlers[kind](uid)
+            lat[kind].append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(user(u) for u in range(users)))
+    return lat, time.perf_counter() - t0
+
+def bench_loop(args):
+    """on-loop: SQLite on the event loop; writer: every query on the one DB
+    thread; reader: plain reads on async_db's read-only reader thread (default)."""
+    _seed_catalog(capacity=2)
+    _seed_day(date(2030, 1, 15), every_min=10)
+    import async_db
+    upsert, aupsert = db.upsert_user, async_db.upsert_user
+    if args.io_ms:
+        # a disk that stalls on commit (busy volume, fsync): the cost offloading is for
+        def slow_upsert(*a):
+            upsert(*a)
+            time.sleep(args.io_ms / 1000)
+        db.upsert_user, async_db.upsert_user = slow_upsert, async_db._wrap(slow_upsert)
+    print(f"{'mode':>8} {'handler':>9} {'p50 ms':>8} {'p99 ms':>8} {'updates/s':>10}   (+{args.io_ms} ms per write)")
+    try:
+        for mode in ("on-loop", "writer", "reader"):
+            lat, wall = asyncio.run(_load(args.users, args.repeat, mode))
+            n = sum(len(v) for v in lat.values())
+            for kind, samples in lat.items():
+                print(f"{mode:>8} {kind:>9} "
+                      f"{statistics.median(samples)*1e3:>8.2f} {_pct(samples, 99)*1e3:>8.2f} {n/wall:>10.0f}")
+    finally:
+        db.upsert_user, async_db.upsert_user = upsert, aupsert
+
+# ---------- epoch: text vs integer overlap queries on a large table ----------
+_TEXT_OVERLAP = """
+    SELECT COUNT(*) FROM bookings
+    WHERE resource_id=? AND status IN ('paid','pending')
+      AND starts_at < ? AND ends_at > ?
+      AND (status='paid' OR (status='pending' AND (expires_at IS NULL OR expires_at > datetime('now'))))
+"""
+
+def bench_epoch(args):
+    _seed_catalog()
+    resources = 50
+    with db.conn_ctx() as conn:
+        conn.executemany("INSERT OR IGNORE INTO resources(id,service_id,name) VALUES(?,1,?)",
+                         [(r, f"R{r}") for r in range(2, resources + 1)])
+        base = TZ.localize(datetime(2030, 1, 1, 0, 0))
+        batch = []
+        for i in range(args.rows):
+            st = base + timedelta(minutes=30 * (i // resources)); en = st + timedelta(minutes=30)
+            status = ("paid", "pending", "cancelled")[i % 3]
+            ex = (st - timedelta(days=1)) if status == "pending" else None
+            batch.append((1, i % resources + 1, i, st.isoformat(), en.isoformat(), 1, status,
+                          ex.isoformat() if ex else None, int(st.timestamp()), int(en.timestamp()),
+                          int(ex.timestamp()) if ex else None))
+            if len(batch) == 50000:
+                conn.executemany("""INSERT INTO bookings(service_id,resource_id,tg_user_id,starts_at,ends_at,amount,
+                                    status,expires_at,starts_ts,ends_ts,expires_ts) VALUES(?,?,?,?,?,?,?,?,?,?,?)""", batch)
+                batch = []
+        if batch:
+            conn.executemany("""INSERT INTO bookings(service_id,resource_id,tg_user_id,starts_at,ends_at,amount,
+                                status,expires_at,starts_ts,ends_ts,expires_ts) VALUES(?,?,?,?,?,?,?,?,?,?,?)""", batch)
+        # the text query's own index, as it was before the epoch migration dropped it
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_time ON bookings(resource_id, starts_at, ends_at)")
+        conn.commit()
+        conn.execute("ANALYZE")
+
+        mid = base + timedelta(minutes=30 * (args.rows // resources // 2))
+        s_iso, e_iso = mid.isoformat(), (mid + timedelta(hours=2)).isoformat()
+        int_sql = f"SELECT COUNT(*) FROM bookings WHERE {db._LIVE_OVERLAP}"
+        int_args = db._overlap_args(7, int(mid.timestamp()), int((mid + timedelta(hours=2)).timestamp()))
+        for name, sql, params in (("text", _TEXT_OVERLAP, (7, e_iso, s_iso)), ("epoch", int_sql, int_args)):
+            plan = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            print(f"{name:>6} plan: " + " | ".join(r[3] for r in plan))
+        t_txt = _timeit(lambda: conn.execute(_TEXT_OVERLAP, (7, e_iso, s_iso)).fetchone(), args.repeat)
+        t_int = _timeit(lambda: conn.execute(int_sql, int_args).fetchone(), args.repeat)
+    print(f"{args.rows:,} rows: text {t_txt*1e6:.0f} us/query, epoch {t_int*1e6:.0f} us/query ({t_txt/t_int:.1f}x)")
+
+# ---------- autoqa: per-message regex scan vs token phrase index ----------
+def _autoqa_regex_scan(text):
+    # The pre-index on_user_text loop: read the table, one fresh regex per pattern.
+    for _, patterns, answer in db.all_autoqa():
+        if any(p and re.search(rf"\b{re.escape(p)}\b", text) for p in patterns):
+            return answer
+    return None
+
+def bench_autoqa(args):
+    db.init_db()
+    db.clear_autoqa()
+    rnd = random.Random(7)
+    words = [f"w{i}" for i in range(3000)]
+    entries = 1000
+    for i in range(entries):  # 5 patterns per entry -> 5k patterns
+        pats = [" ".join(rnd.sample(words, rnd.randint(1, 3))) for _ in range(5)]
+        db.add_autoqa(pats, f"answer {i}")
+    msgs = [normalize_text(" ".join(rnd.choice(words + ["hello", "booking", "price?"]) for _ in range(12)))
+            for _ in range(200)]
+    for m in msgs:
+        assert _autoqa_regex_scan(m) == db.match_autoqa(m), m
+    it = iter(range(10**9))
+    t_old = _timeit(lambda: _autoqa_regex_scan(msgs[next(it) % len(msgs)]), max(1, args.repeat // 4))
+    t_new = _timeit(lambda: db.match_autoqa(msgs[next(it) % len(msgs)]), args.repeat * 50)
+    print(f"{entries * 5} patterns: regex scan {t_old*1e3:.2f} ms/msg, phrase index {t_new*1e6:.1f} us/msg "
+          f"({t_old/t_new:.0f}x)")
+
+# ---------- cache: read-through cache vs SQLite for hot reads ----------
+def bench_cache(args):
+    _seed_catalog()
+    db.set_kv("welcome_text", "hello")
+    ops = {
+        "get_kv": (db.get_kv, ("welcome_text", "default")),
+        "get_service": (db.get_service, (1,)),
+        "get_resource": (db.get_resource, (1,)),
+        "list_services": (db.list_services, ()),
+        "list_resources": (db.list_resources, (1,)),
+    }
+    n = args.repeat * 50
+    print(f"{'op':>15} {'sqlite us':>10} {'cached us':>10} {'speedup':>8}")
+    for name, (fn, fargs) in ops.items():
+        t_db = _timeit(lambda: fn.__wrapped__(*fargs), n)
+        t_c = _timeit(lambda: fn(*fargs), n)
+        print(f"{name:>15} {t_db*1e6:>10.1f} {t_c*1e6:>10.2f} {t_db/t_c:>7.0f}x")
+    print("stats:", db.cache_stats())
+
+# ---------- outbox: direct awaits vs rate-limited outbound queue ----------
+class _FloodBot:
+    """Fake Bot API that answers 429 like Telegram when a chat exceeds its rate
+    (time-compressed: group 20 msg/s, private 10 msg/s)."""
+    def __init__(self, latency: float = 0.005):
+        import outbox
+        self.latency = latency
+        self.buckets = {}
+        self.TokenBucket = outbox.TokenBucket
+        self.calls = self.flood = 0
+        self.delivered = {}  # chat_id -> perf_counter of the last delivery
+
+    async def send_message(self, chat_id, text, **kw):
+        from telegram.error import RetryAfter
+        await asyncio.sleep(self.latency)
+        self.calls += 1
+        b = self.buckets.setdefault(chat_id, self.TokenBucket(20 if chat_id < 0 else 10, 5))
+        now = time.monotonic()
+        if b.delay(now) > 0:
+            self.flood += 1
+            raise RetryAfter(1)
+        b.take(now)
+        self.delivered[chat_id] = time.perf_counter()
+        return True
+
+async def _burst(users: int, queued: bool):
+    import outbox
+    from telegram.error import RetryAfter
+    bot = _FloodBot()
+    group = -100
+    handler_lat, confirm_lat = [], []
+
+    async def direct(chat_id, text, **kw):
+        while True:  # what a careful handler has to do without a queue: sleep out the 429
+            try:
+                return await bot.send_message(chat_id, text, **kw)
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+
+    async def paid(uid):
+        # on_admin + after_paid_announce: a group notice and the user's confirmation
+        t0 = time.perf_counter()
+        if queued:
+            outbox.send_message(group, f"✅ Booking Confirmed #{uid}", priority=outbox.LOW, coalesce=True)
+            fut = outbox.send_message(uid, "✅ Booking Confirmed", priority=outbox.HIGH)
+            handler_lat.append(time.perf_counter() - t0)
+            await fut
+        else:
+            await direct(group, f"✅ Booking Confirmed #{uid}")
+            await direct(uid, "✅ Booking Confirmed")
+            handler_lat.append(time.perf_counter() - t0)
+        confirm_lat.append(bot.delivered[uid] - t0)
+
+    if queued:
+        outbox.start(bot)
+    t0 = time.perf_counter()
+    await asyncio.gather(*(paid(uid) for uid in range(1, users + 1)))
+    if queued:
+        await outbox.join()
+        await outbox.stop()
+    return handler_lat, confirm_lat, time.perf_counter() - t0, bot
+
+def bench_outbox(args):
+    # outbox limits scaled to the fake API's compressed clock (a bit under its caps)
+    os.environ.update(OUTBOX_GROUP_PER_MIN="1080", OUTBOX_CHAT_PER_SEC="8", OUTBOX_GLOBAL_PER_SEC="250")
+    print(f"{'mode':>8} {'handler p50/p99 ms':>19} {'confirm p50/p99 ms':>19} {'API calls':>9} {'429s':>5} {'drain s':>8}")
+    for queued in (False, True):
+        h, c, wall, bot = asyncio.run(_burst(args.users, queued))
+        print(f"{'outbox' if queued else 'direct':>8} {_pct(h, 50)*1e3:>9.1f}/{_pct(h, 99)*1e3:<9.1f} "
+              f"{_pct(c, 50)*1e3:>9.1f}/{_pct(c, 99)*1e3:<9.1f} {bot.calls:>9} {bot.flood:>5} {wall:>8.2f}")
+
+# ---------- metrics: per-update instrumentation overhead ----------
+def bench_metrics(args):
+    import metrics
+    from types import SimpleNamespace
+
+    async def handler(update, context):
+        return None
+
+    h = SimpleNamespace(callback=handler)
+    metrics.instrument_handlers(SimpleNamespace(handlers={0: [h]}))
+    n = args.repeat * 5000
+
+    async def loop(cb):
+        t0 = time.perf_counter()
+        for _ in range(n):
+            await cb(None, None)
+        return (time.perf_counter() - t0) / n
+    t_raw = min(asyncio.run(loop(handler)) for _ in range(3))
+    t_ins = min(asyncio.run(loop(h.callback)) for _ in range(3))
+    print(f"handler wrapper: {(t_ins - t_raw)*1e6:.2f} us/update")
+
+    _seed_catalog()
+    conn = db.get_conn()
+    stmt = lambda: conn.execute("SELECT 1").fetchone()
+    t_traced = _timeit(stmt, n)
+    conn.set_trace_callback(None)
+    t_plain = _timeit(stmt, n)
+    conn.set_trace_callback(metrics.count_statement)
+    print(f"statement counter: {(t_traced - t_plain)*1e6:.2f} us/statement")
+    def block():
+        with db.conn_ctx():
+            pass
+    t_ctx = _timeit(block, n)  # conn_ctx incl. timing hook, no SQL
+    print(f"conn_ctx + db timing: {t_ctx*1e6:.2f} us/block")
+
+# ---------- index: in-memory availability index vs SQLite at N live bookings ----------
+def bench_index(args):
+    _seed_catalog()
+    resources, live = 50, args.live
+    now = db.now_tz()
+    base = TZ.localize(datetime(2030, 1, 1, 0, 0))
+    hold_exp = int((now + timedelta(days=1)).timestamp())
+    with db.conn_ctx() as conn:
+        conn.executemany("INSERT OR IGNORE INTO resources(id,service_id,name,capacity) VALUES(?,1,?,1000)",
+                         [(r, f"R{r}") for r in range(2, resources + 1)])
+        rows = []
+        for i in range(live):
+            st = base + timedelta(minutes=20 * (i // resources)); en = st + timedelta(minutes=30)
+            pending = i % 4 == 0
+            rows.append((1, i % resources + 1, i, st.isoformat(), en.isoformat(), 1,
+                         "pending" if pending else "paid", int(st.timestamp()), int(en.timestamp()),
+                         hold_exp if pending else None))
+        conn.executemany("""INSERT INTO bookings(service_id,resource_id,tg_user_id,starts_at,ends_at,amount,
+                            status,starts_ts,ends_ts,expires_ts) VALUES(?,?,?,?,?,?,?,?,?,?)""", rows)
+        conn.commit()
+        conn.execute("ANALYZE")
+    t0 = time.perf_counter(); db.load_availability(); t_load = time.perf_counter() - t0
+    print(f"{live:,} live bookings: index load {t_load*1e3:.0f} ms")
+
+    day = base + timedelta(days=(live // resources) * 20 // 1440 // 2)
+    day_end = day + timedelta(hours=23, minutes=59)
+    def slots(indexed):
+        db.AVAILABILITY_INDEX = indexed
+        return db.available_slots(7, day, day_end, 30, 15, 3)
+    s_iso, e_iso = (day + timedelta(hours=9)).isoformat(), (day + timedelta(hours=11)).isoformat()
+    def overlap(indexed):
+        db.AVAILABILITY_INDEX = indexed
+        return db.count_overlapping(7, s_iso, e_iso)
+    print(f"{'op':>17} {'sqlite us':>10} {'index us':>9} {'speedup':>8}")
+    for name, fn in (("available_slots", slots), ("count_overlapping", overlap)):
+        t_sql = _timeit(lambda: fn(False), args.repeat)
+        t_mem = _timeit(lambda: fn(True), args.repeat * 10)
+        print(f"{name:>17} {t_sql*1e6:>10.0f} {t_mem*1e6:>9.1f} {t_sql/t_mem:>7.0f}x")
+    db.AVAILABILITY_INDEX = True
+
+    # differential check: random writes through db.py, then index vs SQL everywhere
+    rnd = random.Random(1)
+    span = (live // resources) * 20
+    made = []
+    for _ in range(500):
+        st = base + timedelta(minutes=rnd.randrange(0, span, 15)); en = st + timedelta(minutes=30)
+        bid = db.create_pending_booking(1, "b", 1, rnd.randint(1, resources), st.isoformat(), en.isoformat(), 1, "cash", None)
+        if bid:
+            made.append(bid)
+    for bid in made[::3]:
+        db.mark_paid(bid, "T")
+    for bid in made[1::3]:
+        db.cancel_booking(bid)
+    mismatches = 0
+    for _ in range(2000):
+        st = base + timedelta(minutes=rnd.randrange(0, span, 5)); en = st + timedelta(minutes=rnd.choice((15, 30, 90)))
+        res = rnd.randint(1, resources)
+        a = db._overlapping_from_index(res, st.isoformat(), en.isoformat())
+        with db.conn_ctx() as conn:
+            b = db._count_overlapping(conn, res, int(st.timestamp()), int(en.timestamp()))
+        mismatches += a != b
+    t0 = time.perf_counter(); drift = db.check_availability(repair=False); t_chk = time.perf_counter() - t0
+    print(f"after {len(made)} holds/pays/cancels: {mismatches} of 2000 random overlap counts differ, "
+          f"check_availability drift={drift} ({t_chk*1e3:.0f} ms)")
+
+# ---------- calendar: per-day slot scans vs one batched month query ----------
+def bench_calendar(args):
+    _seed_catalog(capacity=1, open_t="09:00", close_t="17:00")
+    year, month = 2030, 3
+    rows = []
+    for day in range(1, 32):
+        cur = TZ.localize(datetime(year, month, day, 9, 0))
+        every = 30 if day % 3 else 60  # every third day keeps free slots
+        while cur.hour < 17:
+            e = cur + timedelta(minutes=30)
+            rows.append((1, 1, 1, "bench", cur.isoformat(), e.isoformat(), 100, "paid",
+                         int(cur.timestamp()), int(e.timestamp())))
+            cur += timedelta(minutes=every)
+    with db.conn_ctx() as conn:
+        conn.executemany("""INSERT INTO bookings(service_id,resource_id,tg_user_id,user_full_name,
+                            starts_at,ends_at,amount,status,starts_ts,ends_ts) VALUES(?,?,?,?,?,?,?,?,?,?)""", rows)
+        conn.commit()
+    db.load_availability()
+    days = [date(year, month, d) for d in range(1, 32)]
+
+    def per_day():
+        # what a user tapping through the month costs today: one slot scan per date
+        out = set()
+        for d in days:
+            s = TZ.localize(datetime.combine(d, parse_hhmm("09:00")))
+            e = TZ.localize(datetime.combine(d, parse_hhmm("17:00")))
+            if not db.available_slots(1, s, e, 30, 15, 1):
+                out.add(d)
+        return frozenset(out)
+    def cold():
+        db.invalidate_cache("days")
+        return db.month_full_days(1, year, month, "09:00", "17:00", 30, 15, 1)
+    def warm():
+        return db.month_full_days(1, year, month, "09:00", "17:00", 30, 15, 1)
+
+    full = cold()
+    print(f"{len(full)} of {len(days)} days full")
+    print(f"{'path':>28} {'ms/month':>9}")
+    for indexed in (False, True):
+        db.AVAILABILITY_INDEX = indexed
+        t = _timeit(per_day, args.repeat)
+        print(f"{'31 x available_slots' + (' (index)' if indexed else ' (sql)'):>28} {t*1e3:>9.2f}")
+    db.AVAILABILITY_INDEX = True
+    print(f"{'month_full_days (cold)':>28} {_timeit(cold, args.repeat)*1e3:>9.2f}")
+    print(f"{'month_full_days (cached)':>28} {_timeit(warm, args.repeat * 100)*1e3:>9.4f}")
+
+# ---------- next: first free slots, day-by-day probing vs merged gap scan ----------
+def bench_next(args):
+    _seed_catalog(capacity=1, open_t="09:00", close_t="17:00")
+    resources, days_ahead, n = args.resources, 30, 8
+    today = db.now_tz().date()
+    with db.conn_ctx() as conn:
+        conn.executemany("INSERT OR IGNORE INTO resources(id,service_id,name,capacity,open_time,close_time) "
+                         "VALUES(?,1,?,1,'09:00','17:00')", [(r, f"R{r}") for r in range(2, resources + 1)])
+        rows = []
+        # every resource booked solid for the next three weeks, a few gaps after that
+        for r in range(1, resources + 1):
+            for i in range(days_ahead + 1):
+                cur = TZ.localize(datetime.combine(today + timedelta(days=i), parse_hhmm("09:00")))
+                while cur.hour < 17:
+                    e = cur + timedelta(minutes=30)
+                    if i < 21 or (cur.minute, cur.hour % 3, r % 2) != (0, 0, 0):
+                        rows.append((1, r, 1, cur.isoformat(), e.isoformat(), 1, "paid",
+                                     int(cur.timestamp()), int(e.timestamp())))
+                    cur = e
+        conn.executemany("""INSERT INTO bookings(service_id,resource_id,tg_user_id,starts_at,ends_at,amount,
+                            status,starts_ts,ends_ts) VALUES(?,?,?,?,?,?,?,?,?)""", rows)
+        conn.commit()
+    db.load_availability()
+    now = db.now_tz()
+
+    def probe():
+        # what the bot offers without /next: walk the calendar resource by resource
+        found = []
+        for i in range(days_ahead + 1):
+            d = today + timedelta(days=i)
+            for rid, name, cap, o, c in db.list_resources(1):
+                s = TZ.localize(datetime.combine(d, parse_hhmm(o)))
+                e = TZ.localize(datetime.combine(d, parse_hhmm(c)))
+                found += [(st, rid, name, en) for st, en in db.available_slots(rid, s, e, 30, 15, cap) if st >= now]
+            if len(found) >= n:
+                break
+        return [(rid, name, st, en) for st, rid, name, en in sorted(found)[:n]]
+    def merged():
+        return db.earliest_slots(1, n, days_ahead)
+
+    print(f"{len(rows):,} bookings over {resources} resources, first gap on day 21")
+    for indexed in (False, True):
+        db.AVAILABILITY_INDEX = indexed
+        t_old = _timeit(probe, args.repeat)
+        t_new = _timeit(merged, args.repeat)
+        print(f"{'index' if indexed else 'sqlite':>6}: probing {t_old*1e3:7.2f} ms   earliest_slots {t_new*1e3:6.2f} ms   {t_old/t_new:5.1f}x")
+    db.AVAILABILITY_INDEX = True
+
+# ---------- any: union of free slots across resources + assignment policies ----------
+def bench_any(args):
+    _seed_catalog(capacity=2, open_t="08:00", close_t="22:00")
+    resources = args.resources
+    d = date(2030, 2, 4)
+    with db.conn_ctx() as conn:
+        conn.executemany("INSERT OR IGNORE INTO resources(id,service_id,name,capacity,open_time,close_time) "
+                         "VALUES(?,1,?,2,'08:00','22:00')", [(r, f"R{r}") for r in range(2, resources + 1)])
+        rnd = random.Random(7)
+        rows = []
+        for r in range(1, resources + 1):
+            for _ in range(40):
+                st = TZ.localize(datetime.combine(d, parse_hhmm("08:00"))) + timedelta(minutes=15 * rnd.randrange(52))
+                en = st + timedelta(minutes=30)
+                rows.append((1, r, 1, st.isoformat(), en.isoformat(), 1, "paid", int(st.timestamp()), int(en.timestamp())))
+        conn.executemany("""INSERT INTO bookings(service_id,resource_id,tg_user_id,starts_at,ends_at,amount,
+                            status,starts_ts,ends_ts) VALUES(?,?,?,?,?,?,?,?,?)""", rows)
+        conn.commit()
+    db.load_availability()
+
+    def per_resource():
+        # the per-resource flow run N times, then unioned
+        out = set()
+        for rid, name, cap, o, c in db.list_resources(1):
+            s = TZ.localize(datetime.combine(d, parse_hhmm(o))); e = TZ.localize(datetime.combine(d, parse_hhmm(c)))
+            out.update(db.available_slots(rid, s, e, 30, 15, cap))
+        return sorted(out)
+    def union():
+        return db.available_slots_any(1, d, 30, 15)
+
+    print(f"{resources} resources, {len(rows)} bookings on one day")
+    for indexed in (False, True):
+        db.AVAILABILITY_INDEX = indexed
+        t_old = _timeit(per_resource, args.repeat)
+        t_new = _timeit(union, args.repeat)
+        print(f"{'index' if indexed else 'sqlite':>6}: {resources} x available_slots {t_old*1e3:6.2f} ms   "
+              f"available_slots_any {t_new*1e3:6.2f} ms   {t_old/t_new:4.1f}x")
+    db.AVAILABILITY_INDEX = True
+
+    # where 200 holds land on an empty day, per policy
+    day = date(2030, 2, 5)
+    lo = int(TZ.localize(datetime.combine(day, parse_hhmm("00:00"))).timestamp())
+    print(f"{'policy':>13}  holds per resource (first 10)")
+    for policy in db.ASSIGN_POLICIES:
+        counts = {}
+        rnd = random.Random(3)
+        for _ in range(200):
+            st = TZ.localize(datetime.combine(day, parse_hhmm("08:00"))) + timedelta(minutes=30 * rnd.randrange(28))
+            made = db.create_pending_booking_any(1, "b", 1, st.isoformat(), (st + timedelta(minutes=30)).isoformat(),
+                                                 1, "cash", None, policy=policy)
+            if made:
+                counts[made[1]] = counts.get(made[1], 0) + 1
+        print(f"{policy:>13}  {[counts.get(r, 0) for r in range(1, min(resources, 10) + 1)]}")
+        with db.conn_ctx() as conn:
+            conn.execute("DELETE FROM bookings WHERE starts_ts >= ? AND starts_ts < ?", (lo, lo + 86400))
+            conn.commit()
+        db.load_availability()
+
+# ---------- persist: per-update writes vs one batched flush; eager vs lazy restore ----------
+def bench_persist(args):
+    import persistence
+    db.init_db()
+    n = args.users * 20
+    data = {"svc_id": 1, "res_id": 3, "date": date(2030, 1, 2), "start_iso": "2030-01-02T10:00:00+06:00",
+            "end_iso": "2030-01-02T10:30:00+06:00", "amount": 500, "pay_method": "bkash"}
+    rows = [(uid, persistence.dumps({**data, "uid": uid})) for uid in range(n)]
+
+    def per_update():
+        # what writing on every update costs: one transaction per user
+        for row in rows:
+            db.save_persistence([row], [], [], [])
+    def batched():
+        db.save_persistence(rows, [], [], [])
+    t_one = _timeit(per_update, 1)
+    t_batch = _timeit(batched, 1)
+    print(f"{n} dirty users: per-update {t_one*1e3:.1f} ms, one flush {t_batch*1e3:.1f} ms ({t_one/t_batch:.0f}x)")
+
+    big = 100_000
+    db.save_persistence([(uid, persistence.dumps({**data, "uid": uid})) for uid in range(big)], [], [], [])
+    def eager():
+        # what PicklePersistence-style startup does: read and decode every row
+        with db.conn_ctx() as conn:
+            return {uid: persistence.loads(d) for uid, d in conn.execute("SELECT user_id, data FROM persist_user_data")}
+    t_eager = _timeit(eager, 1)
+    t_lazy = _timeit(lambda: persistence.loads(db.load_user_data(4242)), 1000)
+    print(f"{big:,} stored users: eager restore {t_eager*1e3:.0f} ms at startup, "
+          f"lazy restore {t_lazy*1e6:.0f} us on a user's first update")
+
+# ---------- sessions: per-message session SELECT vs in-memory registry ----------
+def bench_sessions(args):
+    os.environ.setdefault("ADMIN_GROUP_ID", "-100")
+    import async_db, ext_dashboard
+    db.init_db(); ext_dashboard.ensure_ext_tables()
+    with db.conn_ctx() as conn:
+        conn.executemany("INSERT OR REPLACE INTO rating_sessions(user_id, booking_id, remaining) VALUES(?,?,5)",
+                         [(uid, uid) for uid in range(0, 10_000, 10)])
+        conn.commit()
+    ext_dashboard.rating_sessions.rebuild()
+    n = 2000
+
+    def select(uid):
+        # the old per-message lookup
+        with db.conn_ctx() as conn:
+            return conn.execute("SELECT booking_id, remaining FROM rating_sessions WHERE user_id=?", (uid,)).fetchone()
+    async def old():
+        for uid in range(n):
+            await async_db.run(select, uid)
+    async def new():
+        for uid in range(n):
+            ext_dashboard.rating_sessions.get(uid)
+    for name, fn in (("DB hop + SELECT", old), ("registry", new)):
+        t0 = time.perf_counter(); asyncio.run(fn()); dt = (time.perf_counter() - t0) / n
+        print(f"{name:>16}: {dt*1e6:7.2f} us per private text (90% without a session)")
+
+# ---------- relay: global reply_session KV vs per-admin in-memory routing ----------
+def bench_relay(args):
+    import async_db, admin_session
+    db.init_db()
+    n, admins = 2000, 5
+
+    async def old():
+        # the old per-message path: read the session, relay, write back the count
+        for i in range(n):
+            sess = await async_db.get_kv("reply_session", None)
+            if not sess:
+                sess = {"user_id": i, "remain": 3, "until": time.time() + 600}
+            await async_db.set_kv("reply_session", {**sess, "remain": max(0, sess["remain"] - 1) or 3})
+    async def new():
+        for a in range(admins):
+            admin_session.start(a, 1000 + a)
+        for i in range(n):
+            admin_session.remember(i, 2000 + i)
+        for i in range(n):
+            a = i % admins
+            route = admin_session.route(a, i if i % 2 else None)
+            if route and route[1] and admin_session.record_send(a) == 0:
+                admin_session.start(a, 1000 + a)
+    for name, fn in (("global KV", old), ("per-admin memory", new)):
+        t0 = time.perf_counter(); asyncio.run(fn()); dt = (time.perf_counter() - t0) / n
+        print(f"{name:>16}: {dt*1e6:8.2f} us per relayed group message")
+    print(f"{admins} admins answering in parallel; half the messages are replies to a forwarded inquiry")
+
+# ---------- reminders: per-minute scan vs heap loaded once ----------
+def bench_reminders(args):
+    os.environ.setdefault("ADMIN_GROUP_ID", "-100")
+    import reminders
+    _seed_catalog()
+    n = args.live
+    now = time.time()
+    with db.conn_ctx() as conn:
+        rows = []
+        for i in range(n):
+            st = now + random.randint(600, 30 * 86400); st_dt = datetime.fromtimestamp(st, TZ)
+            rows.append((1, 1, i, st_dt.isoformat(), (st_dt + timedelta(minutes=30)).isoformat(), 1,
+                         "paid", int(st), int(st) + 1800, f"T{i}"))
+        conn.executemany("""INSERT INTO bookings(service_id,resource_id,tg_user_id,starts_at,ends_at,amount,
+                            status,starts_ts,ends_ts,token) VALUES(?,?,?,?,?,?,?,?,?,?)""", rows)
+        conn.commit()
+
+    def scan():
+        # what a per-minute poller does: read every upcoming paid booking, check each one
+        due = []
+        for bid, uid, st, *_ in db.upcoming_paid(int(now)):
+            left = (st - now) // 60
+            if left in reminders.REMINDER_OFFSETS_MIN:
+                due.append(bid)
+        return due
+    t_scan = _timeit(scan, args.repeat)
+    r = reminders.Reminders()
+    t0 = time.perf_counter(); r.load(db.upcoming_paid(int(now)), now); t_load = time.perf_counter() - t0
+    ops = 10_000
+    t0 = time.perf_counter()
+    for i in range(ops):
+        r.remove(i % n + 1)
+        r.add(i % n + 1, i, int(now) + 3 * 86400, "s / r", "t", now)
+    t_op = (time.perf_counter() - t0) / ops
+    t0 = time.perf_counter(); r.due(now + 60); t_due = time.perf_counter() - t0
+    print(f"{n:,} upcoming paid bookings, offsets {reminders.REMINDER_OFFSETS_MIN} min")
+    print(f"per-minute scan: {t_scan*1e3:7.2f} ms per poll = {t_scan*1440:.1f} s of DB+CPU per day")
+    print(f"heap: load once {t_load*1e3:.1f} ms; pay/cancel update {t_op*1e6:.2f} us; "
+          f"a minute's due pop {t_due*1e6:.1f} us; {len(r):,} reminders pending")
+
+BENCHES = {
+    "availability": bench_availability,
+    "conn": bench_conn,
+    "loop": bench_loop,
+    "epoch": bench_epoch,
+    "autoqa": bench_autoqa,
+    "cache": bench_cache,
+    "outbox": bench_outbox,
+    "metrics": bench_metrics,
+    "index": bench_index,
+    "calendar": bench_calendar,
+    "next": bench_next,
+    "any": bench_any,
+    "persist": bench_persist,
+    "sessions": bench_sessions,
+    "relay": bench_relay,
+    "reminders": bench_reminders,
+}
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Booking bot micro-benchmarks")
+    ap.add_argument("bench", choices=sorted(BENCHES))
+    ap.add_argument("--repeat", type=int, default=20)
+    ap.add_argument("--users", type=int, default=50, help="parallel users for loop")
+    ap.add_argument("--rows", type=int, default=1_000_000, help="synthetic bookings for the epoch bench")
+    ap.add_argument("--live", type=int, default=100_000, help="live bookings for the index / reminders benches")
+    ap.add_argument("--io-ms", type=float, default=0, help="loop bench: extra blocking ms per DB write")
+    ap.add_argument("--resources", type=int, default=10, help="resources for the next / any benches")
+    args = ap.parse_args()
+    BENCHES[args.bench](args)
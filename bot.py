@@ -1,5 +1,5 @@
 # bot.py
-import os, logging, re
+import os, time, logging
 from datetime import datetime, timedelta, date
 from dotenv import load_dotenv
 from typing import Optional
@@ -9,17 +9,28 @@ from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
 )
 from telegram.constants import ChatType
+from telegram.request import BaseRequest
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
-    ConversationHandler, MessageHandler, ContextTypes, filters
+    ConversationHandler, MessageHandler, TypeHandler, ContextTypes, filters
 )
 
-from utils import TZ, parse_hhmm, month_keyboard, main_menu, normalize_text
-from db import (
-    init_db, now_tz, upsert_user, list_services, list_resources,
-    get_service, get_resource, count_overlapping, create_pending_booking,
-    mark_paid, cancel_booking, get_booking, user_bookings, list_bookings,
-    get_kv, set_kv, add_autoqa, all_autoqa
+from utils import TZ, parse_hhmm, month_keyboard, main_menu, normalize_text, encode_cursor, decode_cursor
+from db import init_db, now_tz
+import outbox
+import metrics
+import admin_session
+import dedup
+import throttle
+import inquiries
+import media
+import reminders
+from persistence import SQLitePersistence
+from async_db import (
+    upsert_user, list_services, list_resources,
+    get_service, get_resource, available_slots, month_full_days, month_full_days_any, earliest_slots, create_pending_booking,
+    create_pending_booking_any, available_slots_any, mark_paid, cancel_booking, expire_holds, get_booking, user_bookings, list_bookings,
+    get_kv, set_kv, add_autoqa, match_autoqa, count_live_holds, check_availability
 )
 
 load_dotenv()
@@ -32,6 +43,14 @@ log = logging.getLogger("booking-bot")
 BOT_TOKEN = os.environ["BOT_TOKEN"]
 ADMIN_GROUP_ID = int(os.environ["ADMIN_GROUP_ID"])  # must be negative
 BOOKING_DAYS_AHEAD = int(os.environ.get("BOOKING_DAYS_AHEAD", "30"))
+# 0 = process updates one at a time; N > 0 = up to N handlers in flight
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "0"))
+HOLD_SWEEP_INTERVAL_SEC = int(os.environ.get("HOLD_SWEEP_INTERVAL_SEC", "60"))
+HOLD_SWEEP_BATCH = int(os.environ.get("HOLD_SWEEP_BATCH", "200"))
+AVAILABILITY_CHECK_SEC = int(os.environ.get("AVAILABILITY_CHECK_SEC", "3600"))
+NEXT_SLOTS_N = int(os.environ.get("NEXT_SLOTS_N", "8"))  # how many slots /next offers
+PERSISTENCE = os.environ.get("PERSISTENCE", "1") != "0"  # 0 = mid-flow state is lost on restart
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()  # polling | webhook (see webhook.py)
 
 WELCOME_DEFAULT = "Hello! 😊 How can I help with booking today? Try /menu."
 
@@ -44,14 +63,14 @@ PAY_METHODS = [("bKash", "bkash"), ("Nagad", "nagad"), ("Card", "card"), ("Cash"
 
 # ----------------- Utility: menu -----------------
 async def send_welcome(chat_id: int, context: ContextTypes.DEFAULT_TYPE):
-    welcome = get_kv("welcome_text", WELCOME_DEFAULT)
+    welcome = await get_kv("welcome_text", WELCOME_DEFAULT)
     await context.bot.send_message(chat_id=chat_id, text=welcome)
     await context.bot.send_message(chat_id=chat_id, text="Choose an option:", reply_markup=main_menu())
 
 # ----------------- Commands -----------------
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
-    upsert_user(u.id, u.full_name or "", u.username)
+    await upsert_user(u.id, u.full_name or "", u.username)
     await send_welcome(update.effective_chat.id, context)
 
 async def cmd_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -62,7 +81,7 @@ async def cmd_restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_my(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
-    rows = user_bookings(u.id, limit=10)
+    rows = await user_bookings(u.id, limit=10)
     if not rows:
         await update.message.reply_text("You have no bookings yet.")
         return
@@ -81,49 +100,63 @@ async def cmd_setwelcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(args) == 1:
         await update.message.reply_text("Usage: /setwelcome Your welcome text (menu auto-attached).")
         return
-    set_kv("welcome_text", args[1].strip())
+    await set_kv("welcome_text", args[1].strip())
     await update.message.reply_text("✅ Welcome text updated.")
 
-# admin: list bookings in group with pagination
+# admin: list bookings in group with keyset pagination
 async def cmd_listbooking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != ADMIN_GROUP_ID:
         return
-    await _send_booking_page(update.effective_chat.id, context, page=1)
+    await _send_booking_page(update.effective_chat.id, context)
 
 async def on_list_nav(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
-    _, page_str = q.data.split(":")
-    await _send_booking_page(q.message.chat_id, context, page=int(page_str), edit_message=q)
+    # LIST:<N|P>:<page>:<cursor>
+    _, direction, page_str, cursor = q.data.split(":")
+    await _send_booking_page(q.message.chat_id, context, page=int(page_str),
+                             cursor=decode_cursor(cursor), direction="next" if direction == "N" else "prev",
+                             edit_message=q)
 
 async def _send_booking_page(
     chat_id: int,
     context: ContextTypes.DEFAULT_TYPE,
     page: int = 1,
+    cursor: Optional[tuple] = None,
+    direction: str = "next",
     edit_message: Optional[CallbackQuery] = None,
 ):
     per_page = 10
-    offset = (page - 1) * per_page
-    rows = list_bookings(offset=offset, limit=per_page)
-    if not rows and page > 1:
-        page = 1
-        offset = 0
-        rows = list_bookings(offset=0, limit=per_page)
+    rows = await list_bookings(cursor=cursor, direction=direction, limit=per_page + 1)
+    if not rows and cursor is not None:
+        page, cursor, direction = 1, None, "next"
+        rows = await list_bookings(limit=per_page + 1)
+    # the extra row only tells us whether there is a further page that way
+    more = len(rows) > per_page
+    if direction == "prev":
+        rows = rows[-per_page:]
+        if not more:  # ran into the newest rows: this is page one again
+            page = 1
+    else:
+        rows = rows[:per_page]
 
     if not rows:
         text = "No bookings yet."
     else:
         lines = ["#  Service/Resource  Time                       Status  Token  Amount"]
-        for bid, svc, res, st, en, status, token, amount in rows:
+        for bid, svc, res, st, en, status, token, amount, _ in rows:
             s = datetime.fromisoformat(st).astimezone(TZ)
             e = datetime.fromisoformat(en).astimezone(TZ)
             lines.append(f"{bid:<3}{svc}/{res}  {s:%d %b %Y %I:%M%p}-{e:%I:%M%p}  {status.upper():<7} {token:<8} {amount}")
         text = "```\n" + "\n".join(lines) + "\n```"
 
-    kb = InlineKeyboardMarkup([[
-        InlineKeyboardButton("« Prev", callback_data=f"LIST:{max(1, page-1)}"),
-        InlineKeyboardButton(f"Page {page}", callback_data="IGNORE"),
-        InlineKeyboardButton("Next »", callback_data=f"LIST:{page+1}")
-    ]])
+    nav = [InlineKeyboardButton(f"Page {page}", callback_data="IGNORE")]
+    if rows and page > 1:
+        first = encode_cursor(rows[0][8], rows[0][0])
+        nav.insert(0, InlineKeyboardButton("« Prev", callback_data=f"LIST:P:{page-1}:{first}"))
+    if rows and (more or direction == "prev"):
+        last = encode_cursor(rows[-1][8], rows[-1][0])
+        nav.append(InlineKeyboardButton("Next »", callback_data=f"LIST:N:{page+1}:{last}"))
+    kb = InlineKeyboardMarkup([nav])
     if edit_message:
         await edit_message.edit_message_text(text=text, reply_markup=kb, parse_mode="Markdown")
     else:
@@ -135,11 +168,13 @@ async def on_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     action = q.data.split(":")[1]
     if action == "CREATE":
         await cmd_book_from_menu(q, context)
+    elif action == "NEXT":
+        await _next_services(q.message.chat, context, edit=q)
     elif action == "MY":
         fake = Update(update.update_id, message=None)
         # quickly reuse cmd_my by simulating with chat id
         u = q.from_user
-        rows = user_bookings(u.id, limit=10)
+        rows = await user_bookings(u.id, limit=10)
         if not rows:
             await q.edit_message_text("You have no bookings yet.")
         else:
@@ -155,7 +190,7 @@ async def on_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ----------------- Booking flow -----------------
 async def cmd_book(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    svcs = list_services()
+    svcs = await list_services()
     if not svcs:
         await update.message.reply_text("No services available.")
         return ConversationHandler.END
@@ -164,7 +199,7 @@ async def cmd_book(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return SVC
 
 async def cmd_book_from_menu(q, context):
-    svcs = list_services()
+    svcs = await list_services()
     if not svcs:
         await q.edit_message_text("No services available.")
         return
@@ -175,61 +210,79 @@ async def on_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
     svc_id = int(q.data.split(":")[1])
     context.user_data["svc_id"] = svc_id
-    res_list = list_resources(svc_id)
+    res_list = await list_resources(svc_id)
     if not res_list:
         await q.edit_message_text("No resources for this service.")
         return ConversationHandler.END
     rows = [[InlineKeyboardButton(f"{r[1]} (cap {r[2]})", callback_data=f"RES:{r[0]}")] for r in res_list]
+    if len(res_list) > 1:
+        rows.insert(0, [InlineKeyboardButton("✨ Any available", callback_data="RES:ANY")])
     await q.edit_message_text("Select a resource:", reply_markup=InlineKeyboardMarkup(rows))
     return RES
 
+async def _calendar(context: ContextTypes.DEFAULT_TYPE, year: int, month: int):
+    # month grid with fully booked / closed days crossed out (one cached query per month)
+    today = now_tz().date()
+    max_d = today + timedelta(days=BOOKING_DAYS_AHEAD)
+    full = frozenset()
+    if (year, month) >= (today.year, today.month) and date(year, month, 1) <= max_d:
+        svc = await get_service(context.user_data["svc_id"])
+        rid = context.user_data["res_id"]
+        # a burst of users opening the same cold month shares one query
+        if rid is None:  # "any available": full only when full on every resource
+            full, _ = await dedup.single_flight(
+                ("days", "any", svc[0], year, month),
+                lambda: month_full_days_any(svc[0], year, month, int(svc[2]), int(svc[4])))
+        else:
+            res = await get_resource(rid)
+            full, _ = await dedup.single_flight(
+                ("days", rid, year, month),
+                lambda: month_full_days(res[0], year, month, res[4], res[5], int(svc[2]), int(svc[4]), int(res[3])))
+    return month_keyboard(year, month, today, max_d, full)
+
 async def on_resource(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
-    rid = int(q.data.split(":")[1])
-    context.user_data["res_id"] = rid
+    rid = q.data.split(":")[1]
+    context.user_data["res_id"] = None if rid == "ANY" else int(rid)  # None = assign at hold time
 
     today = now_tz().date()
-    max_d = today + timedelta(days=BOOKING_DAYS_AHEAD)
-    kb = month_keyboard(today.year, today.month, today, max_d)
+    kb = await _calendar(context, today.year, today.month)
     await q.edit_message_text("Choose a date:", reply_markup=kb)
     return CAL
 
 async def on_calendar_nav(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
     _, y, m = q.data.split(":"); y = int(y); m = int(m)
-    today = now_tz().date()
-    max_d = today + timedelta(days=BOOKING_DAYS_AHEAD)
-    kb = month_keyboard(y, m, today, max_d)
+    kb = await _calendar(context, y, m)
     await q.edit_message_reply_markup(reply_markup=kb)
 
+async def on_full_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    d = date.fromisoformat(update.callback_query.data.split(":")[1])
+    await update.callback_query.answer(f"{d:%d %b} is fully booked. Please pick another date.")
+
 async def on_date_picked(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
     d = date.fromisoformat(q.data.split(":")[1])
     context.user_data["date"] = d
 
-    svc = get_service(context.user_data["svc_id"])  # id,name,dur,price,step
-    res = get_resource(context.user_data["res_id"]) # id,svc_id,name,cap,open,close
+    svc = await get_service(context.user_data["svc_id"])  # id,name,dur,price,step
     duration = int(svc[2]); price = int(svc[3]); step = int(svc[4])
-    open_t = parse_hhmm(res[4]); close_t = parse_hhmm(res[5])
+    if context.user_data["res_id"] is None:
+        options = await available_slots_any(svc[0], d, duration, step)
+    else:
+        res = await get_resource(context.user_data["res_id"]) # id,svc_id,name,cap,open,close
+        open_t = parse_hhmm(res[4]); close_t = parse_hhmm(res[5])
 
-    start_dt = TZ.localize(datetime.combine(d, open_t))
-    end_dt   = TZ.localize(datetime.combine(d, close_t))
+        start_dt = TZ.localize(datetime.combine(d, open_t))
+        end_dt   = TZ.localize(datetime.combine(d, close_t))
 
-    options = []
-    cur = start_dt
-    while cur + timedelta(minutes=duration) <= end_dt:
-        s = cur
-        e = cur + timedelta(minutes=duration)
-        cnt = count_overlapping(res[0], s.isoformat(), e.isoformat())
-        if cnt < int(res[3]):
-            options.append((s, e))
-        cur += timedelta(minutes=step)
+        options = await available_slots(res[0], start_dt, end_dt, duration, step, int(res[3]))
+    now = now_tz()
+    options = [(s, e) for s, e in options if s > now]  # today: only times still ahead
 
     if not options:
-        await q.edit_message_text("No available slots on this date. Pick another date:")
-        today = now_tz().date(); max_d = today + timedelta(days=BOOKING_DAYS_AHEAD)
-        kb = month_keyboard(d.year, d.month, today, max_d)
-        await q.edit_message_reply_markup(reply_markup=kb)
+        kb = await _calendar(context, d.year, d.month)
+        await q.edit_message_text("No available slots on this date. Pick another date:", reply_markup=kb)
         return CAL
 
     rows, row = [], []
@@ -244,23 +297,90 @@ async def on_date_picked(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["amount"] = price
     return PICK_TIME
 
+@dedup.once
 async def on_time_picked(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
-    data = q.data.split(":")[1]
+    data = q.data.split(":", 1)[1]  # the ISO times themselves contain ':'
     if "|" not in data:
         await q.edit_message_text("Sorry, invalid time selection. Try /book again.")
         return ConversationHandler.END
     s_iso, e_iso = data.split("|")
+    if datetime.fromisoformat(s_iso) <= now_tz():  # a time list left open (or restored) too long
+        await q.edit_message_text("That slot is no longer available. Try /book again.")
+        return ConversationHandler.END
     context.user_data["start_iso"] = s_iso
     context.user_data["end_iso"] = e_iso
+    return await _ask_payment(q, context)
 
+async def _ask_payment(q: CallbackQuery, context: ContextTypes.DEFAULT_TYPE, header: str = ""):
     buttons = [[InlineKeyboardButton(t, callback_data=f"PM:{v}")] for t, v in PAY_METHODS]
     await q.edit_message_text(
-        f"Fee: {context.user_data['amount']} ৳\nSelect payment method:",
+        f"{header}Fee: {context.user_data['amount']} ৳\nSelect payment method:",
         reply_markup=InlineKeyboardMarkup(buttons)
     )
     return PAY_METHOD
 
+# ----------------- First available slot (/next) -----------------
+async def _next_services(chat, context: ContextTypes.DEFAULT_TYPE, edit: Optional[CallbackQuery] = None):
+    svcs = await list_services()
+    if len(svcs) == 1:
+        text, kb = await _next_slots(svcs[0][0], chat.type == ChatType.PRIVATE)
+    elif svcs:
+        text = "First available slot for which service?"
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton(s[1], callback_data=f"NXS:{s[0]}")] for s in svcs])
+    else:
+        text, kb = "No services available.", None
+    if edit is not None:
+        await edit.edit_message_text(text, reply_markup=kb)
+    else:
+        await context.bot.send_message(chat_id=chat.id, text=text, reply_markup=kb)
+
+async def _next_slots(svc_id: int, bookable: bool):
+    """Text + keyboard listing the earliest free slots. Outside a private chat
+    (e.g. admins in the group) it is a plain list, since booking happens in DM."""
+    svc = await get_service(svc_id)
+    slots = await earliest_slots(svc_id, NEXT_SLOTS_N, BOOKING_DAYS_AHEAD)
+    if not svc or not slots:
+        return f"No free slots in the next {BOOKING_DAYS_AHEAD} days.", None
+    title = f"Earliest free slots – {svc[1]}:"
+    if not bookable:
+        lines = [f"{s:%a %d %b, %I:%M %p} – {name}" for _, name, s, _ in slots]
+        return "\n".join([title, *lines]), None
+    rows = [[InlineKeyboardButton(f"{s:%a %d %b, %I:%M %p} · {name}",
+                                  callback_data=f"NX:{svc_id}:{res_id}:{int(s.timestamp())}")]
+            for res_id, name, s, _ in slots]
+    return title, InlineKeyboardMarkup(rows)
+
+async def cmd_next(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _next_services(update.effective_chat, context)
+
+async def on_next_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query; await q.answer()
+    text, kb = await _next_slots(int(q.data.split(":")[1]), q.message.chat.type == ChatType.PRIVATE)
+    await q.edit_message_text(text, reply_markup=kb)
+
+async def on_next_picked(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # entry point of the booking conversation: skips service/resource/date/time
+    q = update.callback_query; await q.answer()
+    _, svc_id, res_id, ts = q.data.split(":")
+    svc = await get_service(int(svc_id))
+    if not svc:
+        await q.edit_message_text("That service is no longer available. Try /next again.")
+        return ConversationHandler.END
+    s = datetime.fromtimestamp(int(ts), TZ)
+    e = s + timedelta(minutes=int(svc[2]))
+    if s <= now_tz():  # an old /next list
+        await q.edit_message_text("That slot is no longer available. Try /next again.")
+        return ConversationHandler.END
+    context.user_data.update(
+        svc_id=int(svc_id), res_id=int(res_id), date=s.date(),
+        duration=int(svc[2]), amount=int(svc[3]),
+        start_iso=s.isoformat(), end_iso=e.isoformat(),
+    )
+    # the hold itself re-checks capacity and hours, so a slot taken meanwhile is caught there
+    return await _ask_payment(q, context, header=f"{s:%d %b %Y, %I:%M %p}-{e:%I:%M %p}\n")
+
+@dedup.once
 async def on_payment_method(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
     method = q.data.split(":")[1]
@@ -297,7 +417,7 @@ async def on_payment_ref(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Create pending booking (hold)
     u = update.effective_user
-    upsert_user(u.id, u.full_name or "", u.username)
+    await upsert_user(u.id, u.full_name or "", u.username)
 
     svc_id = context.user_data["svc_id"]
     res_id = context.user_data["res_id"]
@@ -305,20 +425,24 @@ async def on_payment_ref(update: Update, context: ContextTypes.DEFAULT_TYPE):
     e_iso  = context.user_data["end_iso"]
     amount = int(context.user_data.get("amount", 0))
 
-    bid = create_pending_booking(
-        tg_user_id=u.id, user_full_name=u.full_name or "",
-        service_id=svc_id, resource_id=res_id,
+    hold = dict(
+        tg_user_id=u.id, user_full_name=u.full_name or "", service_id=svc_id,
         starts_at_iso=s_iso, ends_at_iso=e_iso,
         amount=amount, payment_method=method,
         payment_ref=context.user_data.get("pay_ref"),
     )
+    if res_id is None:
+        made = await create_pending_booking_any(**hold)
+        bid, res_id = made if made else (None, None)
+    else:
+        bid = await create_pending_booking(resource_id=res_id, **hold)
 
     if not bid:
-        await update.message.reply_text("Sorry, that slot just filled up. Please choose another time with /book.")
+        await update.message.reply_text("Sorry, that slot is no longer available. Please choose another time with /book.")
         return ConversationHandler.END
 
-    svc = get_service(svc_id)
-    res = get_resource(res_id)
+    svc = await get_service(svc_id)
+    res = await get_resource(res_id)
     s = datetime.fromisoformat(s_iso).astimezone(TZ)
     e = datetime.fromisoformat(e_iso).astimezone(TZ)
 
@@ -338,41 +462,101 @@ async def on_payment_ref(update: Update, context: ContextTypes.DEFAULT_TYPE):
         InlineKeyboardButton("✅ Mark Paid", callback_data=f"ADMIN:PAID:{bid}:{opaque}"),
         InlineKeyboardButton("🛑 Cancel",    callback_data=f"ADMIN:CANCEL:{bid}:{opaque}")
     ]]
-    await context.bot.send_message(chat_id=ADMIN_GROUP_ID, text=text, reply_markup=InlineKeyboardMarkup(kb))
+    outbox.send_message(ADMIN_GROUP_ID, text, priority=outbox.LOW, reply_markup=InlineKeyboardMarkup(kb))
     await update.message.reply_text("Your request was sent for verification. You'll receive confirmation soon.")
     return ConversationHandler.END
 
-# Admin booking actions
+# Admin booking actions. Double taps are dropped by dedup.once; taps on the
+# same booking and action from different places share one run via single_flight.
+@dedup.once
 async def on_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query; await q.answer()
     if q.message.chat_id != ADMIN_GROUP_ID:
         return
     _, action, bid_str, _ = q.data.split(":")
     bid = int(bid_str)
+    # only the same action collapses: a Cancel tapped during a Mark Paid still runs
+    # (both writes are conditional, so whichever lands second sees the first)
     if action == "PAID":
-        token = os.urandom(4).hex().upper()
-        ok = mark_paid(bid, token)
-        b = get_booking(bid)
-        if not b:
-            await q.edit_message_text("Booking not found.")
-            return
-        if ok:
-            s = datetime.fromisoformat(b[7]).astimezone(TZ)
-            e = datetime.fromisoformat(b[8]).astimezone(TZ)
-            await q.edit_message_text(q.message.text + "\n\n✔️ Marked as PAID")
-            await context.bot.send_message(
-                chat_id=b[5],
-                text=(f"✅ Booking Confirmed\nToken: {token}\nService: {b[2]}\n"
-                      f"Resource: {b[4]}\nTime: {s:%d %b %Y, %I:%M %p} → {e:%I:%M %p}")
-            )
-        else:
-            await q.edit_message_text(q.message.text + "\n\n⚠️ Cannot mark paid (cancelled/expired?)")
+        await dedup.single_flight(("booking", bid, action), lambda: _admin_paid(q, bid))
+    else:
+        await dedup.single_flight(("booking", bid, action), lambda: _admin_cancel(q, bid))
+
+async def _admin_paid(q: CallbackQuery, bid: int):
+    token = os.urandom(4).hex().upper()
+    ok = await mark_paid(bid, token)
+    b = await get_booking(bid)
+    if not b:
+        await q.edit_message_text("Booking not found.")
+        return
+    if ok:
+        s = datetime.fromisoformat(b[7]).astimezone(TZ)
+        e = datetime.fromisoformat(b[8]).astimezone(TZ)
+        if b[12] == "paid":  # not cancelled meanwhile by a concurrent Cancel tap
+            reminders.add(bid, b[5], int(s.timestamp()), f"{b[2]} / {b[4]}", token)
+        await q.edit_message_text(q.message.text + "\n\n✔️ Marked as PAID")
+        outbox.send_message(
+            b[5],
+            (f"✅ Booking Confirmed\nToken: {token}\nService: {b[2]}\n"
+             f"Resource: {b[4]}\nTime: {s:%d %b %Y, %I:%M %p} → {e:%I:%M %p}"),
+            priority=outbox.HIGH,
+        )
+    elif b[12] == "paid":
+        # paid earlier; the user already has their token
+        await q.edit_message_text(q.message.text + f"\n\n✔️ Already PAID (token {b[13]})")
+    elif b[12] in ("pending", "expired"):
+        # the hold lapsed and its seat was taken meanwhile (db.mark_paid)
+        await q.edit_message_text(q.message.text + "\n\n⚠️ Not marked paid: the hold lapsed and the slot "
+                                  "is full now. Refund or rebook the user.")
     else:
-        cancel_booking(bid)
-        b = get_booking(bid)
-        await q.edit_message_text(q.message.text + "\n\n❌ Cancelled.")
-        if b:
-            await context.bot.send_message(chat_id=b[5], text=f"Sorry, your booking #{bid} was cancelled.")
+        await q.edit_message_text(q.message.text + "\n\n⚠️ Cannot mark paid (cancelled)")
+
+async def _admin_cancel(q: CallbackQuery, bid: int):
+    if not await cancel_booking(bid):
+        # cancelled before (a late repeat tap, or another copy of this message)
+        if "❌ Cancelled" not in (q.message.text or ""):
+            await q.edit_message_text(q.message.text + "\n\n❌ Already cancelled.")
+        return
+    reminders.remove(bid)
+    b = await get_booking(bid)
+    await q.edit_message_text(q.message.text + "\n\n❌ Cancelled.")
+    if b:
+        outbox.send_message(b[5], f"Sorry, your booking #{bid} was cancelled.", priority=outbox.HIGH)
+
+# Periodic job: expire lapsed holds so they stop consuming capacity
+async def sweep_holds(context: ContextTypes.DEFAULT_TYPE):
+    metrics.HANDLER.set("sweep_holds")  # job runs in its own task context
+    t0 = time.perf_counter()
+    expired = []
+    while True:
+        batch = await expire_holds(HOLD_SWEEP_BATCH)
+        expired.extend(batch)
+        if len(batch) < HOLD_SWEEP_BATCH:
+            break
+    metrics.SWEEP_RUNS.inc()
+    metrics.SWEEP_EXPIRED.inc(n=len(expired))
+    metrics.SWEEP_SECONDS.observe(time.perf_counter() - t0)
+    log.info("hold sweep: expired %d rows", len(expired))
+    if not expired:
+        return
+
+    lines = []
+    for bid, uid, name, st, en in expired:
+        s = datetime.fromisoformat(st).astimezone(TZ)
+        lines.append(f"#{bid} {name or uid} – {s:%d %b %Y, %I:%M %p}")
+        outbox.send_message(uid, f"⌛ Your hold #{bid} expired before payment was verified. If you already paid, "
+                                 "an admin can still confirm it while the slot is free; otherwise use /book to pick a slot again.")
+    # one roll-up for the admins instead of a message per hold
+    for i in range(0, len(lines), 50):
+        outbox.send_message(ADMIN_GROUP_ID, "⌛ Expired holds\n" + "\n".join(lines[i:i+50]),
+                            priority=outbox.LOW, coalesce=True)
+
+async def check_availability_index(context: ContextTypes.DEFAULT_TYPE):
+    # the index is updated by every write in db.py; this catches anything that
+    # slipped past it (manual SQL edits, a second process) and rebuilds
+    diff = await check_availability()
+    if diff:
+        log.warning("availability index: %d bookings out of step with SQLite, reloaded", diff)
 
 # ----------------- Auto conversation setup (admin) -----------------
 async def cmd_setconversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -393,40 +577,26 @@ async def setqa_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not keys or not answer.strip():
         await update.message.reply_text("❗ Keys or answer missing. Start again: /setconversation")
         return ConversationHandler.END
-    add_autoqa(keys, answer.strip())
+    await add_autoqa(keys, answer.strip())
     await update.message.reply_text("✅ Thanks! Conversation flow updated. I’ll auto-reply for those keywords.")
     return ConversationHandler.END
 
 # ----------------- General inquiries: forward to group / auto-reply -----------------
-def _group_reply_state():
-    # single admin group; store session info in KV
-    return get_kv("reply_session", None)
-
-def _set_group_reply_state(user_id: int, remain: int = 3, minutes: int = 10):
-    until = (now_tz() + timedelta(minutes=minutes)).timestamp()
-    set_kv("reply_session", {"user_id": user_id, "remain": remain, "until": until})
-
-async def _open_reply_mode(context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    _set_group_reply_state(user_id, remain=3, minutes=10)
-    await context.bot.send_message(
-        chat_id=ADMIN_GROUP_ID,
-        text=f"➡️ Reply mode ON for user [{user_id}] (limit: 3). Type your message…"
-    )
-
-def _reply_allowed_for(user_id: int) -> bool:
-    sess = _group_reply_state()
-    if not sess: return False
-    if sess.get("user_id") != user_id: return False
-    if now_tz().timestamp() > sess.get("until", 0): return False
-    if int(sess.get("remain", 0)) <= 0: return False
-    return True
-
-def _consume_reply():
-    sess = _group_reply_state()
-    if not sess: return
-    remain = int(sess.get("remain", 0)) - 1
-    sess["remain"] = max(0, remain)
-    set_kv("reply_session", sess)
+# Reply routing lives in admin_session (in memory, per admin): several admins can
+# answer different users at once, and replying to a forwarded inquiry goes
+# straight to its sender. Forwarding and its keyboards are in inquiries.py.
+def _open_reply_mode(admin, user_id: int):
+    admin_session.start(admin.id, user_id)
+    outbox.send_message(ADMIN_GROUP_ID,
+                        f"➡️ Reply mode ON: {admin.full_name} → user [{user_id}] "
+                        f"(limit: {admin_session.REPLY_LIMIT}). Type your message, "
+                        "or reply to the inquiry itself.",
+                        priority=outbox.LOW, coalesce=True)
+
+def _relay_target(admin_id: int, m):
+    """(user_id, via_session) for an admin's group message, or None."""
+    reply_to = m.reply_to_message.message_id if m.reply_to_message else None
+    return admin_session.route(admin_id, reply_to)
 
 async def on_user_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # only private chats from users
@@ -435,45 +605,25 @@ async def on_user_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = normalize_text(update.message.text or "")
 
     # 1) Auto-Q/A
-    for _, patterns, answer in all_autoqa():
-        if any(p and re.search(rf"\b{re.escape(p)}\b", text) for p in patterns):
-            await update.message.reply_text(answer, reply_markup=main_menu())
-            return
+    answer = await match_autoqa(text)
+    if answer:
+        await update.message.reply_text(answer, reply_markup=main_menu())
+        return
 
-    # 2) Forward to group as General Inquiry
-    u = update.effective_user
-    kb = InlineKeyboardMarkup([[
-        InlineKeyboardButton("💬 Reply", callback_data=f"GR:REPLY:{u.id}"),
-        InlineKeyboardButton("🔕 Mute 10m", callback_data=f"GR:MUTE:{u.id}"),
-        InlineKeyboardButton("⛔ Stop", callback_data=f"GR:STOP:{u.id}")
-    ]])
-    await context.bot.send_message(
-        chat_id=ADMIN_GROUP_ID,
-        text=(f"📨 General Inquiry\nFrom: {u.full_name}\n"
-              f"(@{u.username or 'n/a'}) [{u.id}]\nMessage:\n{text or '(empty)'}"),
-        reply_markup=kb
-    )
+    # 2) Forward to group as General Inquiry (batched into digests, see inquiries.py)
+    inquiries.add(update.effective_user, text)
     # polite default back to user
-    await update.message.reply_text(get_kv("welcome_text", WELCOME_DEFAULT), reply_markup=main_menu())
+    await update.message.reply_text(await get_kv("welcome_text", WELCOME_DEFAULT), reply_markup=main_menu())
 
 async def on_user_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # forward photos also to group
-    if update.effective_chat.type != ChatType.PRIVATE:
+    # forward photos also to group; album parts are gathered first
+    if update.effective_chat.type != ChatType.PRIVATE or not update.message.photo:
         return
     u = update.effective_user
-    photo = update.message.photo[-1].file_id if update.message.photo else None
-    kb = InlineKeyboardMarkup([[
-        InlineKeyboardButton("💬 Reply", callback_data=f"GR:REPLY:{u.id}"),
-        InlineKeyboardButton("🔕 Mute 10m", callback_data=f"GR:MUTE:{u.id}"),
-        InlineKeyboardButton("⛔ Stop", callback_data=f"GR:STOP:{u.id}")
-    ]])
-    if photo:
-        await context.bot.send_photo(
-            chat_id=ADMIN_GROUP_ID, photo=photo,
-            caption=(f"🧾 General Inquiry (photo)\nFrom: {u.full_name} (@{u.username or 'n/a'}) [{u.id}]\n"
-                     f"Caption:\n{update.message.caption or '(no caption)'}"),
-            reply_markup=kb
-        )
+    if update.message.media_group_id:
+        media.collect(update.message, lambda parts: inquiries.add_photos(u, parts))
+    else:
+        inquiries.add_photos(u, [update.message])
 
 # Group button actions for general inquiries
 async def on_group_reply_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -483,58 +633,95 @@ async def on_group_reply_buttons(update: Update, context: ContextTypes.DEFAULT_T
     _, action, uid = q.data.split(":")
     uid = int(uid)
     if action == "REPLY":
-        await _open_reply_mode(context, uid)
+        _open_reply_mode(q.from_user, uid)
     elif action == "MUTE":
-        # simple: just open reply mode but with 0 remain; effectively nothing will send
-        set_kv("reply_session", {"user_id": uid, "remain": 0, "until": (now_tz()+timedelta(minutes=10)).timestamp()})
-        await q.message.reply_text("🔕 Muted replies for 10 minutes for this user.")
-    else:  # STOP
-        set_kv("reply_session", None)
+        admin_session.mute(uid)
+        await q.message.reply_text(f"🔕 Muted replies for {admin_session.REPLY_MINUTES} minutes for this user.")
+    else:  # STOP: ends every admin's reply session with this user
+        admin_session.stop_user(uid)
         await q.message.reply_text("🛑 Reply mode stopped.")
 
-# Relay group messages to the target user while reply mode is on
+# Relay group messages to the target user: the sender of the inquiry being
+# replied to, else the admin's own reply session
 async def on_group_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_chat.id != ADMIN_GROUP_ID:
+    if update.effective_chat.id != ADMIN_GROUP_ID or not update.message.text:
         return
-    sess = _group_reply_state()
-    if not sess: return
-    if now_tz().timestamp() > sess.get("until", 0): return
-    user_id = int(sess.get("user_id"))
-    if sess.get("remain", 0) <= 0: return
-    if update.message.text:
-        await context.bot.send_message(chat_id=user_id, text=update.message.text)
-        _consume_reply()
+    route = _relay_target(update.effective_user.id, update.message)
+    if not route: return
+    user_id, via_session = route
+    outbox.send_message(user_id, update.message.text)
+    if via_session:
+        admin_session.record_send(update.effective_user.id)
 
 async def on_group_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_chat.id != ADMIN_GROUP_ID:
+    if update.effective_chat.id != ADMIN_GROUP_ID or not update.message.photo:
         return
-    sess = _group_reply_state()
-    if not sess: return
-    if now_tz().timestamp() > sess.get("until", 0): return
-    if sess.get("remain", 0) <= 0: return
-    user_id = int(sess.get("user_id"))
-    if update.message.photo:
-        await context.bot.copy_message(
-            chat_id=user_id,
-            from_chat_id=update.effective_chat.id,
-            message_id=update.message.message_id
-        )
-        _consume_reply()
+    admin_id = update.effective_user.id
+    if update.message.media_group_id:
+        media.collect(update.message, lambda parts: _relay_photos(admin_id, parts))
+    else:
+        _relay_photos(admin_id, [update.message])
+
+def _relay_photos(admin_id: int, messages: list):
+    # one album counts as one reply
+    route = _relay_target(admin_id, messages[0])
+    if not route: return
+    user_id, via_session = route
+    scope = ("to", user_id)
+    photos = media.fresh(scope, messages)
+    if len(photos) == 1:
+        media.sent(outbox.copy_message(user_id, ADMIN_GROUP_ID, photos[0].message_id), scope, photos)
+    elif photos:
+        media.sent(outbox.send_media_group(user_id, media.as_album(photos)), scope, photos)
+    if photos and via_session:
+        admin_session.record_send(admin_id)
 
 # ----------------- Wiring -----------------
-def get_app():
+async def _post_init(app: Application):
+    outbox.start(app.bot)
+    await throttle.load_bans()
+    await reminders.start()
+    # after every add_handler (incl. wire_dashboard), so all callbacks get timed
+    metrics.instrument_handlers(app)
+    metrics.gauge("booking_update_queue_depth", "Updates received but not yet dispatched", app.update_queue.qsize)
+    metrics.gauge("booking_live_holds", "Pending holds still reserving capacity", count_live_holds)
+    await metrics.start_server()
+
+async def _post_stop(app: Application):
+    # drain queued sends while the bot's HTTP client is still open
+    await reminders.stop()
+    media.flush()
+    inquiries.flush()
+    await outbox.stop()
+    await metrics.stop_server()
+
+def get_app(request: Optional[BaseRequest] = None, updates_request: Optional[BaseRequest] = None):
+    """Build the Application. request/updates_request swap the HTTP layer
+    (loadtest.py passes an in-process fake Bot API)."""
     init_db()
-    app = Application.builder().token(BOT_TOKEN).build()
+    builder = (Application.builder().token(BOT_TOKEN).concurrent_updates(CONCURRENT_UPDATES or False)
+               .post_init(_post_init).post_stop(_post_stop))
+    if request is not None:
+        builder = builder.request(request)
+    if updates_request is not None:
+        builder = builder.get_updates_request(updates_request)
+    if PERSISTENCE:
+        builder = builder.persistence(SQLitePersistence())
+    app = builder.build()
 
     # Booking conversation
     conv = ConversationHandler(
-        entry_points=[CommandHandler("book", cmd_book)],
+        entry_points=[
+            CommandHandler("book", cmd_book),
+            CallbackQueryHandler(on_next_picked, pattern=r"^NX:\d+:\d+:\d+$"),
+        ],
         states={
             SVC: [CallbackQueryHandler(on_service, pattern=r"^SVC:\d+$")],
-            RES: [CallbackQueryHandler(on_resource, pattern=r"^RES:\d+$")],
+            RES: [CallbackQueryHandler(on_resource, pattern=r"^RES:(\d+|ANY)$")],
             CAL: [
                 CallbackQueryHandler(on_calendar_nav, pattern=r"^CAL:\d{4}:\d{1,2}$"),
                 CallbackQueryHandler(on_date_picked,  pattern=r"^DATE:\d{4}-\d{2}-\d{2}$"),
+                CallbackQueryHandler(on_full_day,     pattern=r"^FULL:\d{4}-\d{2}-\d{2}$"),
             ],
             PICK_TIME: [CallbackQueryHandler(on_time_picked, pattern=r"^TIME:.*$")],
             PAY_METHOD: [CallbackQueryHandler(on_payment_method, pattern=r"^PM:(bkash|nagad|card|cash)$")],
@@ -542,18 +729,24 @@ def get_app():
         },
         fallbacks=[CommandHandler("book", cmd_book)],
         allow_reentry=True,
+        name="booking", persistent=PERSISTENCE,  # a redeploy doesn't drop users mid-flow
     )
 
+    # Flood control first: private updates over the per-user rate stop here
+    app.add_handler(TypeHandler(Update, throttle.guard), group=-1)
+
     # Public commands
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("menu",  cmd_menu))
     app.add_handler(CommandHandler("restart", cmd_restart))
     app.add_handler(CommandHandler("my", cmd_my))
+    app.add_handler(CommandHandler("next", cmd_next))
+    app.add_handler(CallbackQueryHandler(on_next_service, pattern=r"^NXS:\d+$"))
 
     # Admin commands (group only)
     app.add_handler(CommandHandler("setwelcome", cmd_setwelcome))
     app.add_handler(CommandHandler("listbooking", cmd_listbooking))
-    app.add_handler(CallbackQueryHandler(on_list_nav, pattern=r"^LIST:\d+$"))
+    app.add_handler(CallbackQueryHandler(on_list_nav, pattern=r"^LIST:[NP]:\d+:[0-9a-z]+\.[0-9a-z]+$"))
 
     # Auto-conversation setup (group)
     app.add_handler(ConversationHandler(
@@ -567,7 +760,7 @@ def get_app():
     ))
 
     # Menu callbacks
-    app.add_handler(CallbackQueryHandler(on_menu, pattern=r"^MENU:(CREATE|MY|RESTART)$"))
+    app.add_handler(CallbackQueryHandler(on_menu, pattern=r"^MENU:(CREATE|NEXT|MY|RESTART)$"))
 
     # Booking admin actions in group
     app.add_handler(CallbackQueryHandler(on_admin, pattern=r"^ADMIN:(PAID|CANCEL):\d+:"))
@@ -577,14 +770,24 @@ def get_app():
     app.add_handler(MessageHandler(filters.Chat(ADMIN_GROUP_ID) & filters.PHOTO, on_group_photo))
     app.add_handler(MessageHandler(filters.Chat(ADMIN_GROUP_ID) & filters.TEXT & ~filters.COMMAND, on_group_text))
 
+    # Booking conversation before the generic user handlers: it only claims
+    # updates from users mid-flow (or /book), and PAY_REF needs their text
+    app.add_handler(conv)
+
     # User generic handlers (MUST be after conversation so booking states work)
     app.add_handler(MessageHandler(filters.PHOTO & filters.ChatType.PRIVATE, on_user_photo))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, on_user_text))
 
-    # Booking conversation last so it doesn’t swallow generic messages unnecessarily
-    app.add_handler(conv)
+    # Background jobs
+    app.job_queue.run_repeating(sweep_holds, interval=HOLD_SWEEP_INTERVAL_SEC, first=10, name="sweep_holds")
+    app.job_queue.run_repeating(check_availability_index, interval=AVAILABILITY_CHECK_SEC,
+                                first=AVAILABILITY_CHECK_SEC, name="check_availability")
 
     return app
 
 if __name__ == "__main__":
-    get_app().run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == "webhook":
+        from webhook import run_webhook
+        run_webhook(get_app())
+    else:
+        get_app().run_polling(allowed_updates=Update.ALL_TYPES)
@@ -1,23 +1,163 @@
 # db.py
-import os, sqlite3, json
+import os, time, heapq, sqlite3, json, threading, functools
+from itertools import islice
+from bisect import bisect_left, bisect_right
 from contextlib import contextmanager
-from datetime import datetime, timedelta
-from utils import TZ
+import calendar
+from datetime import datetime, timedelta, date
+from utils import TZ, normalize_text, parse_hhmm
+from availability import AvailabilityIndex, free_slots
+import metrics
 
 DB_PATH = os.getenv("DB_PATH", "booking.db")
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")  # NORMAL is durable enough under WAL
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHED_STATEMENTS = int(os.getenv("DB_CACHED_STATEMENTS", "256"))
+AVAILABILITY_INDEX = os.getenv("AVAILABILITY_INDEX", "1") != "0"  # 0 = always ask SQLite
+
+# One long-lived connection per (thread, DB_PATH); sqlite3 connections are not
+# shared across threads.
+_local = threading.local()
+
+def _open(path: str, read_only: bool = False) -> sqlite3.Connection:
+    if read_only:  # WAL lets it read alongside the writer, from its own snapshot
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                               cached_statements=DB_CACHED_STATEMENTS)
+    else:
+        conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                               cached_statements=DB_CACHED_STATEMENTS)
+        conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS};")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS};")
+    conn.execute("PRAGMA foreign_keys=ON;")
+    conn.set_trace_callback(metrics.count_statement)
+    return conn
+
+def get_conn() -> sqlite3.Connection:
+    pool = getattr(_local, "pool", None)
+    if pool is None:
+        pool = _local.pool = {}
+    conn = pool.get(DB_PATH)
+    if conn is None:
+        conn = pool[DB_PATH] = _open(DB_PATH, getattr(_local, "read_only", False))
+    return conn
+
+def read_only_thread():
+    """Thread initializer: connections opened on this thread are read-only (async_db's reader)."""
+    _local.read_only = True
+
+def close_conn():
+    """Close this thread's pooled connections (e.g. before the thread exits)."""
+    for conn in getattr(_local, "pool", {}).values():
+        conn.close()
+    _local.pool = {}
 
 @contextmanager
 def conn_ctx():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA foreign_keys=ON;")
+    # Same contract as before: callers commit explicitly; anything left
+    # uncommitted (error or early return) is rolled back, not leaked.
+    conn = get_conn()
+    depth = getattr(_local, "depth", 0)
+    _local.depth = depth + 1
+    t0 = time.perf_counter()
     try:
         yield conn
     finally:
-        conn.close()
+        _local.depth = depth
+        if depth == 0:
+            if conn.in_transaction:
+                conn.rollback()
+            metrics.observe_db(time.perf_counter() - t0)
+
+# ---------- Read-through cache (kv_store + catalog) ----------
+CACHE_TTL_SEC = float(os.getenv("CACHE_TTL_SEC", "300"))  # 0 = keep until invalidated
+
+class _ReadCache:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = {}  # key -> (stored_at, value); key[0] is the namespace
+        self._lock = threading.Lock()
+
+    def get(self, key, count_miss: bool = True):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and (not self.ttl or time.monotonic() - item[0] < self.ttl):
+                self.hits += 1
+                return True, item[1]
+            if count_miss:
+                self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+
+    def invalidate(self, *namespaces):
+        with self._lock:
+            if not namespaces:
+                self._data.clear()
+            else:
+                for k in [k for k in self._data if k[0] in namespaces]:
+                    del self._data[k]
+
+    def invalidate_prefix(self, *prefix):
+        n = len(prefix)
+        with self._lock:
+            for k in [k for k in self._data if k[:n] == prefix]:
+                del self._data[k]
+
+_cache = _ReadCache(CACHE_TTL_SEC)
+
+def _read_through(ns: str):
+    """Cache a reader's result per (ns, name, *args). The wrapper gets .peek(*args) ->
+    (hit, value) so callers on other threads can skip the DB hop entirely."""
+    def deco(fn):
+        name = fn.__name__
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            if kwargs:
+                return fn(*args, **kwargs)
+            try:
+                hit, value = _cache.get((ns, name, *args))
+            except TypeError:  # unhashable argument: don't cache
+                return fn(*args)
+            if not hit:
+                value = fn(*args)
+                _cache.put((ns, name, *args), value)
+            return value
+        def peek(*args, **kwargs):
+            if kwargs:
+                return False, None
+            try:
+                return _cache.get((ns, name, *args), count_miss=False)  # inner() counts the miss
+            except TypeError:
+                return False, None
+        inner.peek = peek
+        return inner
+    return deco
+
+def invalidate_cache(*namespaces: str):
+    """Drop cached reads ("kv", "catalog", "paid", "days"); no arguments drops everything."""
+    _cache.invalidate(*namespaces)
+
+def cache_stats() -> dict:
+    return {"hits": _cache.hits, "misses": _cache.misses, "size": len(_cache._data)}
+
+metrics.gauge("booking_cache_requests_total", "Read-through cache lookups",
+              lambda: {("hit",): _cache.hits, ("miss",): _cache.misses}, ("result",), type="counter")
 
 def now_tz() -> datetime:
     return datetime.now(TZ)
 
+def to_epoch(iso: str) -> int:
+    """ISO8601 (offset-aware, or naive in TZ) -> unix seconds."""
+    dt = datetime.fromisoformat(iso)
+    if dt.tzinfo is None:
+        dt = TZ.localize(dt)
+    return int(dt.timestamp())
+
 # ---------- Schema & seed helpers ----------
 def init_db():
     with conn_ctx() as conn:
@@ -61,11 +201,14 @@ def init_db():
             status TEXT NOT NULL DEFAULT 'pending',
             token TEXT,
             expires_at TEXT,
-            created_at TEXT NOT NULL DEFAULT (datetime('now'))
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            starts_ts INTEGER,
+            ends_ts INTEGER,
+            expires_ts INTEGER
         );
-        CREATE INDEX IF NOT EXISTS idx_bookings_time ON bookings(resource_id, starts_at, ends_at);
         CREATE INDEX IF NOT EXISTS idx_bookings_status ON bookings(status);
         """)
+        _migrate_epoch_columns(conn)
         # Key/Value store for welcome, reply sessions, etc.
         c.execute("""CREATE TABLE IF NOT EXISTS kv_store(
             k TEXT PRIMARY KEY, v TEXT NOT NULL
@@ -76,9 +219,56 @@ def init_db():
             patterns_json TEXT NOT NULL, -- ["hi","hello"]
             answer TEXT NOT NULL
         );""")
+        # Bot state across restarts (persistence.py): one row per user / conversation
+        c.execute("""CREATE TABLE IF NOT EXISTS persist_user_data(
+            user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_ts INTEGER NOT NULL
+        );""")
+        # Flood bans (throttle.py); per-inquiry mutes are in memory (admin_session.py)
+        c.execute("""CREATE TABLE IF NOT EXISTS mutes(
+            tg_user_id INTEGER PRIMARY KEY, until TEXT NOT NULL
+        );""")
+        c.execute("""CREATE TABLE IF NOT EXISTS persist_conversations(
+            name TEXT NOT NULL, key TEXT NOT NULL, state TEXT NOT NULL, updated_ts INTEGER NOT NULL,
+            PRIMARY KEY(name, key)
+        );""")
         conn.commit()
+    load_availability()
+
+def _migrate_epoch_columns(conn):
+    """Add and backfill integer epoch columns on databases created before they existed."""
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(bookings)")}
+    for col in ("starts_ts", "ends_ts", "expires_ts"):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE bookings ADD COLUMN {col} INTEGER")
+    while True:
+        rows = conn.execute("""
+            SELECT id, starts_at, ends_at, expires_at FROM bookings
+            WHERE starts_ts IS NULL OR ends_ts IS NULL LIMIT 5000
+        """).fetchall()
+        if not rows:
+            break
+        conn.executemany("UPDATE bookings SET starts_ts=?, ends_ts=?, expires_ts=? WHERE id=?",
+                         [(to_epoch(st), to_epoch(en), to_epoch(ex) if ex else None, bid)
+                          for bid, st, en, ex in rows])
+    # Overlap queries all run on the epoch columns now; the old text-column
+    # indexes only cost a write on every booking insert/update.
+    conn.execute("DROP INDEX IF EXISTS idx_bookings_span")
+    conn.execute("DROP INDEX IF EXISTS idx_bookings_time")
+    # Covering partial index over live rows only: overlap checks never touch
+    # the table and never scan cancelled/expired history.
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_bookings_live
+                    ON bookings(resource_id, starts_ts, ends_ts, status, expires_ts)
+                    WHERE status IN ('paid','pending')""")
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_bookings_hold_expiry
+                    ON bookings(expires_ts) WHERE status='pending'""")
+    # Keyset pagination on (starts_ts, id); id is the rowid, so it rides along.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_recent ON bookings(starts_ts)")
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_bookings_paid_recent
+                    ON bookings(starts_ts) WHERE status='paid'""")
+    conn.commit()
 
 # ---------- KV helpers ----------
+@_read_through("kv")
 def get_kv(key: str, default=None):
     with conn_ctx() as conn:
         row = conn.execute("SELECT v FROM kv_store WHERE k=?", (key,)).fetchone()
@@ -89,6 +279,7 @@ def set_kv(key: str, value):
         conn.execute("INSERT INTO kv_store(k,v) VALUES(?,?) ON CONFLICT(k) DO UPDATE SET v=excluded.v",
                      (key, json.dumps(value)))
         conn.commit()
+    _cache.invalidate("kv")
 
 # ---------- Users ----------
 def upsert_user(tg_id: int, full_name: str, username: str|None):
@@ -100,15 +291,38 @@ def upsert_user(tg_id: int, full_name: str, username: str|None):
         """, (tg_id, full_name, username))
         conn.commit()
 
+# ---------- Mutes ----------
+def mute_user(tg_id: int, until: datetime):
+    with conn_ctx() as conn:
+        conn.execute("INSERT INTO mutes(tg_user_id, until) VALUES(?,?) "
+                     "ON CONFLICT(tg_user_id) DO UPDATE SET until=excluded.until",
+                     (tg_id, until.isoformat()))
+        conn.commit()
+
+def active_mutes():
+    """[(tg_user_id, until_ts)] still in force; lapsed rows are deleted."""
+    now_ts = now_tz().timestamp()
+    with conn_ctx() as conn:
+        rows = [(uid, datetime.fromisoformat(u).timestamp())
+                for uid, u in conn.execute("SELECT tg_user_id, until FROM mutes")]
+        lapsed = [(uid,) for uid, ts in rows if ts <= now_ts]
+        if lapsed:
+            conn.executemany("DELETE FROM mutes WHERE tg_user_id=?", lapsed)
+            conn.commit()
+    return [(uid, ts) for uid, ts in rows if ts > now_ts]
+
 # ---------- Catalog ----------
+@_read_through("catalog")
 def list_services():
     with conn_ctx() as conn:
         return conn.execute("SELECT id,name,default_duration_min,price,step_min FROM services WHERE active=1 ORDER BY id").fetchall()
 
+@_read_through("catalog")
 def get_service(svc_id: int):
     with conn_ctx() as conn:
         return conn.execute("SELECT id,name,default_duration_min,price,step_min FROM services WHERE id=?", (svc_id,)).fetchone()
 
+@_read_through("catalog")
 def list_resources(svc_id: int):
     with conn_ctx() as conn:
         return conn.execute("""
@@ -117,65 +331,524 @@ def list_resources(svc_id: int):
             ORDER BY id
         """,(svc_id,)).fetchall()
 
+@_read_through("catalog")
 def get_resource(res_id: int):
     with conn_ctx() as conn:
         return conn.execute("""
             SELECT id,service_id,name,capacity,open_time,close_time FROM resources WHERE id=?
         """,(res_id,)).fetchone()
 
+def upsert_service(name: str, duration_min: int, price: int, step_min: int) -> int:
+    with conn_ctx() as conn:
+        conn.execute("""
+            INSERT OR IGNORE INTO services(name, default_duration_min, price, step_min, active)
+            VALUES(?,?,?,?,1)
+        """, (name, duration_min, price, step_min))
+        sid = conn.execute("SELECT id FROM services WHERE name=?", (name,)).fetchone()[0]
+        conn.commit()
+    _cache.invalidate("catalog")
+    return int(sid)
+
+def upsert_resource(service_id: int, name: str, capacity: int, open_time: str, close_time: str) -> int:
+    with conn_ctx() as conn:
+        conn.execute("""
+            INSERT OR IGNORE INTO resources(service_id, name, capacity, open_time, close_time, active)
+            VALUES(?,?,?,?,?,1)
+        """, (service_id, name, capacity, open_time, close_time))
+        rid = conn.execute("SELECT id FROM resources WHERE service_id=? AND name=?",
+                           (service_id, name)).fetchone()[0]
+        conn.commit()
+    _cache.invalidate("catalog")
+    return int(rid)
+
 # ---------- Availability & Booking ----------
+# Slots always fit inside one open/close window, so no booking is longer than
+# a day. That gives overlap queries a lower bound on starts_ts and turns them
+# into a bounded index range scan.
+MAX_BOOKING_SEC = 86400
+
+# paid or pending (unexpired) consume capacity
+# params: (res_id, end_ts, start_ts - MAX_BOOKING_SEC, start_ts, now_ts)
+_LIVE_OVERLAP = """
+    resource_id=? AND status IN ('paid','pending')
+    AND starts_ts < ? AND starts_ts > ? AND ends_ts > ?
+    AND (status='paid' OR (status='pending' AND (expires_ts IS NULL OR expires_ts > ?)))
+"""
+
+def _overlap_args(res_id: int, start_ts: int, end_ts: int):
+    return (res_id, end_ts, start_ts - MAX_BOOKING_SEC, start_ts, int(now_tz().timestamp()))
+
+def _count_overlapping(conn, res_id: int, start_ts: int, end_ts: int) -> int:
+    return conn.execute(f"SELECT COUNT(*) FROM bookings WHERE {_LIVE_OVERLAP}",
+                        _overlap_args(res_id, start_ts, end_ts)).fetchone()[0]
+
+# ---------- In-memory availability index (see availability.py) ----------
+# Loaded by init_db(); every status change below updates it after COMMIT.
+# Capacity checks inside create_pending_booking stay in SQL: that one must
+# hold under the write lock even if another process touched the table.
+_avail = AvailabilityIndex()
+
+def _live_rows_sql(conn, horizon: int, now_ts: int):
+    return conn.execute("""
+        SELECT id, resource_id, starts_ts, ends_ts, CASE WHEN status='pending' THEN expires_ts END
+        FROM bookings INDEXED BY idx_bookings_live
+        WHERE status IN ('paid','pending') AND ends_ts > ?
+          AND (status='paid' OR expires_ts IS NULL OR expires_ts > ?)
+    """, (horizon, now_ts)).fetchall()
+
+def load_availability():
+    """(Re)build the index from SQLite: live bookings that can still overlap a slot from yesterday on."""
+    if not AVAILABILITY_INDEX:
+        return
+    now_ts = int(now_tz().timestamp())
+    horizon = now_ts - MAX_BOOKING_SEC
+    with conn_ctx() as conn:
+        _avail.load(_live_rows_sql(conn, horizon, now_ts), horizon)
+
+def check_availability(repair: bool = True) -> int:
+    """Compare the index with SQLite; returns the number of differing bookings.
+
+    Also drops bookings that ended over a day ago. With repair, any drift
+    (e.g. rows edited outside this process) triggers a full reload.
+    """
+    if not AVAILABILITY_INDEX or _avail.horizon is None:
+        return 0
+    now_ts = int(now_tz().timestamp())
+    _avail.prune(now_ts - MAX_BOOKING_SEC)
+    with conn_ctx() as conn:
+        # the same now_ts on both sides: a hold lapsing between the reads is not drift
+        want = {(r[0], r[1], r[2], r[3]) for r in _live_rows_sql(conn, _avail.horizon, now_ts)}
+    diff = len(want ^ _avail.snapshot(now_ts))
+    if diff:
+        AVAIL_DRIFT.inc(n=diff)
+    if diff and repair:
+        load_availability()
+        _cache.invalidate("days")
+    return diff
+
+metrics.gauge("booking_availability_index_size", "Live bookings held by the availability index", _avail.size)
+AVAIL_DRIFT = metrics.Counter("booking_availability_drift_total", "Bookings found out of step by check_availability")
+
+def _overlapping_from_index(res_id: int, start_iso: str, end_iso: str):
+    s_ts, e_ts = to_epoch(start_iso), to_epoch(end_iso)
+    if not AVAILABILITY_INDEX or not _avail.covers(s_ts):
+        return None
+    return _avail.count_overlapping(res_id, s_ts, e_ts, int(now_tz().timestamp()))
+
+def _slots_from_index(res_id: int, day_start: datetime, day_end: datetime,
+                      duration_min: int, step_min: int, capacity: int):
+    first = int(day_start.timestamp())
+    if not AVAILABILITY_INDEX or not _avail.covers(first):
+        return None
+    duration = duration_min * 60
+    free = _avail.free_starts(res_id, first, int(day_end.timestamp()) - duration, duration,
+                              step_min * 60, capacity, int(now_tz().timestamp()))
+    out, dur = [], timedelta(seconds=duration)
+    for s in free:
+        st = day_start + timedelta(seconds=s - first)
+        out.append((st, st + dur))
+    return out
+
+def _index_peek(from_index):
+    # same (hit, value) contract as _read_through's .peek: async_db answers on the loop
+    def peek(*args, **kwargs):
+        value = from_index(*args, **kwargs)
+        return (value is not None), value
+    return peek
+
 def count_overlapping(res_id: int, start_iso: str, end_iso: str) -> int:
+    n = _overlapping_from_index(res_id, start_iso, end_iso)
+    if n is not None:
+        return n
     with conn_ctx() as conn:
-        # paid or pending (unexpired) consume capacity
-        return conn.execute("""
-            SELECT COUNT(*) FROM bookings
-            WHERE resource_id=? AND status IN ('paid','pending')
-              AND starts_at < ? AND ends_at > ?
-              AND (status='paid' OR (status='pending' AND (expires_at IS NULL OR expires_at > datetime('now'))))
-        """,(res_id, end_iso, start_iso)).fetchone()[0]
+        return _count_overlapping(conn, res_id, to_epoch(start_iso), to_epoch(end_iso))
+count_overlapping.peek = _index_peek(_overlapping_from_index)
 
-def create_pending_booking(tg_user_id: int, user_full_name: str,
-                           service_id: int, resource_id: int,
-                           starts_at_iso: str, ends_at_iso: str,
-                           amount: int, payment_method: str, payment_ref: str|None):
+def day_bookings(res_id: int, day_start: datetime, day_end: datetime):
+    """Sorted (starts, ends) of the live bookings that can overlap the window:
+    the only blocking part of available_slots (async_db runs just this on the DB thread)."""
+    with conn_ctx() as conn:
+        rows = conn.execute(f"SELECT starts_ts, ends_ts FROM bookings WHERE {_LIVE_OVERLAP}",
+                            _overlap_args(res_id, int(day_start.timestamp()), int(day_end.timestamp()))).fetchall()
+    return sorted(r[0] for r in rows), sorted(r[1] for r in rows)
+
+def slots_from_bookings(starts: list, ends: list, day_start: datetime, day_end: datetime,
+                        duration_min: int, step_min: int, capacity: int):
+    """Free slots from day_bookings() with two sorted arrays:
+    overlapping = #(starts < slot_end) - #(ends <= slot_start). Pure CPU."""
+    out = []
+    duration = timedelta(minutes=duration_min)
+    step = timedelta(minutes=step_min)
+    cur = day_start
+    while cur + duration <= day_end:
+        s_ts = int(cur.timestamp()); e_ts = s_ts + duration_min * 60
+        if bisect_left(starts, e_ts) - bisect_right(ends, s_ts) < capacity:
+            out.append((cur, cur + duration))
+        cur += step
+    return out
+
+def available_slots(res_id: int, day_start: datetime, day_end: datetime,
+                    duration_min: int, step_min: int, capacity: int):
+    """Free (start, end) slots of a resource between day_start and day_end.
+
+    Served from the in-memory index when it covers the day. Otherwise loads the
+    day's live bookings in one query (day_bookings) and scans them in memory
+    (slots_from_bookings).
+    """
+    out = _slots_from_index(res_id, day_start, day_end, duration_min, step_min, capacity)
+    if out is not None:
+        return out
+    starts, ends = day_bookings(res_id, day_start, day_end)
+    return slots_from_bookings(starts, ends, day_start, day_end, duration_min, step_min, capacity)
+available_slots.peek = _index_peek(_slots_from_index)
+
+@_read_through("days")
+def month_full_days(res_id: int, year: int, month: int, open_time: str, close_time: str,
+                    duration_min: int, step_min: int, capacity: int) -> frozenset:
+    """Dates of the month with no free slot (fully booked, or too short to fit one).
+
+    One query for the whole month's live bookings, then the same two-array
+    overlap count as available_slots, stopping at a day's first free slot.
+    Cached per (resource, month) until a booking on that resource changes.
+    """
+    open_t, close_t = parse_hhmm(open_time), parse_hhmm(close_time)
+    days = [date(year, month, d) for d in range(1, calendar.monthrange(year, month)[1] + 1)]
+    windows = [(int(TZ.localize(datetime.combine(d, open_t)).timestamp()),
+                int(TZ.localize(datetime.combine(d, close_t)).timestamp())) for d in days]
+    with conn_ctx() as conn:
+        rows = conn.execute(f"SELECT starts_ts, ends_ts FROM bookings WHERE {_LIVE_OVERLAP}",
+                            _overlap_args(res_id, windows[0][0], windows[-1][1])).fetchall()
+    starts = sorted(r[0] for r in rows)
+    ends = sorted(r[1] for r in rows)
+
+    duration, step = duration_min * 60, step_min * 60
+    full = set()
+    for d, (t, close_ts) in zip(days, windows):
+        while t + duration <= close_ts:
+            if bisect_left(starts, t + duration) - bisect_right(ends, t) < capacity:
+                break
+            t += step
+        else:
+            full.add(d)
+    return frozenset(full)
+
+def month_full_days_any(service_id: int, year: int, month: int, duration_min: int, step_min: int) -> frozenset:
+    """Days full on every active resource of the service (the "any available" calendar)."""
+    full = None
+    for r in list_resources(service_id):  # id, name, capacity, open_time, close_time
+        f = month_full_days(r[0], year, month, r[3], r[4], duration_min, step_min, int(r[2]))
+        full = f if full is None else full & f
+    return full or frozenset()
+
+def _month_full_any_peek(service_id, year, month, duration_min, step_min):
+    hit, resources = list_resources.peek(service_id)
+    if not hit:
+        return False, None
+    full = None
+    for r in resources:
+        hit, f = month_full_days.peek(r[0], year, month, r[3], r[4], duration_min, step_min, int(r[2]))
+        if not hit:
+            return False, None
+        full = f if full is None else full & f
+    return True, full or frozenset()
+month_full_days_any.peek = _month_full_any_peek
+
+def _tag(slots, res):
+    for t in slots:
+        yield t, res[0], res[1]
+
+def earliest_slots(service_id: int, n: int, days_ahead: int):
+    """The n earliest free slots of a service across all its active resources,
+    from now to days_ahead out, as (res_id, res_name, start, end).
+
+    Each resource gets a lazy free_slots() scan over its day windows; a heap
+    merge pulls from whichever is earliest, so the search stops after about n
+    slots however far out they are.
+    """
+    svc = get_service(service_id)
+    resources = list_resources(service_id)
+    if not svc or not resources or n <= 0:
+        return []
+    duration, step = int(svc[2]) * 60, int(svc[4]) * 60
+    now_ts = int(now_tz().timestamp())
+    today = now_tz().date()
+    days = [today + timedelta(days=i) for i in range(days_ahead + 1)]
+
+    epoch = {}  # (day, "HH:MM") -> ts; resources mostly share hours, and localize() is the slow part
+    def at(d, hhmm):
+        ts = epoch.get((d, hhmm))
+        if ts is None:
+            ts = epoch[d, hhmm] = int(TZ.localize(datetime.combine(d, parse_hhmm(hhmm))).timestamp())
+        return ts
+
+    scans = []
+    with conn_ctx() as conn:
+        for res in resources:  # id, name, capacity, open_time, close_time
+            first, last = at(days[0], res[3]), at(days[-1], res[4])
+            if AVAILABILITY_INDEX and _avail.covers(first):
+                starts, ends = _avail.timeline(res[0], now_ts)
+            else:
+                rows = conn.execute(f"SELECT starts_ts, ends_ts FROM bookings WHERE {_LIVE_OVERLAP}",
+                                    _overlap_args(res[0], first, last)).fetchall()
+                starts, ends = sorted(r[0] for r in rows), sorted(r[1] for r in rows)
+            windows = ((at(d, res[3]), at(d, res[4])) for d in days)  # lazy: the scan may stop on day one
+            scans.append(_tag(free_slots(starts, ends, windows, duration, step, int(res[2]), now_ts), res))
+
+    out = []
+    for t, res_id, name in islice(heapq.merge(*scans), n):
+        st = datetime.fromtimestamp(t, TZ)
+        out.append((res_id, name, st, st + timedelta(seconds=duration)))
+    return out
+
+def _any_windows(resources, day: date):
+    return {r[0]: (int(TZ.localize(datetime.combine(day, parse_hhmm(r[3]))).timestamp()),
+                   int(TZ.localize(datetime.combine(day, parse_hhmm(r[4]))).timestamp())) for r in resources}
+
+def _merge_free(scans, duration: int):
+    out, last, dur = [], None, timedelta(seconds=duration)
+    for t in heapq.merge(*scans):
+        if t != last:
+            st = datetime.fromtimestamp(t, TZ)
+            out.append((st, st + dur))
+            last = t
+    return out
+
+def _slots_any_from_index(service_id: int, day: date, duration_min: int, step_min: int):
+    hit, resources = list_resources.peek(service_id)
+    if not AVAILABILITY_INDEX or not hit or not resources:
+        return None
+    windows = _any_windows(resources, day)
+    if not _avail.covers(min(w[0] for w in windows.values())):
+        return None
+    now_ts = int(now_tz().timestamp())
+    duration, step = duration_min * 60, step_min * 60
+    scans = [_avail.free_starts(r[0], windows[r[0]][0], windows[r[0]][1] - duration, duration, step, int(r[2]), now_ts)
+             for r in resources]
+    return _merge_free(scans, duration)
+
+def available_slots_any(service_id: int, day: date, duration_min: int, step_min: int):
+    """Union of free (start, end) slots on day across the service's active resources.
+
+    Bookings for every resource come from the index, or from one query, and
+    the per-resource scans are merged in a single ascending pass.
+    """
+    out = _slots_any_from_index(service_id, day, duration_min, step_min)
+    if out is not None:
+        return out
+    resources = list_resources(service_id)  # id, name, capacity, open_time, close_time
+    if not resources:
+        return []
+    windows = _any_windows(resources, day)
+    lo = min(w[0] for w in windows.values()); hi = max(w[1] for w in windows.values())
+    with conn_ctx() as conn:
+        rows = conn.execute(f"""
+            SELECT resource_id, starts_ts, ends_ts FROM bookings
+            WHERE resource_id IN ({",".join("?" * len(resources))}) AND status IN ('paid','pending')
+              AND starts_ts < ? AND starts_ts > ? AND ends_ts > ?
+              AND (status='paid' OR expires_ts IS NULL OR expires_ts > ?)
+        """, (*windows, hi, lo - MAX_BOOKING_SEC, lo, int(now_tz().timestamp()))).fetchall()
+    by_res = {rid: ([], []) for rid in windows}
+    for rid, st, en in rows:
+        by_res[rid][0].append(st); by_res[rid][1].append(en)
+    duration, step = duration_min * 60, step_min * 60
+    scans = [free_slots(sorted(by_res[r[0]][0]), sorted(by_res[r[0]][1]), [windows[r[0]]], duration, step, int(r[2]))
+             for r in resources]
+    return _merge_free(scans, duration)
+available_slots_any.peek = _index_peek(_slots_any_from_index)
+
+def _bookings_changed(*res_ids):
+    for rid in set(res_ids):
+        _cache.invalidate_prefix("days", "month_full_days", rid)
+
+def _within_hours(starts_ts: int, ends_ts: int, open_time: str, close_time: str) -> bool:
+    day = datetime.fromtimestamp(starts_ts, TZ).date()
+    opens = int(TZ.localize(datetime.combine(day, parse_hhmm(open_time))).timestamp())
+    closes = int(TZ.localize(datetime.combine(day, parse_hhmm(close_time))).timestamp())
+    return opens <= starts_ts and ends_ts <= closes
+
+def _create_hold(pick, tg_user_id: int, user_full_name: str, service_id: int,
+                 starts_at_iso: str, ends_at_iso: str,
+                 amount: int, payment_method: str, payment_ref: str|None):
+    """pick(conn, starts_ts, ends_ts) -> resource_id with a free seat inside its
+    working hours, or None. It runs inside the write transaction, so its answer
+    cannot go stale. Slots that already started are refused before pick runs."""
     hold_minutes = int(os.getenv("HOLD_MINUTES", "10"))
-    expires_at = now_tz() + timedelta(minutes=hold_minutes)
+    now = now_tz()
+    expires_at = now + timedelta(minutes=hold_minutes)
     expires_at_iso = expires_at.isoformat()
 
     with conn_ctx() as conn:
         try:
+            conn.execute("BEGIN IMMEDIATE")
+            starts_ts, ends_ts = to_epoch(starts_at_iso), to_epoch(ends_at_iso)
+            # stale buttons (an old /next list, a restored conversation) can name a past slot
+            resource_id = pick(conn, starts_ts, ends_ts) if starts_ts > int(now.timestamp()) else None
+            if resource_id is None:
+                conn.rollback()
+                return None
             conn.execute("""
                 INSERT INTO bookings(service_id,resource_id,tg_user_id,user_full_name,
-                 starts_at,ends_at,amount,payment_method,payment_ref,status,expires_at)
-                VALUES(?,?,?,?,?,?,?,?,?,'pending',?)
+                 starts_at,ends_at,amount,payment_method,payment_ref,status,expires_at,
+                 starts_ts,ends_ts,expires_ts)
+                VALUES(?,?,?,?,?,?,?,?,?,'pending',?,?,?,?)
             """, (service_id, resource_id, tg_user_id, user_full_name,
-                  starts_at_iso, ends_at_iso, amount, payment_method, payment_ref, expires_at_iso))
+                  starts_at_iso, ends_at_iso, amount, payment_method, payment_ref, expires_at_iso,
+                  starts_ts, ends_ts, int(expires_at.timestamp())))
             bid = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
             conn.commit()
-            return int(bid)
         except sqlite3.IntegrityError:
             conn.rollback()
             return None
+    _avail.add(int(bid), resource_id, starts_ts, ends_ts, int(expires_at.timestamp()))
+    _bookings_changed(resource_id)
+    return int(bid), resource_id
+
+def create_pending_booking(tg_user_id: int, user_full_name: str,
+                           service_id: int, resource_id: int,
+                           starts_at_iso: str, ends_at_iso: str,
+                           amount: int, payment_method: str, payment_ref: str|None):
+    """Insert a pending hold, or return None if the slot is already at capacity,
+    has started, or is outside the resource's hours.
+
+    The capacity check and the INSERT share one BEGIN IMMEDIATE transaction,
+    so concurrent writers queue on the write lock instead of both seeing
+    the last free seat.
+    """
+    def pick(conn, starts_ts, ends_ts):
+        row = conn.execute("SELECT capacity, open_time, close_time FROM resources WHERE id=? AND active=1",
+                           (resource_id,)).fetchone()
+        if not row or not _within_hours(starts_ts, ends_ts, row[1], row[2]):
+            return None
+        if _count_overlapping(conn, resource_id, starts_ts, ends_ts) >= int(row[0]):
+            return None
+        return resource_id
+    made = _create_hold(pick, tg_user_id, user_full_name, service_id, starts_at_iso, ends_at_iso,
+                        amount, payment_method, payment_ref)
+    return made[0] if made else None
+
+# ---------- "Any available" resource assignment ----------
+# A policy gets the resources with a free seat for the slot as
+# (resource_id, capacity, overlapping) rows, ordered by id, and returns one.
+ANY_RESOURCE_POLICY = os.getenv("ANY_RESOURCE_POLICY", "least_loaded")
+
+def _least_loaded(conn, service_id, cands, starts_ts, ends_ts):
+    # fewest live bookings that local day, relative to capacity
+    day = datetime.fromtimestamp(starts_ts, TZ).date()
+    day_start = int(TZ.localize(datetime.combine(day, datetime.min.time())).timestamp())
+    return min(cands, key=lambda c: (_count_overlapping(conn, c[0], day_start, day_start + 86400) / c[1], c[0]))
+
+_rr_last = {}  # service_id -> last assigned resource_id (updated under the write lock)
+
+def _round_robin(conn, service_id, cands, starts_ts, ends_ts):
+    last = _rr_last.get(service_id, 0)
+    c = next((c for c in cands if c[0] > last), cands[0])
+    _rr_last[service_id] = c[0]
+    return c
+
+def _packing(conn, service_id, cands, starts_ts, ends_ts):
+    # fill the resource already closest to full, keeping others whole for later
+    return min(cands, key=lambda c: (c[1] - c[2], c[0]))
+
+ASSIGN_POLICIES = {"least_loaded": _least_loaded, "round_robin": _round_robin, "packing": _packing}
+if ANY_RESOURCE_POLICY not in ASSIGN_POLICIES:
+    raise ValueError(f"ANY_RESOURCE_POLICY must be one of {', '.join(ASSIGN_POLICIES)}")
+
+def create_pending_booking_any(tg_user_id: int, user_full_name: str, service_id: int,
+                               starts_at_iso: str, ends_at_iso: str,
+                               amount: int, payment_method: str, payment_ref: str|None,
+                               policy: str|None = None):
+    """Hold the slot on whichever of the service's resources the policy picks.
+    Returns (booking_id, resource_id), or None if every resource is full."""
+    choose = ASSIGN_POLICIES[policy or ANY_RESOURCE_POLICY]
+    def pick(conn, starts_ts, ends_ts):
+        cands = []
+        for rid, cap, open_t, close_t in conn.execute("""
+                SELECT id, capacity, open_time, close_time FROM resources
+                WHERE service_id=? AND active=1 ORDER BY id""", (service_id,)):
+            if not _within_hours(starts_ts, ends_ts, open_t, close_t):
+                continue
+            used = _count_overlapping(conn, rid, starts_ts, ends_ts)
+            if used < cap:
+                cands.append((rid, int(cap), used))
+        return choose(conn, service_id, cands, starts_ts, ends_ts)[0] if cands else None
+    return _create_hold(pick, tg_user_id, user_full_name, service_id, starts_at_iso, ends_at_iso,
+                        amount, payment_method, payment_ref)
 
 def mark_paid(booking_id: int, token: str) -> bool:
+    """Pay a pending or expired hold and give it token. True only if this call
+    paid it: an already paid booking keeps its token, a cancelled one stays put.
+
+    One conditional UPDATE. A lapsed hold (swept to 'expired' or not) no
+    longer reserves its seat, so it is only paid if the slot still has one
+    free under resources.capacity; otherwise it is left as it was.
+    """
+    now_ts = int(now_tz().timestamp())
     with conn_ctx() as conn:
-        row = conn.execute("SELECT status FROM bookings WHERE id=?", (booking_id,)).fetchone()
-        if not row: return False
-        if row[0] == 'paid': return True
-        if row[0] in ('cancelled','expired'): return False
-        conn.execute("UPDATE bookings SET status='paid', token=?, expires_at=NULL WHERE id=?",
-                     (token, booking_id))
+        row = conn.execute("""
+            UPDATE bookings SET status='paid', token=:token, expires_at=NULL, expires_ts=NULL
+            WHERE id=:id AND status IN ('pending','expired') AND token IS NULL
+              AND (expires_ts IS NULL OR expires_ts > :now
+                   OR (SELECT COUNT(*) FROM bookings o
+                       WHERE o.resource_id=bookings.resource_id AND o.status IN ('paid','pending')
+                         AND o.starts_ts < bookings.ends_ts AND o.starts_ts > bookings.starts_ts - :max_sec
+                         AND o.ends_ts > bookings.starts_ts
+                         AND (o.status='paid' OR o.expires_ts IS NULL OR o.expires_ts > :now))
+                      < (SELECT capacity FROM resources WHERE id=bookings.resource_id))
+            RETURNING resource_id, starts_ts, ends_ts""",
+            {"token": token, "id": booking_id, "now": now_ts, "max_sec": MAX_BOOKING_SEC}).fetchone()
         conn.commit()
-        return True
+    if not row: return False
+    _avail.mark_paid(booking_id, *row)
+    _bookings_changed(row[0])  # a lapsed, not yet swept hold takes its seat back
+    _cache.invalidate("paid")
+    return True
 
 def cancel_booking(booking_id: int) -> bool:
+    """Cancel a booking. True only if this call cancelled it (not when it was
+    missing or already cancelled)."""
+    with conn_ctx() as conn:
+        row = conn.execute("""
+            UPDATE bookings SET status='cancelled'
+            WHERE id=? AND status<>'cancelled'
+            RETURNING resource_id""", (booking_id,)).fetchone()
+        conn.commit()
+    if not row: return False
+    _avail.remove(booking_id)
+    _bookings_changed(row[0])
+    _cache.invalidate("paid")  # cheaper than asking whether it was paid
+    return True
+
+def expire_holds(batch_size: int = 200):
+    """Flip up to batch_size lapsed pending holds to 'expired'.
+
+    Returns the expired rows as (id, tg_user_id, user_full_name, starts_at, ends_at).
+    """
+    now_ts = int(now_tz().timestamp())
     with conn_ctx() as conn:
-        row = conn.execute("SELECT status FROM bookings WHERE id=?", (booking_id,)).fetchone()
-        if not row: return False
-        if row[0] == 'cancelled': return True
-        conn.execute("UPDATE bookings SET status='cancelled' WHERE id=?", (booking_id,))
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute("""
+            SELECT id, tg_user_id, user_full_name, starts_at, ends_at, resource_id
+            FROM bookings INDEXED BY idx_bookings_hold_expiry
+            WHERE status='pending' AND expires_ts <= ?
+            ORDER BY expires_ts
+            LIMIT ?
+        """, (now_ts, batch_size)).fetchall()
+        if rows:
+            conn.executemany("UPDATE bookings SET status='expired' WHERE id=? AND status='pending'",
+                             [(r[0],) for r in rows])
         conn.commit()
-        return True
+    for r in rows:
+        _avail.remove(r[0])
+    _bookings_changed(*(r[5] for r in rows))
+    return [r[:5] for r in rows]
+
+def count_live_holds() -> int:
+    """Pending holds that still reserve capacity (not yet lapsed)."""
+    with conn_ctx() as conn:
+        return conn.execute("""
+            SELECT COUNT(*) FROM bookings INDEXED BY idx_bookings_hold_expiry
+            WHERE status='pending' AND expires_ts > ?
+        """, (int(now_tz().timestamp()),)).fetchone()[0]
 
 def get_booking(booking_id: int):
     with conn_ctx() as conn:
@@ -188,16 +861,51 @@ def get_booking(booking_id: int):
         WHERE b.id=?
         """,(booking_id,)).fetchone()
 
-def list_bookings(offset=0, limit=15):
+def keyset(cursor, direction: str = "next"):
+    """WHERE / ORDER BY fragments and params for newest-first pages keyed on
+    (b.starts_ts, b.id). cursor is a (starts_ts, id) pair or None for page one;
+    direction "next" = strictly older, "prev" = strictly newer (rows come back
+    ascending, reverse them), "at" = the cursor row and older (re-render)."""
+    if cursor is None:
+        return "1", "b.starts_ts DESC, b.id DESC", ()
+    if direction == "prev":
+        return "(b.starts_ts, b.id) > (?, ?)", "b.starts_ts ASC, b.id ASC", tuple(cursor)
+    op = "<=" if direction == "at" else "<"
+    return f"(b.starts_ts, b.id) {op} (?, ?)", "b.starts_ts DESC, b.id DESC", tuple(cursor)
+
+def list_bookings(cursor=None, direction="next", limit=15):
+    """One keyset page of all bookings, newest first; each row ends with starts_ts
+    for building the next cursor. Cost is independent of page depth."""
+    where, order, params = keyset(cursor, direction)
+    with conn_ctx() as conn:
+        rows = conn.execute(f"""
+        SELECT b.id, s.name, r.name, b.starts_at, b.ends_at, b.status, COALESCE(b.token,'-'), b.amount, b.starts_ts
+        FROM bookings b INDEXED BY idx_bookings_recent
+        JOIN services s ON s.id=b.service_id
+        JOIN resources r ON r.id=b.resource_id
+        WHERE {where}
+        ORDER BY {order}
+        LIMIT ?
+        """,(*params, limit)).fetchall()
+    return rows[::-1] if direction == "prev" and cursor is not None else rows
+
+@_read_through("paid")
+def count_paid() -> int:
+    with conn_ctx() as conn:
+        return int(conn.execute("SELECT COUNT(*) FROM bookings WHERE status='paid'").fetchone()[0])
+
+def upcoming_paid(after_ts: int):
+    """(id, tg_user_id, starts_ts, service, resource, token) of paid bookings
+    starting after after_ts, soonest first (reminders.py loads these once)."""
     with conn_ctx() as conn:
         return conn.execute("""
-        SELECT b.id, s.name, r.name, b.starts_at, b.ends_at, b.status, COALESCE(b.token,'-'), b.amount
-        FROM bookings b
+        SELECT b.id, b.tg_user_id, b.starts_ts, s.name, r.name, b.token
+        FROM bookings b INDEXED BY idx_bookings_paid_recent
         JOIN services s ON s.id=b.service_id
         JOIN resources r ON r.id=b.resource_id
-        ORDER BY b.starts_at DESC
-        LIMIT ? OFFSET ?
-        """,(limit, offset)).fetchall()
+        WHERE b.status='paid' AND b.starts_ts > ?
+        ORDER BY b.starts_ts
+        """, (after_ts,)).fetchall()
 
 def user_bookings(tg_user_id: int, limit=10):
     with conn_ctx() as conn:
@@ -211,13 +919,52 @@ def user_bookings(tg_user_id: int, limit=10):
         LIMIT ?
         """,(tg_user_id, limit)).fetchall()
 
+# ---------- Bot persistence (persistence.py) ----------
+def load_user_data(user_id: int):
+    with conn_ctx() as conn:
+        row = conn.execute("SELECT data FROM persist_user_data WHERE user_id=?", (user_id,)).fetchone()
+    return row[0] if row else None
+
+def load_conversations(name: str, since_ts: int):
+    with conn_ctx() as conn:
+        return conn.execute("SELECT key, state FROM persist_conversations WHERE name=? AND updated_ts > ?",
+                            (name, since_ts)).fetchall()
+
+def save_persistence(users, dropped_users, conversations, ended_conversations, before_ts: int = 0):
+    """Write one flush of bot state in a single transaction.
+
+    users: [(user_id, data_json)], dropped_users: [user_id],
+    conversations: [(name, key_json, state_json)], ended_conversations: [(name, key_json)].
+    Conversation rows last touched before before_ts are dropped too.
+    """
+    now_ts = int(time.time())
+    with conn_ctx() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("""INSERT INTO persist_user_data(user_id, data, updated_ts) VALUES(?,?,?)
+                            ON CONFLICT(user_id) DO UPDATE SET data=excluded.data, updated_ts=excluded.updated_ts""",
+                         [(uid, data, now_ts) for uid, data in users])
+        conn.executemany("DELETE FROM persist_user_data WHERE user_id=?", [(uid,) for uid in dropped_users])
+        conn.executemany("""INSERT INTO persist_conversations(name, key, state, updated_ts) VALUES(?,?,?,?)
+                            ON CONFLICT(name, key) DO UPDATE SET state=excluded.state, updated_ts=excluded.updated_ts""",
+                         [(n, k, st, now_ts) for n, k, st in conversations])
+        conn.executemany("DELETE FROM persist_conversations WHERE name=? AND key=?", ended_conversations)
+        if before_ts:
+            conn.execute("DELETE FROM persist_conversations WHERE updated_ts <= ?", (before_ts,))
+        conn.commit()
+
 # ---------- Auto Q/A ----------
+# Phrase index over normalized tokens: (longest phrase, {token tuple: (entry order, answer)}).
+# Built lazily from auto_qa and dropped whenever the table changes.
+_qa_index = None
+
 def add_autoqa(patterns: list[str], answer: str):
+    global _qa_index
     patterns = [p.strip().lower() for p in patterns if p.strip()]
     with conn_ctx() as conn:
         conn.execute("INSERT INTO auto_qa(patterns_json,answer) VALUES(?,?)",
                      (json.dumps(patterns), answer.strip()))
         conn.commit()
+    _qa_index = None
 
 def all_autoqa():
     with conn_ctx() as conn:
@@ -232,6 +979,34 @@ def all_autoqa():
         return out
 
 def clear_autoqa():  # not exposed as command, but handy to keep
+    global _qa_index
     with conn_ctx() as conn:
         conn.execute("DELETE FROM auto_qa")
         conn.commit()
+    _qa_index = None
+
+def _build_qa_index():
+    phrases, longest = {}, 0
+    for order, (_, patterns, answer) in enumerate(all_autoqa()):
+        for p in patterns:
+            toks = tuple(normalize_text(p).split())
+            if toks and toks not in phrases:  # earlier entries win, as in the old linear scan
+                phrases[toks] = (order, answer)
+                longest = max(longest, len(toks))
+    return longest, phrases
+
+def match_autoqa(norm_text: str):
+    """Answer of the first auto_qa entry with a pattern occurring as a whole-word
+    phrase in norm_text, or None. Cost depends on the message, not the Q/A bank."""
+    global _qa_index
+    if _qa_index is None:
+        _qa_index = _build_qa_index()
+    longest, phrases = _qa_index
+    toks = norm_text.split()
+    best = None
+    for i in range(len(toks)):
+        for n in range(1, min(longest, len(toks) - i) + 1):
+            hit = phrases.get(tuple(toks[i:i + n]))
+            if hit and (best is None or hit[0] < best[0]):
+                best = hit
+    return best[1] if best else None
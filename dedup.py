@@ -0,0 +1,79 @@
+# dedup.py
+# Repeated button taps. Double taps arrive as separate callback queries with
+# the same data on the same message; only the first one runs the handler, the
+# rest are just answered (so the client spinner stops) and dropped.
+#
+# single_flight() collapses concurrent work on one key (a booking id and an
+# action), so two admins tapping Mark Paid on the same booking run it once.
+import os, time, asyncio, functools
+from collections import OrderedDict
+
+CALLBACK_DEDUP_SEC = float(os.getenv("CALLBACK_DEDUP_SEC", "15"))
+CALLBACK_DEDUP_SIZE = int(os.getenv("CALLBACK_DEDUP_SIZE", "10000"))
+
+
+class TTLSet:
+    """Keys seen in the last ttl seconds, oldest evicted beyond maxsize."""
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._seen = OrderedDict()  # key -> expiry, in insertion (= expiry) order
+
+    def add(self, key) -> bool:
+        """Record key; False if it was already there and not expired."""
+        now = time.monotonic()
+        seen = self._seen
+        while seen:
+            k, exp = next(iter(seen.items()))
+            if exp > now and len(seen) < self.maxsize:
+                break
+            seen.popitem(last=False)
+        if key in seen:
+            return False
+        seen[key] = now + self.ttl
+        return True
+
+    def __contains__(self, key) -> bool:
+        exp = self._seen.get(key)
+        return exp is not None and exp > time.monotonic()
+
+_taps = TTLSet(CALLBACK_DEDUP_SEC, CALLBACK_DEDUP_SIZE)
+_inflight = {}  # key -> asyncio.Future
+
+
+def first_tap(q) -> bool:
+    # the admin keyboard's opaque nonce is part of q.data, so it keys the booking message
+    return _taps.add((q.message.chat.id, q.message.message_id, q.data))
+
+def once(handler):
+    """Callback handler decorator: repeat taps answer and return None (for a
+    ConversationHandler state, None keeps the current state)."""
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        q = update.callback_query
+        if q.message is not None and not first_tap(q):
+            await q.answer()
+            return None
+        return await handler(update, context)
+    return wrapper
+
+async def single_flight(key, fn):
+    """Run fn() once for concurrent callers of key. Returns (result, leader)."""
+    fut = _inflight.get(key)
+    if fut is not None:
+        return await asyncio.shield(fut), False
+    fut = _inflight[key] = asyncio.get_running_loop().create_future()
+    try:
+        result = await fn()
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # retrieved: followers re-raise it, no "never retrieved" warning
+        raise
+    else:
+        fut.set_result(result)
+        return result, True
+    finally:
+        del _inflight[key]
@@ -9,8 +9,10 @@ from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler, MessageHandler, ContextTypes, filters
 )
 
-from db import conn_ctx, get_booking, now_tz
-from utils import TZ
+from db import conn_ctx, now_tz, keyset
+from async_db import run, get_booking, count_paid
+from utils import TZ, encode_cursor, decode_cursor
+import outbox
 
 # Load .env once
 p = find_dotenv(usecwd=True)
@@ -53,18 +55,12 @@ def _fmt_when(st_iso: str, en_iso: str) -> str:
     e = datetime.fromisoformat(en_iso).astimezone(TZ)
     return f"{s:%d %b %Y, %I:%M %p} → {e:%I:%M %p}"
 
-def _mins_until(st_iso: str) -> int:
-    try:
-        s = datetime.fromisoformat(st_iso).astimezone(TZ)
-        delta = s - now_tz()
-        return max(0, int(delta.total_seconds() // 60))
-    except Exception:
-        return 0
+def _mins_until(starts_ts: int, now_ts: float) -> int:
+    return max(0, int((starts_ts - now_ts) // 60))
 
-async def after_paid_announce(context: ContextTypes.DEFAULT_TYPE, booking_id: int):
-    """Send token + details to admin group right after payment marked PAID."""
+def _fetch_paid_announce(booking_id: int):
     with conn_ctx() as conn:
-        row = conn.execute("""
+        return conn.execute("""
             SELECT b.id, b.tg_user_id, b.user_full_name, u.username,
                    s.name, r.name, b.starts_at, b.ends_at, COALESCE(b.token,'-')
             FROM bookings b
@@ -73,6 +69,18 @@ async def after_paid_announce(context: ContextTypes.DEFAULT_TYPE, booking_id: in
             LEFT JOIN users u ON u.tg_user_id=b.tg_user_id
             WHERE b.id=? AND b.status='paid'
         """, (booking_id,)).fetchone()
+
+def _ensure_meta(booking_id: int):
+    with conn_ctx() as conn:
+        conn.execute("""
+        INSERT OR IGNORE INTO booking_meta(booking_id, service_done, user_reply_remaining, admin_reply_remaining)
+        VALUES(?,0,0,0)
+        """, (booking_id,))
+        conn.commit()
+
+async def after_paid_announce(context: ContextTypes.DEFAULT_TYPE, booking_id: int):
+    """Send token + details to admin group right after payment marked PAID."""
+    row = await run(_fetch_paid_announce, booking_id)
     if not row:
         return
     bid, uid, full, uname, sname, rname, st, en, token = row
@@ -85,44 +93,113 @@ async def after_paid_announce(context: ContextTypes.DEFAULT_TYPE, booking_id: in
         f"Time: {_fmt_when(st, en)}\n"
         f"Token: {token}"
     )
-    await context.bot.send_message(chat_id=ADMIN_GROUP_ID, text=text)
-    with conn_ctx() as conn:
-        conn.execute("""
-        INSERT OR IGNORE INTO booking_meta(booking_id, service_done, user_reply_remaining, admin_reply_remaining)
-        VALUES(?,0,0,0)
-        """, (booking_id,))
-        conn.commit()
+    outbox.send_message(ADMIN_GROUP_ID, text, priority=outbox.LOW, coalesce=True)
+    await run(_ensure_meta, booking_id)
 
 # ---------- /listbooking UI ----------
 
 PAGE_SIZE = 10
 
-def _fetch_paid_bookings(offset: int = 0) -> List[Tuple]:
+def _fetch_paid_bookings(cursor=None, direction: str = "next") -> List[Tuple]:
+    # keyset page (+1 look-ahead row) on (starts_ts, id); see db.keyset
+    where, order, params = keyset(cursor, direction)
     with conn_ctx() as conn:
-        rows = conn.execute("""
+        rows = conn.execute(f"""
             SELECT b.id, b.user_full_name, COALESCE(b.token,'-'), b.starts_at, b.ends_at,
-                   COALESCE(m.service_done,0)
-            FROM bookings b
+                   COALESCE(m.service_done,0), b.starts_ts
+            FROM bookings b INDEXED BY idx_bookings_paid_recent
             LEFT JOIN booking_meta m ON m.booking_id=b.id
-            WHERE b.status='paid'
-            ORDER BY b.starts_at DESC
-            LIMIT ? OFFSET ?
-        """, (PAGE_SIZE, offset)).fetchall()
-    return rows
+            WHERE b.status='paid' AND {where}
+            ORDER BY {order}
+            LIMIT ?
+        """, (*params, PAGE_SIZE + 1)).fetchall()
+    return rows[::-1] if direction == "prev" and cursor is not None else rows
 
-def _count_paid() -> int:
+def _toggle_done(bid: int) -> int:
     with conn_ctx() as conn:
-        n = conn.execute("SELECT COUNT(*) FROM bookings WHERE status='paid'").fetchone()[0]
-    return int(n)
+        row = conn.execute(
+            "SELECT COALESCE(service_done,0) FROM booking_meta WHERE booking_id=?",
+            (bid,)
+        ).fetchone()
+        cur = int(row[0]) if row else 0
+        newv = 0 if cur == 1 else 1
+        conn.execute("INSERT OR IGNORE INTO booking_meta(booking_id, service_done) VALUES(?,0)", (bid,))
+        conn.execute("UPDATE booking_meta SET service_done=? WHERE booking_id=?", (newv, bid))
+        conn.commit()
+    return newv
+
+# ---------- reply / rating sessions ----------
+# Almost every text in the group or in private has no session, so lookups are
+# served from memory. The tables stay the source of truth across restarts:
+# every change is written through (on the single DB thread, in order) and the
+# registry is rebuilt from them at startup.
+class _SessionRegistry:
+    def __init__(self, table: str, key_col: str, limit: int):
+        self.table, self.key_col, self.limit = table, key_col, limit
+        self._s = {}  # key -> [booking_id, remaining]
+
+    def rebuild(self):
+        with conn_ctx() as conn:
+            rows = conn.execute(f"SELECT {self.key_col}, booking_id, remaining FROM {self.table}").fetchall()
+        self._s = {int(k): [int(bid), int(left)] for k, bid, left in rows}
+
+    def get(self, key: int):
+        return self._s.get(key)
 
-def _table_lines(rows: List[Tuple]) -> List[str]:
-    # columns: Name | Token | Avail(min) | Done
+    async def open(self, key: int, bid: int):
+        self._s[key] = [bid, self.limit]
+        await run(self._write_open, key, bid)
+
+    async def drop(self, key: int):
+        if self._s.pop(key, None) is not None:
+            await run(self._write_drop, key)
+
+    def take(self, key: int):
+        """Spend one message of the session; returns what is left, or None if
+        nothing was. No await in here, so concurrent messages can't both spend
+        the last one."""
+        sess = self._s.get(key)
+        if sess is None or sess[1] <= 0:
+            return None
+        sess[1] -= 1
+        return sess[1]
+
+    async def save(self, key: int):
+        sess = self._s.get(key)
+        if sess is not None:
+            await run(self._write_remaining, key, sess[1])
+
+    def _write_open(self, key: int, bid: int):
+        with conn_ctx() as conn:
+            conn.execute(f"""
+            INSERT INTO {self.table}({self.key_col}, booking_id, remaining)
+            VALUES(?,?,?)
+            ON CONFLICT({self.key_col}) DO UPDATE SET booking_id=excluded.booking_id, remaining=excluded.remaining
+            """, (key, bid, self.limit))
+            conn.commit()
+
+    def _write_drop(self, key: int):
+        with conn_ctx() as conn:
+            conn.execute(f"DELETE FROM {self.table} WHERE {self.key_col}=?", (key,))
+            conn.commit()
+
+    def _write_remaining(self, key: int, left: int):
+        with conn_ctx() as conn:
+            conn.execute(f"UPDATE {self.table} SET remaining=? WHERE {self.key_col}=?", (left, key))
+            conn.commit()
+
+rating_sessions = _SessionRegistry("rating_sessions", "user_id", 5)
+admin_reply_sessions = _SessionRegistry("admin_reply_sessions", "admin_id", 7)
+
+def _table_lines(rows: List[Tuple], now_ts: float) -> List[str]:
+    # columns: Name | Token | Avail(min) | Done (users and this group also get
+    # reminders before the start, see reminders.py)
     lines = []
     header = f"{'User':20}  {'Token':10}  {'Avail(min)':10}  {'Done':5}"
     lines.append("```\n" + header)
     lines.append("-"*len(header))
-    for bid, name, token, st, en, done in rows:
-        avail = _mins_until(st)
+    for bid, name, token, st, en, done, st_ts in rows:
+        avail = _mins_until(st_ts, now_ts)
         d = "YES" if int(done)==1 else "NO"
         nm = (name or "-")[:20].ljust(20)
         tk = (token or "-")[:10].ljust(10)
@@ -132,36 +209,60 @@ def _table_lines(rows: List[Tuple]) -> List[str]:
     lines.append("```")
     return lines
 
-def _kb_for_page(rows: List[Tuple], page: int, total: int):
+def _kb_for_page(rows: List[Tuple], page: int, has_next: bool, now_ts: float):
+    # row buttons carry the page anchor (first row's cursor) so the page re-renders in place
+    anchor = f"{page}:{encode_cursor(rows[0][6], rows[0][0])}"
     buttons = []
-    for bid, name, token, st, en, done in rows:
+    for bid, name, token, st, en, done, st_ts in rows:
         dmark = "☑️" if int(done)==1 else "⬜️"
         row = [
-            InlineKeyboardButton(f"{dmark} Done #{bid}", callback_data=f"BLIST:DONE:{bid}:{page}"),
-            InlineKeyboardButton("💬 Reply", callback_data=f"BLIST:REPLY:{bid}:{page}")
+            InlineKeyboardButton(f"{dmark} Done #{bid}", callback_data=f"BLIST:DONE:{bid}:{anchor}"),
+            InlineKeyboardButton("💬 Reply", callback_data=f"BLIST:REPLY:{bid}:{anchor}")
         ]
-        if _mins_until(st) == 0:  # overdue or now
-            row.append(InlineKeyboardButton("🔁 Reschedule", callback_data=f"BLIST:RS:{bid}:{page}"))
+        if _mins_until(st_ts, now_ts) == 0:  # overdue or now
+            row.append(InlineKeyboardButton("🔁 Reschedule", callback_data=f"BLIST:RS:{bid}:{anchor}"))
         buttons.append(row)
     nav = []
     if page > 0:
-        nav.append(InlineKeyboardButton("⬅ Prev", callback_data=f"BLIST:PAGE:{page-1}"))
-    if (page+1)*PAGE_SIZE < total:
-        nav.append(InlineKeyboardButton("Next ➡", callback_data=f"BLIST:PAGE:{page+1}"))
+        first = encode_cursor(rows[0][6], rows[0][0])
+        nav.append(InlineKeyboardButton("⬅ Prev", callback_data=f"BLIST:PAGE:{page-1}:P:{first}"))
+    if has_next:
+        last = encode_cursor(rows[-1][6], rows[-1][0])
+        nav.append(InlineKeyboardButton("Next ➡", callback_data=f"BLIST:PAGE:{page+1}:N:{last}"))
     if nav:
         buttons.append(nav)
     return InlineKeyboardMarkup(buttons)
 
+async def _render_page(page: int = 0, cursor=None, direction: str = "next"):
+    """(text, keyboard) for one page, or None when there are no paid bookings."""
+    rows = await run(_fetch_paid_bookings, cursor, direction)
+    if not rows and cursor is not None:
+        page, cursor, direction = 0, None, "next"
+        rows = await run(_fetch_paid_bookings)
+    if not rows:
+        return None
+    more = len(rows) > PAGE_SIZE
+    if direction == "prev":
+        rows = rows[-PAGE_SIZE:]
+        if not more:
+            page = 0
+        has_next = True
+    else:
+        rows = rows[:PAGE_SIZE]
+        has_next = more
+    total = await count_paid()
+    now_ts = now_tz().timestamp()
+    txt = f"PAID bookings: {total} · page {page+1}\n" + "\n".join(_table_lines(rows, now_ts))
+    return txt, _kb_for_page(rows, page, has_next, now_ts)
+
 async def cmd_listbooking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != ADMIN_GROUP_ID:
         return
-    total = _count_paid()
-    rows = _fetch_paid_bookings(0)
-    if not rows:
+    page = await _render_page()
+    if not page:
         await update.message.reply_text("No PAID bookings yet.")
         return
-    txt = "\n".join(_table_lines(rows))
-    kb = _kb_for_page(rows, 0, total)
+    txt, kb = page
     await update.message.reply_text(txt, reply_markup=kb, parse_mode="Markdown")
 
 async def on_blist(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -171,69 +272,46 @@ async def on_blist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     parts = q.data.split(":")
     _, act = parts[0], parts[1]
     if act == "PAGE":
+        # BLIST:PAGE:<page>:<N|P>:<cursor>
         page = int(parts[2])
-        total = _count_paid()
-        rows = _fetch_paid_bookings(page*PAGE_SIZE)
-        txt = "\n".join(_table_lines(rows))
-        kb = _kb_for_page(rows, page, total)
-        await q.edit_message_text(txt, reply_markup=kb, parse_mode="Markdown")
+        rendered = await _render_page(page, decode_cursor(parts[4]), "next" if parts[3] == "N" else "prev")
+        if rendered:
+            await q.edit_message_text(rendered[0], reply_markup=rendered[1], parse_mode="Markdown")
     elif act == "DONE":
+        # BLIST:DONE:<bid>:<page>:<anchor cursor>
         bid = int(parts[2]); page = int(parts[3])
-        with conn_ctx() as conn:
-            row = conn.execute(
-                "SELECT COALESCE(service_done,0) FROM booking_meta WHERE booking_id=?",
-                (bid,)
-            ).fetchone()
-            cur = int(row[0]) if row else 0
-            newv = 0 if cur == 1 else 1
-            conn.execute("INSERT OR IGNORE INTO booking_meta(booking_id, service_done) VALUES(?,0)", (bid,))
-            conn.execute("UPDATE booking_meta SET service_done=? WHERE booking_id=?", (newv, bid))
-            conn.commit()
+        newv = await run(_toggle_done, bid)
         if newv == 1:
-            b = get_booking(bid)
+            b = await get_booking(bid)
             if b:
                 uid = b[5]
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text=("✅ Your service is completed.\n"
-                          "Please share your feedback or rating (you can send up to 5 messages in this thread).")
+                outbox.send_message(
+                    uid,
+                    ("✅ Your service is completed.\n"
+                     "Please share your feedback or rating (you can send up to 5 messages in this thread).")
                 )
-                with conn_ctx() as conn:
-                    conn.execute("""
-                    INSERT INTO rating_sessions(user_id, booking_id, remaining)
-                    VALUES(?,?,5)
-                    ON CONFLICT(user_id) DO UPDATE SET booking_id=excluded.booking_id, remaining=5
-                    """, (uid, bid))
-                    conn.commit()
-                await q.message.reply_text(f"Opened rating window for user [{uid}] (limit: 5).")
-        total = _count_paid()
-        rows = _fetch_paid_bookings(page*PAGE_SIZE)
-        txt = "\n".join(_table_lines(rows))
-        kb = _kb_for_page(rows, page, total)
-        await q.edit_message_text(txt, reply_markup=kb, parse_mode="Markdown")
+                await rating_sessions.open(uid, bid)
+                await q.message.reply_text(f"Opened rating window for user [{uid}] (limit: {rating_sessions.limit}).")
+        rendered = await _render_page(page, decode_cursor(parts[4]), "at")
+        if rendered:
+            await q.edit_message_text(rendered[0], reply_markup=rendered[1], parse_mode="Markdown")
 
     elif act == "REPLY":
         bid = int(parts[2]); page = int(parts[3])
         admin_id = update.effective_user.id
-        with conn_ctx() as conn:
-            conn.execute("""
-            INSERT INTO admin_reply_sessions(admin_id, booking_id, remaining)
-            VALUES(?,?,7)
-            ON CONFLICT(admin_id) DO UPDATE SET booking_id=excluded.booking_id, remaining=7
-            """, (admin_id, bid))
-            conn.commit()
-        await q.message.reply_text(f"➡ Reply mode ON for booking #{bid} (limit: 7). Type your message…")
+        await admin_reply_sessions.open(admin_id, bid)
+        await q.message.reply_text(f"➡ Reply mode ON for booking #{bid} (limit: {admin_reply_sessions.limit}). Type your message…")
     elif act == "RS":
         bid = int(parts[2]); page = int(parts[3])
-        b = get_booking(bid)
+        b = await get_booking(bid)
         if not b:
             await q.message.reply_text("Booking not found.")
             return
         uid = b[5]
-        await context.bot.send_message(
-            chat_id=uid,
-            text=(f"⏰ Your booking #{bid} time has passed or is due.\n"
-                  "Please use /book to pick a new slot. Mention your previous token to the admin if needed.")
+        outbox.send_message(
+            uid,
+            (f"⏰ Your booking #{bid} time has passed or is due.\n"
+             "Please use /book to pick a new slot. Mention your previous token to the admin if needed.")
         )
         await q.message.reply_text(f"Reschedule instruction sent to user [{uid}].")
 
@@ -245,61 +323,51 @@ async def handle_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not update.message or not update.message.text or update.message.text.startswith("/"):
         return
     admin_id = update.effective_user.id
-    with conn_ctx() as conn:
-        row = conn.execute(
-            "SELECT booking_id, remaining FROM admin_reply_sessions WHERE admin_id=?",
-            (admin_id,)
-        ).fetchone()
-    if not row:
+    sess = admin_reply_sessions.get(admin_id)
+    if not sess:
         return
-    bid, left = int(row[0]), int(row[1])
-    if left <= 0:
-        with conn_ctx() as conn:
-            conn.execute("DELETE FROM admin_reply_sessions WHERE admin_id=?", (admin_id,))
-            conn.commit()
+    bid = sess[0]
+    left = admin_reply_sessions.take(admin_id)
+    if left is None:
+        await admin_reply_sessions.drop(admin_id)
         await update.message.reply_text("Reply limit is over. Tap Reply again from /listbooking.")
         return
-    b = get_booking(bid)
+    await admin_reply_sessions.save(admin_id)
+    b = await get_booking(bid)
     if not b:
         await update.message.reply_text("Booking not found.")
         return
     uid = b[5]
-    await context.bot.send_message(chat_id=uid, text=update.message.text)
-    with conn_ctx() as conn:
-        conn.execute("UPDATE admin_reply_sessions SET remaining=remaining-1 WHERE admin_id=?", (admin_id,))
-        conn.commit()
-    if left-1 <= 0:
+    outbox.send_message(uid, update.message.text)
+    if left <= 0:
         await update.message.reply_text("✅ Reply limit reached for this session.")
 
 async def handle_user_rating(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != "private" or not update.message or not update.message.text:
         return
     uid = update.effective_user.id
-    with conn_ctx() as conn:
-        row = conn.execute(
-            "SELECT booking_id, remaining FROM rating_sessions WHERE user_id=?", (uid,)
-        ).fetchone()
-    if not row:
+    sess = rating_sessions.get(uid)
+    if not sess:
         return
-    bid, left = int(row[0]), int(row[1])
-    if left <= 0:
-        with conn_ctx() as conn:
-            conn.execute("DELETE FROM rating_sessions WHERE user_id=?", (uid,))
-            conn.commit()
+    bid = sess[0]
+    left = rating_sessions.take(uid)
+    if left is None:
+        await rating_sessions.drop(uid)
         return
-    await context.bot.send_message(
-        chat_id=ADMIN_GROUP_ID,
-        text=(f"📝 Rating/Response for booking #{bid}\n"
-              f"From user [{uid}]:\n{update.message.text}")
+    await rating_sessions.save(uid)
+    outbox.send_message(
+        ADMIN_GROUP_ID,
+        (f"📝 Rating/Response for booking #{bid}\n"
+         f"From user [{uid}]:\n{update.message.text}"),
+        priority=outbox.LOW, coalesce=True
     )
-    with conn_ctx() as conn:
-        conn.execute("UPDATE rating_sessions SET remaining=remaining-1 WHERE user_id=?", (uid,))
-        conn.commit()
-    if left-1 <= 0:
-        await context.bot.send_message(chat_id=uid, text="🙏 Thanks for your feedback. The session is now closed.")
+    if left <= 0:
+        outbox.send_message(uid, "🙏 Thanks for your feedback. The session is now closed.")
 
 def wire_dashboard(app: Application):
     ensure_ext_tables()
+    rating_sessions.rebuild()
+    admin_reply_sessions.rebuild()
     app.add_handler(CommandHandler("listbooking", cmd_listbooking), group=0)
     app.add_handler(CallbackQueryHandler(on_blist, pattern=r"^BLIST:(PAGE|DONE|REPLY|RS):"), group=0)
     app.add_handler(MessageHandler(filters.Chat(ADMIN_GROUP_ID) & filters.TEXT & ~filters.COMMAND, handle_admin_reply), group=0)
@@ -0,0 +1,133 @@
+# inquiries.py
+# General inquiries on their way to the admin group. Unmatched private texts
+# wait up to INQUIRY_DIGEST_SEC and go out as one message per user; when
+# INQUIRY_ROLLUP_USERS or more users are waiting at once, they share roll-up
+# messages with a button row per user. A user reaching INQUIRY_DIGEST_MAX
+# messages is sent at once.
+#
+# Photos skip the digest: a single photo carries the keyboard itself, an album
+# goes as one media group plus one control message (see media.py).
+#
+# Replying to a single-user digest goes straight to that user (admin_session);
+# a roll-up has several senders, so there the per-user Reply button is the way.
+import os, asyncio
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import outbox
+import media
+import admin_session
+
+ADMIN_GROUP_ID = int(os.environ["ADMIN_GROUP_ID"])
+INQUIRY_DIGEST_SEC = float(os.getenv("INQUIRY_DIGEST_SEC", "3"))   # 0 = forward each message at once
+INQUIRY_DIGEST_MAX = int(os.getenv("INQUIRY_DIGEST_MAX", "10"))    # messages per user per digest
+INQUIRY_ROLLUP_USERS = int(os.getenv("INQUIRY_ROLLUP_USERS", "4"))
+INQUIRY_ROLLUP_MAX = int(os.getenv("INQUIRY_ROLLUP_MAX", "8"))     # users per roll-up message
+
+_pending = {}  # user_id -> (full_name, username, [texts]), in arrival order
+_timer = None
+
+def keyboard(user_id: int, n: str = "") -> list:
+    """The Reply / Mute / Stop row for one user (n numbers it in a roll-up)."""
+    return [
+        InlineKeyboardButton(f"💬 Reply {n}".rstrip(), callback_data=f"GR:REPLY:{user_id}"),
+        InlineKeyboardButton(f"🔕 Mute 10m {n}".rstrip(), callback_data=f"GR:MUTE:{user_id}"),
+        InlineKeyboardButton(f"⛔ Stop {n}".rstrip(), callback_data=f"GR:STOP:{user_id}"),
+    ]
+
+def track(fut, user_id: int):
+    # the forwarded copy's message_id is known once the outbox has sent it
+    def done(f):
+        if f.cancelled() or f.exception() is not None or f.result() is None:
+            return
+        r = f.result()  # a Message, or a tuple of them for a media group
+        for m in (r if isinstance(r, (list, tuple)) else (r,)):
+            admin_session.remember(m.message_id, user_id)
+    fut.add_done_callback(done)
+
+def _clip(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:max(0, limit - 1)] + "…"
+
+# ---------- buffering ----------
+def add(user, text: str):
+    entry = _pending.get(user.id)
+    if entry is None:
+        entry = _pending[user.id] = (user.full_name, user.username or "n/a", [])
+    entry[2].append(text or "(empty)")
+    if len(entry[2]) >= INQUIRY_DIGEST_MAX or INQUIRY_DIGEST_SEC <= 0:
+        flush_user(user.id)
+    else:
+        global _timer
+        if _timer is None:
+            _timer = asyncio.get_running_loop().call_later(INQUIRY_DIGEST_SEC, flush)
+
+def flush_user(user_id: int):
+    """Send what user_id has waiting now (e.g. before forwarding their photo)."""
+    entry = _pending.pop(user_id, None)
+    if entry is not None:
+        _send_one(user_id, *entry)
+
+def flush():
+    """Send everything waiting: per user, or as roll-ups when many users are."""
+    global _timer
+    if _timer is not None:
+        _timer.cancel()
+        _timer = None
+    batch = list(_pending.items())
+    _pending.clear()
+    if len(batch) < max(2, INQUIRY_ROLLUP_USERS):
+        for uid, entry in batch:
+            _send_one(uid, *entry)
+        return
+    for i in range(0, len(batch), INQUIRY_ROLLUP_MAX):
+        _send_rollup(batch[i:i + INQUIRY_ROLLUP_MAX])
+
+def add_photos(user, messages: list):
+    """A single photo message, or every part of an album."""
+    scope = ("from", user.id)
+    photos = media.fresh(scope, messages)
+    if not photos:
+        return  # the same screenshot(s) again
+    flush_user(user.id)  # their buffered texts go first
+    caption = next((m.caption for m in messages if m.caption), None) or "(no caption)"
+    sender = f"From: {user.full_name} (@{user.username or 'n/a'}) [{user.id}]"
+    kb = InlineKeyboardMarkup([keyboard(user.id)])
+    if len(photos) == 1:
+        fut = outbox.send_photo(
+            ADMIN_GROUP_ID, photos[0].photo[-1].file_id, priority=outbox.LOW,
+            caption=_clip(f"🧾 General Inquiry (photo)\n{sender}\nCaption:\n{caption}", 1024),
+            reply_markup=kb,
+        )
+        media.sent(fut, scope, photos)
+        track(fut, user.id)
+        return
+    fut = outbox.send_media_group(ADMIN_GROUP_ID, media.as_album(photos), priority=outbox.LOW)
+    media.sent(fut, scope, photos)
+    track(fut, user.id)
+    track(outbox.send_message(
+        ADMIN_GROUP_ID, _clip(f"🧾 General Inquiry ({len(photos)} photos above)\n{sender}\nCaption:\n{caption}",
+                              outbox.MAX_TEXT),
+        priority=outbox.LOW, reply_markup=kb,
+    ), user.id)
+
+# ---------- sending ----------
+def _send_one(user_id: int, name: str, username: str, texts: list):
+    if len(texts) == 1:
+        body = f"Message:\n{texts[0]}"
+    else:
+        body = f"Messages ({len(texts)}):\n" + "\n".join(f"• {t}" for t in texts)
+    text = f"📨 General Inquiry\nFrom: {name}\n(@{username}) [{user_id}]\n" + body
+    track(outbox.send_message(
+        ADMIN_GROUP_ID, _clip(text, outbox.MAX_TEXT), priority=outbox.LOW,
+        reply_markup=InlineKeyboardMarkup([keyboard(user_id)]),
+    ), user_id)
+
+def _send_rollup(batch: list):
+    budget = (outbox.MAX_TEXT - 100) // len(batch)
+    parts = [f"📨 General Inquiries – {len(batch)} users"]
+    rows = []
+    for n, (uid, (name, username, texts)) in enumerate(batch, 1):
+        parts.append(_clip(f"{n}) {name} (@{username}) [{uid}]\n" + "\n".join(f"• {t}" for t in texts), budget))
+        rows.append(keyboard(uid, str(n)))
+    outbox.send_message(ADMIN_GROUP_ID, "\n\n".join(parts), priority=outbox.LOW,
+                        reply_markup=InlineKeyboardMarkup(rows))
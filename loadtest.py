@@ -0,0 +1,301 @@
+# loadtest.py
+# End-to-end load harness: runs get_app() + wire_dashboard() against an
+# in-process fake Bot API and replays update streams at a given concurrency.
+#
+#   python loadtest.py --users 50 --concurrency 16 --api-latency-ms 30
+#   python loadtest.py --replay updates.jsonl      # one raw Update JSON per line
+#   python loadtest.py --record updates.jsonl ...  # save the scripted stream
+#   python loadtest.py --replay updates.jsonl --webhook  # POST them through webhook.WebhookApp
+#   python loadtest.py --users 50 --flood 5        # plus 5 users spamming 100 texts each
+import os, re, json, time, asyncio, argparse, tempfile, itertools
+from collections import defaultdict
+
+_tmpdir = tempfile.mkdtemp(prefix="booking-load-")
+os.environ.setdefault("DB_PATH", os.path.join(_tmpdir, "load.db"))
+os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+os.environ.setdefault("ADMIN_GROUP_ID", "-1001")
+# the fake API has no flood limits; keep the outbox from pacing the run
+os.environ.setdefault("OUTBOX_GROUP_PER_MIN", "60000")
+os.environ.setdefault("OUTBOX_CHAT_PER_SEC", "1000")
+os.environ.setdefault("OUTBOX_GLOBAL_PER_SEC", "10000")
+# a scripted flow sends ~11 updates back to back (a person spreads them over
+# a minute); keep those under the throttle, --flood users still trip it
+os.environ.setdefault("THROTTLE_BURST", "20")
+
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+import bot
+import db
+import outbox
+import metrics
+from ext_dashboard import wire_dashboard
+
+ADMIN_GROUP_ID = int(os.environ["ADMIN_GROUP_ID"])
+ADMIN_ID = 999_000
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LoadBot", "username": "load_bot",
+            "can_join_groups": True, "can_read_all_group_messages": True, "supports_inline_queries": False}
+
+# ---------- fake Bot API ----------
+class FakeBotAPI:
+    """State shared by the fake request objects: call counts, last keyboard per chat."""
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = defaultdict(int)
+        self.last_markup = {}            # chat_id -> inline_keyboard rows
+        self.sent = defaultdict(list)    # chat_id -> texts
+        self._msg_ids = itertools.count(10_000)
+
+    def message(self, chat_id, params):
+        chat_id = int(chat_id)
+        chat = {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}
+        if chat_id <= 0:
+            chat["title"] = "Admins"
+        msg = {"message_id": int(params.get("message_id") or next(self._msg_ids)), "date": int(time.time()),
+               "chat": chat, "from": BOT_USER, "text": params.get("text") or params.get("caption") or ""}
+        markup = params.get("reply_markup")
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        if markup and "inline_keyboard" in markup:
+            msg["reply_markup"] = markup
+            self.last_markup[chat_id] = markup["inline_keyboard"]
+        return msg
+
+    def handle(self, method: str, params: dict):
+        self.calls[method] += 1
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText", "sendPhoto", "editMessageReplyMarkup", "editMessageCaption"):
+            if method in ("sendMessage", "sendPhoto"):
+                self.sent[int(params["chat_id"])].append(params.get("text") or params.get("caption") or "")
+            return self.message(params["chat_id"], params)
+        if method == "copyMessage":
+            return {"message_id": next(self._msg_ids)}
+        if method == "sendMediaGroup":
+            media = params.get("media") or []
+            if isinstance(media, str):
+                media = json.loads(media)
+            return [self.message(params["chat_id"], {}) for _ in media]
+        return True  # answerCallbackQuery, deleteMessage, setWebhook, ...
+
+class FakeRequest(BaseRequest):
+    def __init__(self, api: FakeBotAPI):
+        self.api = api
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data: RequestData = None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if self.api.latency:
+            await asyncio.sleep(self.api.latency)
+        params = request_data.parameters if request_data else {}
+        result = self.api.handle(url.rsplit("/", 1)[-1], params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+# ---------- update builders ----------
+_update_ids = itertools.count(1)
+_msg_ids = itertools.count(1)
+
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"}
+
+def _chat(chat_id: int) -> dict:
+    if chat_id > 0:
+        return {"id": chat_id, "type": "private", "first_name": f"User{chat_id}"}
+    return {"id": chat_id, "type": "supergroup", "title": "Admins"}
+
+def text_update(uid: int, text: str, chat_id: int = None) -> dict:
+    msg = {"message_id": next(_msg_ids), "date": int(time.time()), "chat": _chat(chat_id or uid),
+           "from": _user(uid), "text": text}
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_update_ids), "message": msg}
+
+def callback_update(uid: int, data: str, chat_id: int = None) -> dict:
+    msg = {"message_id": next(_msg_ids), "date": int(time.time()), "chat": _chat(chat_id or uid),
+           "from": BOT_USER, "text": "…"}
+    return {"update_id": next(_update_ids),
+            "callback_query": {"id": str(next(_update_ids)), "from": _user(uid), "chat_instance": "load",
+                               "data": data, "message": msg}}
+
+# ---------- instrumentation ----------
+class Stats:
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def observe(self, name: str, seconds: float):
+        self.samples[name].append(seconds)
+
+    def report(self, updates: int, wall: float, api: FakeBotAPI):
+        def pct(xs, p):
+            xs = sorted(xs)
+            return xs[min(len(xs) - 1, int(len(xs) * p / 100))]
+        print(f"\n{updates} updates in {wall:.2f}s -> {updates / wall:.0f} updates/s")
+        print(f"{'handler':>24} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for name, xs in sorted(self.samples.items()):
+            print(f"{name:>24} {len(xs):>6} {pct(xs, 50)*1e3:>8.2f} {pct(xs, 95)*1e3:>8.2f} {pct(xs, 99)*1e3:>8.2f}")
+        print("Bot API calls: " + ", ".join(f"{k}={v}" for k, v in sorted(api.calls.items())))
+
+# ---------- scripted flows ----------
+def _pick(api: FakeBotAPI, chat_id: int, prefix: str):
+    for row in api.last_markup.get(chat_id, []):
+        for btn in row:
+            if btn.get("callback_data", "").startswith(prefix):
+                return btn["callback_data"]
+    return None
+
+async def booking_flow(app, api, uid: int, record):
+    """/book -> SVC -> RES -> DATE -> TIME -> PM -> ref, choosing buttons from the bot's own keyboards."""
+    async def send(u):
+        record(u)
+        await app.process_update(Update.de_json(u, app.bot))
+
+    await send(text_update(uid, "/book"))
+    for prefix in ("SVC:", "RES:", "DATE:", "TIME:"):
+        data = _pick(api, uid, prefix)
+        if data is None:
+            return
+        await send(callback_update(uid, data))
+    await send(callback_update(uid, "PM:cash"))
+    await send(text_update(uid, "ok"))
+
+async def inquiry_flow(app, api, uid: int, record):
+    for text in ("hello", "what is the price for a room?", "/menu"):
+        u = text_update(uid, text)
+        record(u)
+        await app.process_update(Update.de_json(u, app.bot))
+
+def _tap_again(u: dict) -> dict:
+    """The same button on the same message, tapped again (new update and query ids)."""
+    q = dict(u["callback_query"], id=str(next(_update_ids)))
+    return {"update_id": next(_update_ids), "callback_query": q}
+
+async def flood_flow(app, uid: int, record, n: int = 100):
+    for i in range(n):
+        u = text_update(uid, f"spam {i}")
+        record(u)
+        await app.process_update(Update.de_json(u, app.bot))
+
+async def admin_flow(app, api, record, taps: int = 1):
+    """Mark every pending booking announced in the admin group as paid (each button
+    tapped `taps` times), then page the listings."""
+    bids = sorted({int(m) for t in api.sent[ADMIN_GROUP_ID] for m in re.findall(r"ID: #(\d+)", t)})
+    updates = []
+    for bid in bids:
+        u = callback_update(ADMIN_ID, f"ADMIN:PAID:{bid}:{os.urandom(3).hex()}", ADMIN_GROUP_ID)
+        updates += [u] + [_tap_again(u) for _ in range(taps - 1)]
+    updates.append(text_update(ADMIN_ID, "/listbooking", ADMIN_GROUP_ID))
+    for u in updates:
+        record(u)
+    await asyncio.gather(*(app.process_update(Update.de_json(u, app.bot)) for u in updates))
+    nxt = _pick(api, ADMIN_GROUP_ID, "LIST:N:")
+    if nxt:
+        u = callback_update(ADMIN_ID, nxt, ADMIN_GROUP_ID)
+        record(u)
+        await app.process_update(Update.de_json(u, app.bot))
+
+def _seed(resources: int, capacity: int):
+    db.init_db()
+    sid = db.upsert_service("Load Test", 30, 500, 15)
+    for i in range(resources):
+        db.upsert_resource(sid, f"Room {i+1}", capacity, "08:00", "22:00")
+
+async def main(args):
+    _seed(args.resources, args.capacity)
+    api = FakeBotAPI(latency=args.api_latency_ms / 1000)
+    app = bot.get_app(request=FakeRequest(api), updates_request=FakeRequest(api))
+    wire_dashboard(app)
+    stats = Stats()
+    metrics.instrument_handlers(app, stats.observe)
+    web = None
+    if args.webhook:
+        import httpx
+        from webhook import WebhookApp
+        web = WebhookApp(app, secret="load")
+        await web.startup()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=web), base_url="http://bot",
+                                   headers={"X-Telegram-Bot-Api-Secret-Token": "load"})
+    else:
+        await app.initialize()
+        await app.post_init(app)
+
+    recorded = []
+    record = recorded.append if args.record else (lambda u: None)
+    sem = asyncio.Semaphore(args.concurrency)
+    counted = lambda: sum(len(v) for v in stats.samples.values())
+
+    t0 = time.perf_counter()
+    if args.replay:
+        per_user = defaultdict(list)  # keep per-user order, run users in parallel
+        with open(args.replay) as fh:
+            for line in fh:
+                if line.strip():
+                    u = json.loads(line)
+                    frm = (u.get("message") or u.get("callback_query") or {}).get("from", {})
+                    per_user[frm.get("id")].append(u)
+
+        async def replay(updates):
+            async with sem:
+                for u in updates:
+                    if web:
+                        r = await client.post(web.path, json=u)
+                        r.raise_for_status()
+                    else:
+                        await app.process_update(Update.de_json(u, app.bot))
+        await asyncio.gather(*(replay(us) for us in per_user.values()))
+    else:
+        async def user(uid):
+            async with sem:
+                for _ in range(args.flows):
+                    await booking_flow(app, api, uid, record)
+                    await inquiry_flow(app, api, uid, record)
+        await asyncio.gather(*(user(100_000 + i) for i in range(args.users)),
+                             *(flood_flow(app, 200_000 + i, record) for i in range(args.flood)))
+        await outbox.join()  # admin_flow reads the announcements from the group
+        await admin_flow(app, api, record, 2 if args.double_tap else 1)
+    if web:
+        await app.update_queue.join()  # POSTs return once queued; wait for the handlers
+    await outbox.join()
+    wall = time.perf_counter() - t0
+
+    sent = outbox.stats()
+    exposition = await metrics.render() if args.metrics else ""
+    if web:
+        await web.shutdown()
+        await client.aclose()
+    else:
+        await app.post_stop(app)
+        await app.shutdown()
+    stats.report(counted(), wall, api)
+    print("outbox:", sent)
+    if exposition:
+        print(exposition, end="")
+    if args.record:
+        with open(args.record, "w") as fh:
+            for u in recorded:
+                fh.write(json.dumps(u) + "\n")
+        print(f"recorded {len(recorded)} updates to {args.record}")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Replay update streams against get_app() with a fake Bot API")
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--flows", type=int, default=1, help="booking + inquiry flows per user")
+    ap.add_argument("--concurrency", type=int, default=16, help="users in flight at once")
+    ap.add_argument("--api-latency-ms", type=float, default=0.0, help="simulated Bot API round trip")
+    ap.add_argument("--resources", type=int, default=3)
+    ap.add_argument("--capacity", type=int, default=2)
+    ap.add_argument("--replay", help="JSONL file of raw Update dicts to replay instead of the scripted flows")
+    ap.add_argument("--webhook", action="store_true", help="with --replay: POST updates through the webhook ASGI app")
+    ap.add_argument("--metrics", action="store_true", help="print the /metrics exposition at the end")
+    ap.add_argument("--record", help="write the scripted update stream to this JSONL file")
+    ap.add_argument("--flood", type=int, default=0, help="extra users each sending 100 texts back to back")
+    ap.add_argument("--double-tap", action="store_true", help="admins tap every Mark Paid button twice")
+    asyncio.run(main(ap.parse_args()))
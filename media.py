@@ -0,0 +1,73 @@
+# media.py
+# Photo relays in both directions (user -> admin group, admin group -> user).
+#
+# Telegram delivers an album as one update per item, sharing media_group_id.
+# collect() buffers the parts per (chat, media_group_id) and hands the whole
+# album to a callback once no part has arrived for ALBUM_WAIT_SEC, so it can be
+# relayed with one send_media_group instead of a call per photo.
+#
+# fresh() / sent() remember which photos (by file_unique_id, stable across
+# re-uploads of the same file) were already relayed for a scope -- the user
+# they came from, or the user they went to -- so duplicate screenshots are
+# skipped. A photo only counts as relayed once its send succeeded.
+import os, asyncio
+
+from telegram import InputMediaPhoto
+
+from dedup import TTLSet
+
+ALBUM_WAIT_SEC = float(os.getenv("ALBUM_WAIT_SEC", "1.0"))
+MEDIA_DEDUP_SEC = float(os.getenv("MEDIA_DEDUP_SEC", "86400"))
+MEDIA_DEDUP_SIZE = int(os.getenv("MEDIA_DEDUP_SIZE", "20000"))
+
+_albums = {}  # (chat_id, media_group_id) -> [messages, timer, on_done]
+_relayed = TTLSet(MEDIA_DEDUP_SEC, MEDIA_DEDUP_SIZE)
+_sending = set()  # keys of photos in flight, so a duplicate sent meanwhile is skipped too
+
+def collect(message, on_done):
+    """Buffer one album part; on_done(messages) gets the album in order."""
+    key = (message.chat_id, message.media_group_id)
+    album = _albums.get(key)
+    if album is None:
+        album = _albums[key] = [[], None, on_done]
+    else:
+        album[1].cancel()
+    album[0].append(message)
+    album[1] = asyncio.get_running_loop().call_later(ALBUM_WAIT_SEC, _done, key)
+
+def _done(key):
+    messages, timer, on_done = _albums.pop(key)
+    timer.cancel()
+    on_done(sorted(messages, key=lambda m: m.message_id))
+
+def flush():
+    """Hand over albums still waiting for parts (shutdown)."""
+    for key in list(_albums):
+        _done(key)
+
+def _key(scope, m):
+    return scope, m.photo[-1].file_unique_id
+
+def fresh(scope, messages: list) -> list:
+    """The photo messages not yet relayed for scope; hand their send to sent()."""
+    out = []
+    for m in messages:
+        k = _key(scope, m)
+        if k not in _relayed and k not in _sending:
+            _sending.add(k)
+            out.append(m)
+    return out
+
+def sent(fut, scope, messages: list):
+    """Mark messages relayed for scope once fut (the outbox send) succeeds;
+    if it fails, they are not, so the user can simply send them again."""
+    keys = [_key(scope, m) for m in messages]
+    def done(f):
+        _sending.difference_update(keys)
+        if not f.cancelled() and f.exception() is None and f.result() is not None:
+            for k in keys:
+                _relayed.add(k)
+    fut.add_done_callback(done)
+
+def as_album(messages: list) -> list:
+    return [InputMediaPhoto(m.photo[-1].file_id, caption=m.caption) for m in messages]
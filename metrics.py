@@ -0,0 +1,198 @@
+# metrics.py
+# In-process metrics with Prometheus text exposition (no client library).
+# Counters and histograms are dicts keyed by label tuples, updated in a few
+# hundred ns; gauges are callbacks read only when /metrics is scraped.
+import os, hmac, time, asyncio, inspect, threading, contextvars
+from bisect import bisect_left
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # polling mode: 0 = no metrics listener
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")      # bearer token for /metrics; webhook mode needs it
+
+# who is running right now; copied into the DB thread by async_db.run
+HANDLER = contextvars.ContextVar("metrics_handler", default="-")
+DB_OP = contextvars.ContextVar("metrics_db_op", default="direct")
+
+HANDLER_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+DB_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1)
+
+_registry = {}  # name -> metric, in registration order
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    esc = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, esc)) + "}"
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+        _registry[name] = self
+
+    def inc(self, *labels, n: float = 1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + n
+
+    async def lines(self):
+        return [f"{self.name}{_labels(self.labels, lv)} {v}" for lv, v in list(self.values.items())]
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=HANDLER_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._lock = threading.Lock()
+        _registry[name] = self
+
+    def observe(self, value: float, *labels):
+        i = bisect_left(self.buckets, value)  # first bucket with le >= value
+        with self._lock:
+            st = self.values.get(labels)
+            if st is None:
+                st = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            st[0][i] += 1
+            st[1] += value
+            st[2] += 1
+
+    async def lines(self):
+        out = []
+        for lv, (counts, total, n) in list(self.values.items()):
+            cum = 0
+            for le, c in zip(self.buckets + ("+Inf",), counts):
+                cum += c
+                out.append(f"{self.name}_bucket{_labels(self.labels + ('le',), lv + (le,))} {cum}")
+            out.append(f"{self.name}_sum{_labels(self.labels, lv)} {total}")
+            out.append(f"{self.name}_count{_labels(self.labels, lv)} {n}")
+        return out
+
+class Gauge:
+    """Read at scrape time. fn returns a number, or {label tuple: number};
+    it may be a coroutine function (e.g. an async_db query)."""
+    def __init__(self, name: str, help: str, fn, labels=(), type: str = "gauge"):
+        self.name, self.help, self.fn, self.labels, self.type = name, help, fn, tuple(labels), type
+        _registry[name] = self  # re-registering a name replaces it (get_app() may run twice)
+
+    async def lines(self):
+        v = self.fn()
+        if inspect.isawaitable(v):
+            v = await v
+        if not isinstance(v, dict):
+            v = {(): v}
+        return [f"{self.name}{_labels(self.labels, lv)} {x}" for lv, x in v.items()]
+
+gauge = Gauge
+
+async def render() -> str:
+    out = []
+    for m in list(_registry.values()):
+        try:
+            lines = await m.lines()
+        except Exception:  # a broken gauge must not take the whole scrape down
+            continue
+        out += [f"# HELP {m.name} {m.help}", f"# TYPE {m.name} {m.type}", *lines]
+    return "\n".join(out) + "\n"
+
+# ---------- built-in metrics ----------
+HANDLER_SECONDS = Histogram("booking_handler_seconds", "Handler run time", ("handler",), HANDLER_BUCKETS)
+HANDLER_ERRORS = Counter("booking_handler_errors_total", "Handler runs that raised", ("handler",))
+DB_SECONDS = Histogram("booking_db_seconds", "Time inside outermost conn_ctx blocks", ("op",), DB_BUCKETS)
+DB_STATEMENTS = Counter("booking_db_statements_total", "SQL statements executed, by calling handler", ("handler",))
+SWEEP_RUNS = Counter("booking_sweeper_runs_total", "Hold sweeper runs")
+SWEEP_EXPIRED = Counter("booking_sweeper_expired_total", "Holds expired by the sweeper")
+SWEEP_SECONDS = Histogram("booking_sweeper_seconds", "Hold sweeper run time", (), HANDLER_BUCKETS)
+
+def observe_db(seconds: float):
+    DB_SECONDS.observe(seconds, DB_OP.get())
+
+def count_statement(_sql):
+    # sqlite3 trace callback: runs on the thread executing the statement
+    DB_STATEMENTS.inc(HANDLER.get())
+
+def instrument_handlers(app, observe=None):
+    """Wrap every handler callback (including ConversationHandler states) to
+    record booking_handler_seconds and tag DB work with the handler name.
+    observe(name, seconds), if given, also gets each sample."""
+    from telegram.ext import ApplicationHandlerStop, ConversationHandler
+
+    def wrap(h):
+        if isinstance(h, ConversationHandler):
+            for sub in (*h.entry_points, *h.fallbacks, *(x for hs in h.states.values() for x in hs)):
+                wrap(sub)
+            return
+        cb = getattr(h, "callback", None)
+        if cb is None or getattr(cb, "_instrumented", False):
+            return
+        name = cb.__name__
+
+        async def timed(update, context, _cb=cb, _name=name):
+            token = HANDLER.set(_name)
+            t0 = time.perf_counter()
+            try:
+                return await _cb(update, context)
+            except ApplicationHandlerStop:  # control flow (throttle), not a failure
+                raise
+            except Exception:
+                HANDLER_ERRORS.inc(_name)
+                raise
+            finally:
+                dt = time.perf_counter() - t0
+                HANDLER.reset(token)
+                HANDLER_SECONDS.observe(dt, _name)
+                if observe is not None:
+                    observe(_name, dt)
+        timed._instrumented = True
+        timed.__name__ = name
+        h.callback = timed
+
+    for handlers in app.handlers.values():
+        for h in handlers:
+            wrap(h)
+
+# ---------- exposition for polling mode (webhook.py serves /metrics itself) ----------
+_server = None
+
+def authorized(auth_header: bytes) -> bool:
+    return not METRICS_TOKEN or hmac.compare_digest(auth_header, f"Bearer {METRICS_TOKEN}".encode())
+
+async def _handle(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        auth = b""
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            k, _, v = line.partition(b":")
+            if k.strip().lower() == b"authorization":
+                auth = v.strip()
+        parts = request.split()
+        if len(parts) < 2 or parts[1] != b"/metrics":
+            status, body = "404 Not Found", b"not found\n"
+        elif not authorized(auth):
+            status, body = "403 Forbidden", b"forbidden\n"
+        else:
+            status, body = "200 OK", (await render()).encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_server(port: int = METRICS_PORT, host: str = "0.0.0.0"):
+    global _server
+    if port and _server is None:
+        _server = await asyncio.start_server(_handle, host, port)
+
+async def stop_server():
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
@@ -46,18 +46,45 @@ CREATE TABLE IF NOT EXISTS bookings (
     status TEXT NOT NULL DEFAULT 'pending', -- pending|paid|cancelled|expired
     token TEXT,                -- generated on paid
     expires_at TEXT,           -- when a pending hold expires
-    created_at TEXT NOT NULL DEFAULT (datetime('now'))
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    starts_ts INTEGER,         -- unix seconds mirrors of the ISO columns;
+    ends_ts INTEGER,           -- all overlap / expiry queries use these
+    expires_ts INTEGER
 );
 
 -- ---------- Indexes ----------
-CREATE INDEX IF NOT EXISTS idx_bookings_time
-    ON bookings(resource_id, starts_at, ends_at);
-
 CREATE INDEX IF NOT EXISTS idx_bookings_status
     ON bookings(status);
 
+CREATE INDEX IF NOT EXISTS idx_bookings_live
+    ON bookings(resource_id, starts_ts, ends_ts, status, expires_ts)
+    WHERE status IN ('paid','pending');
+
+CREATE INDEX IF NOT EXISTS idx_bookings_hold_expiry
+    ON bookings(expires_ts) WHERE status = 'pending';
+
+CREATE INDEX IF NOT EXISTS idx_bookings_recent
+    ON bookings(starts_ts);
+
+CREATE INDEX IF NOT EXISTS idx_bookings_paid_recent
+    ON bookings(starts_ts) WHERE status = 'paid';
+
 CREATE TABLE IF NOT EXISTS mutes (
   tg_user_id INTEGER PRIMARY KEY,
   until TEXT NOT NULL -- ISO8601 with timezone
 );
 
+-- ---------- Bot persistence (persistence.py) ----------
+CREATE TABLE IF NOT EXISTS persist_user_data (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,            -- JSON of context.user_data
+    updated_ts INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS persist_conversations (
+    name TEXT NOT NULL,            -- ConversationHandler name
+    key TEXT NOT NULL,             -- JSON of the (chat_id, user_id) key
+    state TEXT NOT NULL,           -- JSON of the state
+    updated_ts INTEGER NOT NULL,
+    PRIMARY KEY (name, key)
+);
@@ -0,0 +1,269 @@
+# outbox.py
+# Central outbound dispatcher. Handlers enqueue a send and return at once; one
+# worker drains the queue under Telegram's flood limits (~30 msg/s per bot,
+# ~1 msg/s per private chat, ~20 msg/min per group):
+#   - global + per-chat token buckets
+#   - priority lanes (HIGH user confirmations before LOW group notices)
+#   - per-chat FIFO, so messages to one chat never overtake each other
+#   - RetryAfter (429) pauses only the chat that hit it, then retries
+#   - plain-text group notices queued behind each other are merged into one
+import os, time, heapq, asyncio, logging
+from collections import deque
+from typing import Optional
+
+from telegram.error import RetryAfter, NetworkError
+
+import metrics
+
+log = logging.getLogger("booking-bot.outbox")
+
+OUTBOX_GLOBAL_PER_SEC = float(os.getenv("OUTBOX_GLOBAL_PER_SEC", "25"))
+OUTBOX_CHAT_PER_SEC = float(os.getenv("OUTBOX_CHAT_PER_SEC", "1"))
+OUTBOX_GROUP_PER_MIN = float(os.getenv("OUTBOX_GROUP_PER_MIN", "18"))
+OUTBOX_CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", "3"))
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "3"))
+OUTBOX_DRAIN_SEC = float(os.getenv("OUTBOX_DRAIN_SEC", "10"))
+
+HIGH, NORMAL, LOW = 0, 1, 2
+MAX_TEXT = 4096  # Telegram message length limit (coalesced texts stay under it)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.t = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.t) * self.rate)
+        self.t = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until one token is available (0 = now)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Job:
+    __slots__ = ("method", "kwargs", "priority", "coalesce", "futures", "attempts")
+
+    def __init__(self, method, kwargs, priority, coalesce, fut):
+        self.method = method
+        self.kwargs = kwargs
+        self.priority = priority
+        self.coalesce = coalesce
+        self.futures = [fut]
+        self.attempts = 0
+
+
+def _swallow(fut: asyncio.Future):
+    # callers may fire-and-forget; failures are already logged by the worker
+    if not fut.cancelled():
+        fut.exception()
+
+
+class Outbox:
+    def __init__(self):
+        self.bot = None
+        self._global = TokenBucket(OUTBOX_GLOBAL_PER_SEC, OUTBOX_GLOBAL_PER_SEC)
+        self._buckets = {}       # chat_id -> TokenBucket
+        self._chats = {}         # chat_id -> deque[_Job]
+        self._ready = []         # heap (priority, seq, chat_id): may send now
+        self._waiting = []       # heap (ready_at, seq, chat_id): throttled / paused
+        self._scheduled = set()  # chat_ids present in _ready or _waiting
+        self._busy = set()       # chat_ids with a request in flight
+        self._paused = {}        # chat_id -> monotonic time a RetryAfter ends
+        self._tasks = set()
+        self._seq = 0
+        self._wake = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._worker: Optional[asyncio.Task] = None
+        self.counts = {"sent": 0, "failed": 0, "retried": 0, "coalesced": 0}
+        self.errors = {}         # exception class name -> count (failed + retried)
+
+    # ---------- public ----------
+    def start(self, bot):
+        self.bot = bot
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run(), name="outbox")
+
+    async def join(self):
+        """Wait until every queued send has been delivered or failed."""
+        await self._idle.wait()
+
+    async def stop(self, timeout: float = OUTBOX_DRAIN_SEC):
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            log.warning("outbox: shutting down with %d unsent messages", self.pending())
+        self._worker.cancel()
+        for t in list(self._tasks):
+            t.cancel()
+        await asyncio.gather(self._worker, *self._tasks, return_exceptions=True)
+        for q in self._chats.values():
+            for job in q:
+                for f in job.futures:
+                    f.cancel()
+        self.__init__()
+
+    def pending(self) -> int:
+        return sum(len(q) for q in self._chats.values()) + len(self._busy)
+
+    def enqueue(self, method: str, chat_id: int, priority: int = NORMAL,
+                coalesce: bool = False, **kwargs) -> asyncio.Future:
+        """Queue bot.<method>(chat_id=chat_id, **kwargs). Returns a future with
+        the API result; callers may await it or ignore it."""
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(_swallow)
+        q = self._chats.setdefault(chat_id, deque())
+        coalesce = coalesce and method == "send_message" and "reply_markup" not in kwargs
+        tail = q[-1] if q else None
+        if (coalesce and tail is not None and tail.coalesce
+                and tail.kwargs.get("parse_mode") == kwargs.get("parse_mode")
+                and len(tail.kwargs["text"]) + 2 + len(kwargs["text"]) <= MAX_TEXT):
+            # still waiting for its turn: ride along instead of costing another message
+            tail.kwargs["text"] += "\n\n" + kwargs["text"]
+            tail.futures.append(fut)
+            self.counts["coalesced"] += 1
+            return fut
+        q.append(_Job(method, kwargs, priority, coalesce, fut))
+        self._idle.clear()
+        self._schedule(chat_id)
+        return fut
+
+    # ---------- scheduling ----------
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        b = self._buckets.get(chat_id)
+        if b is None:
+            rate = OUTBOX_CHAT_PER_SEC if chat_id > 0 else OUTBOX_GROUP_PER_MIN / 60
+            b = self._buckets[chat_id] = TokenBucket(rate, OUTBOX_CHAT_BURST)
+        return b
+
+    def _schedule(self, chat_id: int):
+        if chat_id in self._scheduled or chat_id in self._busy or not self._chats.get(chat_id):
+            return
+        now = time.monotonic()
+        ready_at = max(now + self._bucket(chat_id).delay(now), self._paused.get(chat_id, 0))
+        self._seq += 1
+        if ready_at <= now:
+            heapq.heappush(self._ready, (self._chats[chat_id][0].priority, self._seq, chat_id))
+        else:
+            heapq.heappush(self._waiting, (ready_at, self._seq, chat_id))
+        self._scheduled.add(chat_id)
+        self._wake.set()
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._waiting and self._waiting[0][0] <= now:
+                _, seq, chat_id = heapq.heappop(self._waiting)
+                heapq.heappush(self._ready, (self._chats[chat_id][0].priority, seq, chat_id))
+            if not self._ready:
+                timeout = self._waiting[0][0] - now if self._waiting else None
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            d = self._global.delay(now)
+            if d > 0:
+                await asyncio.sleep(d)
+                continue
+            _, _, chat_id = heapq.heappop(self._ready)
+            self._scheduled.discard(chat_id)
+            job = self._chats[chat_id].popleft()
+            self._global.take(now)
+            self._bucket(chat_id).take(now)
+            self._busy.add(chat_id)
+            task = asyncio.create_task(self._deliver(chat_id, job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, chat_id: int, job: _Job):
+        try:
+            result = await getattr(self.bot, job.method)(chat_id=chat_id, **job.kwargs)
+        except RetryAfter as e:
+            ra = e.retry_after
+            wait = ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+            self._retry_or_fail(chat_id, job, e, wait)
+        except NetworkError as e:  # includes TimedOut
+            self._retry_or_fail(chat_id, job, e, 2 ** job.attempts)
+        except Exception as e:  # Forbidden (user blocked the bot), BadRequest, ...
+            self._fail(chat_id, job, e)
+        else:
+            self.counts["sent"] += 1
+            for f in job.futures:
+                if not f.done():
+                    f.set_result(result)
+        finally:
+            self._busy.discard(chat_id)
+            if self._chats.get(chat_id):
+                self._schedule(chat_id)
+            else:
+                self._chats.pop(chat_id, None)
+                if not self._chats and not self._busy:
+                    self._idle.set()
+
+    def _retry_or_fail(self, chat_id: int, job: _Job, err: Exception, wait: float):
+        job.attempts += 1
+        self.errors[type(err).__name__] = self.errors.get(type(err).__name__, 0) + 1
+        if job.attempts > OUTBOX_MAX_RETRIES:
+            self._fail(chat_id, job, err)
+            return
+        log.info("outbox: %s to %s retrying in %.1fs (%s)", job.method, chat_id, wait, err)
+        self.counts["retried"] += 1
+        self._paused[chat_id] = time.monotonic() + wait
+        self._chats.setdefault(chat_id, deque()).appendleft(job)
+
+    def _fail(self, chat_id: int, job: _Job, err: Exception):
+        log.warning("outbox: %s to %s failed: %s", job.method, chat_id, err)
+        self.counts["failed"] += 1
+        if not isinstance(err, (RetryAfter, NetworkError)):  # those were counted on retry
+            self.errors[type(err).__name__] = self.errors.get(type(err).__name__, 0) + 1
+        for f in job.futures:
+            if not f.done():
+                f.set_exception(err)
+
+
+_outbox = Outbox()
+
+def start(bot):
+    _outbox.start(bot)
+
+async def stop():
+    await _outbox.stop()
+
+async def join():
+    await _outbox.join()
+
+def stats() -> dict:
+    return {**_outbox.counts, "pending": _outbox.pending()}
+
+metrics.gauge("booking_outbox_messages_total", "Outbox jobs by outcome",
+              lambda: {(k,): v for k, v in _outbox.counts.items()}, ("result",), type="counter")
+metrics.gauge("booking_outbox_errors_total", "Outbound API errors by exception class",
+              lambda: {(k,): v for k, v in _outbox.errors.items()}, ("error",), type="counter")
+metrics.gauge("booking_outbox_pending", "Queued or in-flight outbound sends", lambda: _outbox.pending())
+
+def send_message(chat_id: int, text: str, priority: int = NORMAL, coalesce: bool = False, **kwargs):
+    return _outbox.enqueue("send_message", chat_id, priority, coalesce, text=text, **kwargs)
+
+def send_photo(chat_id: int, photo, priority: int = NORMAL, **kwargs):
+    return _outbox.enqueue("send_photo", chat_id, priority, photo=photo, **kwargs)
+
+def send_media_group(chat_id: int, media: list, priority: int = NORMAL, **kwargs):
+    # one call for a whole album (2-10 items); the future gets the tuple of Messages
+    return _outbox.enqueue("send_media_group", chat_id, priority, media=media, **kwargs)
+
+def copy_message(chat_id: int, from_chat_id: int, message_id: int, priority: int = NORMAL, **kwargs):
+    return _outbox.enqueue("copy_message", chat_id, priority,
+                           from_chat_id=from_chat_id, message_id=message_id, **kwargs)
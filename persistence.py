@@ -0,0 +1,164 @@
+# persistence.py
+# Keeps the booking conversation and context.user_data across restarts, in
+# the bot's own SQLite file (one row per user / conversation key).
+#
+# PTB calls update_*() for what changed, every PERSIST_FLUSH_SEC. Those calls
+# only stage rows here; the staged batch is written in one transaction on the
+# DB thread. user_data is not loaded at startup: refresh_user_data() pulls a
+# user's row the first time one of their updates arrives.
+import os, json, time, asyncio, logging
+from datetime import date, datetime
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import async_db
+
+log = logging.getLogger("booking-bot.persistence")
+
+PERSIST_FLUSH_SEC = float(os.getenv("PERSIST_FLUSH_SEC", "5"))
+# conversation states older than this are stale (the user moved on); not restored
+PERSIST_CONVERSATION_TTL_SEC = int(os.getenv("PERSIST_CONVERSATION_TTL_SEC", "86400"))
+
+
+# user_data holds plain values plus the picked date; JSON keeps the rows readable
+def _default(o):
+    if isinstance(o, datetime):
+        return {"$dt": o.isoformat()}
+    if isinstance(o, date):
+        return {"$date": o.isoformat()}
+    raise TypeError(f"cannot persist {type(o).__name__}")
+
+def _hook(d):
+    if len(d) == 1:
+        if "$dt" in d:
+            return datetime.fromisoformat(d["$dt"])
+        if "$date" in d:
+            return date.fromisoformat(d["$date"])
+    return d
+
+def dumps(value) -> str:
+    return json.dumps(value, default=_default, separators=(",", ":"))
+
+def loads(text: str):
+    return json.loads(text, object_hook=_hook)
+
+
+class SQLitePersistence(BasePersistence):
+    def __init__(self, update_interval: float = PERSIST_FLUSH_SEC):
+        # chat_data (admin reply sessions) and bot_data are not persisted
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False,
+                                                     user_data=True, callback_data=False),
+                         update_interval=update_interval)
+        self._loaded = set()    # user ids whose row has been merged into user_data
+        self._loading = {}      # user_id -> in-flight read
+        self._users = {}        # user_id -> json, staged
+        self._dropped = set()
+        self._convs = {}        # (name, key_json) -> state json | None (ended)
+        self._writer = None
+
+    # ---------- reads ----------
+    async def get_user_data(self):
+        return {}  # restored per user in refresh_user_data
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        if user_id in self._loaded:
+            return
+        # concurrent first updates from one user share a single read
+        task = self._loading.get(user_id)
+        if task is None:
+            task = self._loading[user_id] = asyncio.ensure_future(async_db.load_user_data(user_id))
+        try:
+            raw = await task
+        finally:
+            self._loading.pop(user_id, None)
+        if user_id not in self._loaded:
+            self._loaded.add(user_id)
+            if raw:
+                for k, v in loads(raw).items():
+                    user_data.setdefault(k, v)
+
+    async def get_conversations(self, name: str):
+        rows = await async_db.load_conversations(name, int(time.time()) - PERSIST_CONVERSATION_TTL_SEC)
+        return {tuple(json.loads(k)): loads(st) for k, st in rows}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # ---------- writes (staged) ----------
+    async def update_user_data(self, user_id: int, data: dict):
+        self._loaded.add(user_id)  # what PTB holds is now the truth for this user
+        self._dropped.discard(user_id)
+        try:
+            self._users[user_id] = dumps(data)
+        except TypeError as e:
+            log.warning("user_data of %s not persisted: %s", user_id, e)
+            return
+        self._schedule()
+
+    async def drop_user_data(self, user_id: int):
+        self._users.pop(user_id, None)
+        self._dropped.add(user_id)
+        self._schedule()
+
+    async def update_conversation(self, name: str, key, new_state):
+        self._convs[name, json.dumps(list(key))] = None if new_state is None else dumps(new_state)
+        self._schedule()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    # ---------- flushing ----------
+    def _schedule(self):
+        # PTB gathers one update_*() per dirty key; the writer starts after
+        # they have all staged, so one flush round is one transaction
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.get_running_loop().create_task(self._drain())
+
+    async def _drain(self):
+        await asyncio.sleep(0)
+        while self._users or self._dropped or self._convs:
+            users, self._users = self._users, {}
+            dropped, self._dropped = self._dropped, set()
+            convs, self._convs = self._convs, {}
+            try:
+                await async_db.save_persistence(
+                    list(users.items()), list(dropped),
+                    [(n, k, st) for (n, k), st in convs.items() if st is not None],
+                    [(n, k) for (n, k), st in convs.items() if st is None],
+                    int(time.time()) - PERSIST_CONVERSATION_TTL_SEC,
+                )
+            except Exception:
+                log.exception("persistence flush failed; retrying next round")
+                # put back what was not superseded meanwhile
+                for k, v in users.items():
+                    self._users.setdefault(k, v)
+                self._dropped |= dropped - self._users.keys()
+                for k, v in convs.items():
+                    self._convs.setdefault(k, v)
+                return
+
+    async def flush(self):
+        if self._writer is not None:
+            await self._writer
+        await self._drain()
@@ -0,0 +1,168 @@
+# reminders.py
+# Reminders before paid bookings start, at each of REMINDER_OFFSETS_MIN
+# (default 24h and 1h). Upcoming paid bookings are loaded once at startup;
+# after that, paying or cancelling a booking pushes to / drops from the heap,
+# O(log n), and no table is ever scanned on a timer.
+#
+#   - heap of (fire_ts, booking_id, offset_min, seq); a cancelled booking's entries
+#     stay in the heap and are skipped when they surface (compacted once most
+#     of the heap is stale)
+#   - one task sleeps until the earliest entry is due; everything due then is
+#     sent in one round through the outbox: one message per user, plus one
+#     "starting soon" list for the admin group at the last offset
+#   - after downtime, reminders missed by up to REMINDER_GRACE_MIN still go out
+import os, time, heapq, asyncio, logging, itertools
+from datetime import datetime
+
+import outbox
+import metrics
+from utils import TZ
+from async_db import upcoming_paid
+
+log = logging.getLogger("booking-bot.reminders")
+
+ADMIN_GROUP_ID = int(os.environ["ADMIN_GROUP_ID"])
+REMINDER_OFFSETS_MIN = sorted({int(x) for x in os.getenv("REMINDER_OFFSETS_MIN", "1440,60").split(",") if x.strip()},
+                              reverse=True)  # empty = reminders off
+REMINDER_GRACE_MIN = int(os.getenv("REMINDER_GRACE_MIN", "10"))
+
+SENT = metrics.Counter("booking_reminders_sent_total", "Booking reminders sent to users")
+
+def _in(seconds: float) -> str:
+    m = max(0, round(seconds / 60))
+    if m < 60:
+        return f"{m} min"
+    h, m = divmod(m, 60)
+    return f"{h}h {m}min" if m else f"{h}h"
+
+
+class Reminders:
+    def __init__(self):
+        self._heap = []       # (fire_ts, booking_id, offset_min, seq)
+        self._bookings = {}   # booking_id -> [user_id, starts_ts, what, token, entries left, seq]
+        self._seq = itertools.count()  # tells a re-added booking's entries from its old ones
+        self._stale = 0       # heap entries of removed bookings
+        self._wake = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._heap) - self._stale
+
+    # ---------- updates ----------
+    def add(self, bid: int, user_id: int, starts_ts: int, what: str, token, now: float = None):
+        now = time.time() if now is None else now
+        self.remove(bid)
+        earliest = now - REMINDER_GRACE_MIN * 60
+        fires = [(starts_ts - off * 60, off) for off in REMINDER_OFFSETS_MIN]
+        fires = [(at, off) for at, off in fires if at > earliest and starts_ts > now]
+        if not fires:
+            return
+        seq = next(self._seq)
+        self._bookings[bid] = [user_id, starts_ts, what, token, len(fires), seq]
+        top = self._heap[0][0] if self._heap else None
+        for at, off in fires:
+            heapq.heappush(self._heap, (at, bid, off, seq))
+        if self._wake is not None and (top is None or self._heap[0][0] < top):
+            self._wake.set()  # a new earliest entry: re-arm the sleep
+
+    def remove(self, bid: int):
+        b = self._bookings.pop(bid, None)
+        if b is None:
+            return
+        self._stale += b[4]
+        if self._stale > 1000 and self._stale * 2 > len(self._heap):
+            self._heap = [e for e in self._heap if self._live(e)]
+            heapq.heapify(self._heap)
+            self._stale = 0
+
+    def load(self, rows, now: float = None):
+        """rows: (id, user_id, starts_ts, service, resource, token), e.g. db.upcoming_paid."""
+        for bid, uid, st, svc, res, token in rows:
+            self.add(bid, uid, st, f"{svc} / {res}", token, now)
+
+    def _live(self, entry) -> bool:
+        b = self._bookings.get(entry[1])
+        return b is not None and b[5] == entry[3]
+
+    # ---------- firing ----------
+    def due(self, now: float) -> list:
+        """Pop every entry due by now: [(booking_id, offset_min, user_id, starts_ts, what, token)]."""
+        out, h = [], self._heap
+        while h and h[0][0] <= now:
+            entry = heapq.heappop(h)
+            if not self._live(entry):
+                self._stale -= 1
+                continue
+            _, bid, off, _ = entry
+            b = self._bookings[bid]
+            b[4] -= 1
+            if not b[4]:
+                del self._bookings[bid]
+            out.append((bid, off, *b[:4]))
+        return out
+
+    def _send(self, batch: list, now: float):
+        per_user = {}
+        for bid, off, uid, st, what, token in batch:
+            when = datetime.fromtimestamp(st, TZ)
+            per_user.setdefault(uid, []).append(
+                f"⏰ Reminder: booking #{bid} – {what}\n"
+                f"Starts {when:%d %b, %I:%M %p} (in {_in(st - now)})\nToken: {token or '-'}")
+        for uid, lines in per_user.items():
+            outbox.send_message(uid, "\n\n".join(lines), priority=outbox.NORMAL)
+        SENT.inc(n=len(batch))
+        last = REMINDER_OFFSETS_MIN[-1]
+        soon = [f"#{bid} {what} – {datetime.fromtimestamp(st, TZ):%I:%M %p} [{uid}]"
+                for bid, off, uid, st, what, token in batch if off == last]
+        if soon:
+            outbox.send_message(ADMIN_GROUP_ID, f"⏰ Starting within {_in(last * 60)}:\n" + "\n".join(soon),
+                                priority=outbox.LOW, coalesce=True)
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            batch = self.due(now)
+            if batch:
+                self._send(batch, now)
+            # wall-clock target; re-checked at least hourly in case the clock jumps
+            delay = min(self._heap[0][0] - now, 3600) if self._heap else 3600
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), max(0.0, delay))
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        if not REMINDER_OFFSETS_MIN:
+            return
+        self._wake = asyncio.Event()
+        now = time.time()
+        self.load(await upcoming_paid(int(now)), now)
+        log.info("reminders: %d pending for %d bookings", len(self), len(self._bookings))
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+_reminders = Reminders()
+
+async def start():
+    await _reminders.start()
+
+async def stop():
+    await _reminders.stop()
+
+def add(bid: int, user_id: int, starts_ts: int, what: str, token):
+    _reminders.add(bid, user_id, starts_ts, what, token)
+
+def remove(bid: int):
+    _reminders.remove(bid)
+
+metrics.gauge("booking_reminders_pending", "Reminders waiting in the heap", lambda: len(_reminders))
@@ -1,5 +1,5 @@
 import os
-from db import init_db, conn_ctx
+from db import init_db, upsert_service, upsert_resource
 
 # Initialize schema
 init_db()
@@ -20,29 +20,11 @@ r2_cap = int(os.environ.get("DEFAULT_RESOURCE_2_CAPACITY", "2"))
 r2_open = os.environ.get("DEFAULT_RESOURCE_2_OPEN", "10:00")
 r2_close = os.environ.get("DEFAULT_RESOURCE_2_CLOSE", "18:00")
 
-with conn_ctx() as conn:
-    # Service
-    conn.execute(
-        "INSERT OR IGNORE INTO services(name, default_duration_min, price, step_min, active) "
-        "VALUES (?,?,?,?,1)",
-        (svc_name, dur, price, step),
-    )
-    sid = conn.execute(
-        "SELECT id FROM services WHERE name = ?",
-        (svc_name,),
-    ).fetchone()[0]
+# Service
+sid = upsert_service(svc_name, dur, price, step)
 
-    # Resources
-    conn.execute(
-        "INSERT OR IGNORE INTO resources(service_id, name, capacity, open_time, close_time, active) "
-        "VALUES (?,?,?,?,?,1)",
-        (sid, r1, r1_cap, r1_open, r1_close),
-    )
-    conn.execute(
-        "INSERT OR IGNORE INTO resources(service_id, name, capacity, open_time, close_time, active) "
-        "VALUES (?,?,?,?,?,1)",
-        (sid, r2, r2_cap, r2_open, r2_close),
-    )
-    conn.commit()
+# Resources
+upsert_resource(sid, r1, r1_cap, r1_open, r1_close)
+upsert_resource(sid, r2, r2_cap, r2_open, r2_close)
 
 print("Seeded default service and resources.")
@@ -0,0 +1,9 @@
+# conftest.py
+# Tests import the flat modules from the repo root against a throwaway DB;
+# each test in test_availability.py points db.DB_PATH at its own file.
+import os, sys, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="booking-test-"), "test.db")
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("ADMIN_GROUP_ID", "-1001")
@@ -0,0 +1,211 @@
+# test_availability.py
+# Oversell and index-vs-SQL parity checks (formerly asserts inside bench.py).
+# Every query is run twice, AVAILABILITY_INDEX on and off, and must agree.
+import random, threading
+from datetime import datetime, timedelta, date
+
+import pytest
+
+import db
+from availability import free_slots
+from utils import TZ, parse_hhmm
+
+@pytest.fixture(autouse=True)
+def fresh_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "test.db"))
+    monkeypatch.setattr(db, "AVAILABILITY_INDEX", True)
+    db.invalidate_cache()
+    db.init_db()
+    db.load_availability()
+    yield
+    db.close_conn()
+    db.invalidate_cache()
+
+def _catalog(capacity=1, resources=1, open_t="09:00", close_t="17:00"):
+    sid = db.upsert_service("Test", 30, 100, 15)
+    rids = [db.upsert_resource(sid, f"R{i}", capacity, open_t, close_t) for i in range(resources)]
+    return sid, rids
+
+def _insert_paid(rows):
+    """rows: (resource_id, start datetime, end datetime); written behind db.py's back, then reloaded."""
+    with db.conn_ctx() as conn:
+        conn.executemany("""INSERT INTO bookings(service_id,resource_id,tg_user_id,starts_at,ends_at,amount,
+                            status,starts_ts,ends_ts)
+                            SELECT service_id,?,1,?,?,1,'paid',?,? FROM resources WHERE id=?""",
+                         [(r, s.isoformat(), e.isoformat(), int(s.timestamp()), int(e.timestamp()), r)
+                          for r, s, e in rows])
+        conn.commit()
+    db.load_availability()
+
+def _both(fn, monkeypatch):
+    """fn() with the in-memory index, then from SQLite; asserts they agree."""
+    out = []
+    for indexed in (True, False):
+        monkeypatch.setattr(db, "AVAILABILITY_INDEX", indexed)
+        db.invalidate_cache("days")
+        out.append(fn())
+    monkeypatch.setattr(db, "AVAILABILITY_INDEX", True)
+    assert out[0] == out[1]
+    return out[0]
+
+def _at(d, hhmm):
+    return TZ.localize(datetime.combine(d, parse_hhmm(hhmm)))
+
+# ---------- oversell ----------
+def test_racing_holds_never_oversell():
+    sid, (rid,) = _catalog(capacity=1, open_t="00:00", close_t="23:59")
+    base = _at(date(2031, 3, 1), "10:00")
+    threads = 16
+    for rnd in range(5):
+        s = base + timedelta(hours=rnd); e = s + timedelta(minutes=30)
+        # overlapping but not identical windows still compete for the same seat
+        windows = [(s + timedelta(minutes=i % 3 * 5), e + timedelta(minutes=i % 3 * 5)) for i in range(threads)]
+        gate = threading.Barrier(threads)
+        won = []
+
+        def worker(i):
+            ws, we = windows[i]
+            gate.wait()
+            try:
+                bid = db.create_pending_booking(i, "t", sid, rid, ws.isoformat(), we.isoformat(), 100, "cash", None)
+                if bid:
+                    won.append(bid)
+            finally:
+                db.close_conn()
+
+        pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        for t in pool: t.start()
+        for t in pool: t.join()
+        assert len(won) == 1
+        assert db.count_overlapping(rid, s.isoformat(), (e + timedelta(minutes=10)).isoformat()) == 1
+
+def test_lapsed_hold_not_paid_into_a_taken_seat():
+    sid, (rid,) = _catalog(capacity=1, open_t="00:00", close_t="23:59")
+    st = db.now_tz().replace(microsecond=0) + timedelta(days=1); en = st + timedelta(minutes=30)
+    b1 = db.create_pending_booking(1, "a", sid, rid, st.isoformat(), en.isoformat(), 1, "bkash", "TX1234")
+    with db.conn_ctx() as conn:
+        conn.execute("UPDATE bookings SET expires_ts=? WHERE id=?", (int(db.now_tz().timestamp()) - 5, b1))
+        conn.commit()
+    db.expire_holds()
+    b2 = db.create_pending_booking(2, "b", sid, rid, st.isoformat(), en.isoformat(), 1, "cash", None)
+    assert b2
+    assert not db.mark_paid(b1, "T1")
+    db.cancel_booking(b2)
+    assert db.mark_paid(b1, "T1")
+    assert db.get_booking(b1)[12] == "paid"
+    assert not db.create_pending_booking(3, "c", sid, rid, st.isoformat(), en.isoformat(), 1, "cash", None)
+    assert db.check_availability(repair=False) == 0
+
+# ---------- index vs SQL parity ----------
+def test_day_slots_and_overlap_parity(monkeypatch):
+    sid, rids = _catalog(capacity=2, resources=3, open_t="00:00", close_t="23:59")
+    rnd = random.Random(1)
+    d = date(2030, 1, 15)
+    _insert_paid([(rnd.choice(rids), s, s + timedelta(minutes=rnd.choice((15, 30, 90))))
+                  for s in (_at(d, "00:00") + timedelta(minutes=15 * rnd.randrange(96)) for _ in range(120))])
+    day_start, day_end = _at(d, "00:00"), _at(d, "23:59")
+    for rid in rids:
+        _both(lambda: db.available_slots(rid, day_start, day_end, 30, 15, 2), monkeypatch)
+    for _ in range(200):
+        s = day_start + timedelta(minutes=rnd.randrange(0, 1440, 5)); e = s + timedelta(minutes=rnd.choice((15, 30, 90)))
+        rid = rnd.choice(rids)
+        _both(lambda: db.count_overlapping(rid, s.isoformat(), e.isoformat()), monkeypatch)
+
+def test_index_tracks_writes():
+    sid, rids = _catalog(capacity=2, resources=4, open_t="00:00", close_t="23:59")
+    rnd = random.Random(2)
+    base = _at(date(2030, 6, 1), "00:00")
+    made = []
+    for _ in range(200):
+        s = base + timedelta(minutes=rnd.randrange(0, 3 * 1440, 15)); e = s + timedelta(minutes=30)
+        bid = db.create_pending_booking(1, "b", sid, rnd.choice(rids), s.isoformat(), e.isoformat(), 1, "cash", None)
+        if bid:
+            made.append(bid)
+    for bid in made[::3]:
+        assert db.mark_paid(bid, "T")
+    for bid in made[1::3]:
+        db.cancel_booking(bid)
+    for _ in range(500):
+        s = base + timedelta(minutes=rnd.randrange(0, 3 * 1440, 5)); e = s + timedelta(minutes=rnd.choice((15, 30, 90)))
+        rid = rnd.choice(rids)
+        with db.conn_ctx() as conn:
+            want = db._count_overlapping(conn, rid, int(s.timestamp()), int(e.timestamp()))
+        assert db._overlapping_from_index(rid, s.isoformat(), e.isoformat()) == want
+    assert db.check_availability(repair=False) == 0
+
+def test_month_full_days_matches_per_day(monkeypatch):
+    sid, (rid,) = _catalog(capacity=1)
+    year, month = 2030, 3
+    rows = []
+    for day in range(1, 32):
+        cur = _at(date(year, month, day), "09:00")
+        every = 30 if day % 3 else 60  # every third day keeps free slots
+        while cur.hour < 17:
+            rows.append((rid, cur, cur + timedelta(minutes=30)))
+            cur += timedelta(minutes=every)
+    _insert_paid(rows)
+    full = _both(lambda: db.month_full_days(rid, year, month, "09:00", "17:00", 30, 15, 1), monkeypatch)
+    per_day = frozenset(d for d in (date(year, month, i) for i in range(1, 32))
+                        if not db.available_slots(rid, _at(d, "09:00"), _at(d, "17:00"), 30, 15, 1))
+    assert full == per_day and len(full) == 21
+
+def test_earliest_slots_matches_probing(monkeypatch):
+    sid, rids = _catalog(capacity=1, resources=4)
+    today, days_ahead, n = db.now_tz().date(), 30, 8
+    rows = []
+    # every resource booked solid for three weeks, a few gaps after that
+    for i, rid in enumerate(rids):
+        for day in range(days_ahead + 1):
+            cur = _at(today + timedelta(days=day), "09:00")
+            while cur.hour < 17:
+                e = cur + timedelta(minutes=30)
+                if day < 21 or (cur.minute, cur.hour % 3, i % 2) != (0, 0, 0):
+                    rows.append((rid, cur, e))
+                cur = e
+    _insert_paid(rows)
+    now = db.now_tz()
+
+    def probe():
+        found = []
+        for day in range(days_ahead + 1):
+            d = today + timedelta(days=day)
+            for rid, name, cap, o, c in db.list_resources(sid):
+                found += [(st, rid, name, en) for st, en in db.available_slots(rid, _at(d, o), _at(d, c), 30, 15, cap)
+                          if st >= now]
+            if len(found) >= n:
+                break
+        return [(rid, name, st, en) for st, rid, name, en in sorted(found)[:n]]
+    merged = _both(lambda: db.earliest_slots(sid, n, days_ahead), monkeypatch)
+    assert merged == probe() and len(merged) == n
+    assert all(st.date() >= today + timedelta(days=21) for _, _, st, _ in merged)
+
+def test_any_resource_union_matches_per_resource(monkeypatch):
+    sid, rids = _catalog(capacity=2, resources=5, open_t="08:00", close_t="22:00")
+    d = date(2030, 2, 4)
+    rnd = random.Random(7)
+    _insert_paid([(rid, s, s + timedelta(minutes=30))
+                  for rid in rids for s in (_at(d, "08:00") + timedelta(minutes=15 * rnd.randrange(52)) for _ in range(40))])
+    def per_resource():
+        out = set()
+        for rid, name, cap, o, c in db.list_resources(sid):
+            out.update(db.available_slots(rid, _at(d, o), _at(d, c), 30, 15, cap))
+        return sorted(out)
+    assert _both(lambda: db.available_slots_any(sid, d, 30, 15), monkeypatch) == per_resource()
+
+# ---------- closed (capacity 0) resources ----------
+def test_free_slots_capacity_zero():
+    assert list(free_slots([], [], [(0, 3600)], 1800, 900, 0)) == []
+    assert list(free_slots([0], [1800], [(0, 3600)], 1800, 900, 0)) == []
+
+def test_closed_resource_offers_nothing(monkeypatch):
+    sid, (open_rid, closed_rid) = _catalog(capacity=1, resources=2)
+    with db.conn_ctx() as conn:
+        conn.execute("UPDATE resources SET capacity=0 WHERE id=?", (closed_rid,))
+        conn.commit()
+    db.invalidate_cache()
+    d = db.now_tz().date() + timedelta(days=2)
+    assert _both(lambda: db.available_slots(closed_rid, _at(d, "09:00"), _at(d, "17:00"), 30, 15, 0), monkeypatch) == []
+    slots = _both(lambda: db.earliest_slots(sid, 5, 7), monkeypatch)
+    assert len(slots) == 5 and all(rid == open_rid for rid, *_ in slots)
+    assert _both(lambda: db.available_slots_any(sid, d, 30, 15), monkeypatch) == \
+        db.available_slots(open_rid, _at(d, "09:00"), _at(d, "17:00"), 30, 15, 1)
@@ -0,0 +1,122 @@
+# throttle.py
+# Per-user flood control for private chats, run as handler group -1 so excess
+# updates stop before any handler (auto-Q/A, KV reads, group forwards) runs.
+#
+#   - each user has a token bucket: THROTTLE_BURST updates at once, refilled
+#     at THROTTLE_RATE per second; over it, updates are dropped
+#   - the first drop of a burst gets one "slow down" notice, the rest are silent
+#   - THROTTLE_BAN_AFTER drops without calming down = banned for
+#     THROTTLE_BAN_MIN minutes, stored in the mutes table (survives restarts)
+#
+# The admin group is never throttled.
+import os, time, logging
+from datetime import datetime
+
+from telegram import Update
+from telegram.constants import ChatType
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+import outbox
+import metrics
+from outbox import TokenBucket
+from utils import TZ
+from async_db import mute_user, active_mutes
+
+log = logging.getLogger("booking-bot.throttle")
+
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "0.5"))     # updates/sec sustained; 0 = no rate limit
+THROTTLE_BURST = float(os.getenv("THROTTLE_BURST", "8"))
+THROTTLE_BAN_AFTER = int(os.getenv("THROTTLE_BAN_AFTER", "40"))  # 0 = never ban
+THROTTLE_BAN_MIN = int(os.getenv("THROTTLE_BAN_MIN", "60"))
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "50000"))
+
+if THROTTLE_RATE > 0 and THROTTLE_BURST < 1:
+    raise ValueError("THROTTLE_BURST must be at least 1 (or THROTTLE_RATE=0 to turn rate limiting off)")
+
+# a bucket untouched this long is full again, i.e. the same as a fresh one
+_IDLE_SEC = THROTTLE_BURST / THROTTLE_RATE if THROTTLE_RATE > 0 else 0.0
+
+DROPPED = metrics.Counter("booking_throttled_updates_total", "Private updates dropped by the throttle", ("reason",))
+BANS = metrics.Counter("booking_throttle_bans_total", "Users banned for flooding")
+
+class _User:
+    __slots__ = ("bucket", "seen", "strikes", "last_drop", "album")
+
+    def __init__(self, now: float):
+        self.bucket = TokenBucket(THROTTLE_RATE, THROTTLE_BURST)
+        self.bucket.t = now
+        self.seen = now
+        self.strikes = 0      # drops in the current burst
+        self.last_drop = float("-inf")
+        self.album = None     # media_group_id of the last admitted album
+
+_users = {}    # user_id -> _User
+_banned = {}   # user_id -> until (epoch seconds)
+_prune_at = THROTTLE_MAX_USERS
+
+def check(user_id: int, now: float, album=None) -> str:
+    """'ok', 'drop' (first of a burst: notify), 'quiet' (drop silently),
+    'ban' (just crossed THROTTLE_BAN_AFTER) or 'banned'. Parts of an album
+    (same media_group_id) cost one token together."""
+    until = _banned.get(user_id)
+    if until is not None:
+        if time.time() < until:
+            return "banned"
+        del _banned[user_id]
+    if THROTTLE_RATE <= 0:
+        return "ok"  # rate limiting off; stored bans still apply
+    u = _users.get(user_id)
+    if u is None:
+        u = _users[user_id] = _User(now)
+        if len(_users) > _prune_at:
+            _prune(now)
+    u.seen = now
+    if album is not None and album == u.album:
+        return "ok"
+    b = u.bucket
+    if b.delay(now) == 0:
+        b.take(now)
+        u.album = album
+        return "ok"
+    first = now - u.last_drop > _IDLE_SEC  # no drop for a while: a new burst
+    u.strikes = 1 if first else u.strikes + 1
+    u.last_drop = now
+    if THROTTLE_BAN_AFTER and u.strikes >= THROTTLE_BAN_AFTER:
+        _banned[user_id] = time.time() + THROTTLE_BAN_MIN * 60
+        del _users[user_id]
+        return "ban"
+    return "drop" if first else "quiet"
+
+def _prune(now: float):
+    global _prune_at
+    for uid in [uid for uid, u in _users.items() if now - u.seen > _IDLE_SEC]:
+        del _users[uid]
+    _prune_at = max(THROTTLE_MAX_USERS, 2 * len(_users))
+
+async def load_bans():
+    _banned.update(await active_mutes())
+
+async def guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat, user = update.effective_chat, update.effective_user
+    if chat is None or user is None or chat.type != ChatType.PRIVATE:
+        return
+    album = update.message.media_group_id if update.message else None
+    verdict = check(user.id, time.monotonic(), album)
+    if verdict == "ok":
+        return
+    DROPPED.inc("banned" if verdict == "banned" else "rate")
+    q = update.callback_query
+    if verdict == "drop":
+        if q is not None:
+            await q.answer("⏳ Too many taps, please wait a moment.")
+        else:
+            outbox.send_message(chat.id, "⏳ You're sending messages too fast. Please wait a moment.",
+                                priority=outbox.LOW, coalesce=True)
+    elif verdict == "ban":
+        BANS.inc()
+        until = _banned[user.id]
+        await mute_user(user.id, datetime.fromtimestamp(until, TZ))
+        log.warning("user %s banned for flooding until %s", user.id, datetime.fromtimestamp(until, TZ))
+        outbox.send_message(chat.id, f"🚫 Too many messages. Please try again in {THROTTLE_BAN_MIN} minutes.",
+                            priority=outbox.LOW)
+    raise ApplicationHandlerStop
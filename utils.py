@@ -14,7 +14,9 @@ def parse_hhmm(txt: str):
     return time(hour=h, minute=m)
 
 # --- Calendar keyboard (month grid with prev/next) ---
-def month_keyboard(year: int, month: int, min_date: date, max_date: date) -> InlineKeyboardMarkup:
+def month_keyboard(year: int, month: int, min_date: date, max_date: date,
+                   full=frozenset()) -> InlineKeyboardMarkup:
+    """full: dates with no free slot; shown crossed out and answered without a slot scan."""
     cal = calendar.Calendar(firstweekday=6)  # Sunday
     header = [InlineKeyboardButton(f"{calendar.month_name[month]} {year}", callback_data="IGNORE")]
     week_names = [InlineKeyboardButton(d, callback_data="IGNORE") for d in ["S", "M", "T", "W", "T", "F", "S"]]
@@ -25,6 +27,8 @@ def month_keyboard(year: int, month: int, min_date: date, max_date: date) -> Inl
         for d in week:
             if d.month != month or d < min_date or d > max_date:
                 btns.append(InlineKeyboardButton(" ", callback_data="IGNORE"))
+            elif d in full:
+                btns.append(InlineKeyboardButton(f"{d.day}✕", callback_data=f"FULL:{d.isoformat()}"))
             else:
                 btns.append(InlineKeyboardButton(str(d.day), callback_data=f"DATE:{d.isoformat()}"))
         rows.append(btns)
@@ -47,6 +51,7 @@ def month_keyboard(year: int, month: int, min_date: date, max_date: date) -> Inl
 def main_menu():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📅 Create Booking", callback_data="MENU:CREATE")],
+        [InlineKeyboardButton("⚡ First Available", callback_data="MENU:NEXT")],
         [InlineKeyboardButton("🧾 My Booked", callback_data="MENU:MY")],
         [InlineKeyboardButton("🔄 Restart", callback_data="MENU:RESTART")],
     ])
@@ -55,3 +60,21 @@ def main_menu():
 _word_re = re.compile(r"[^\w\s]", re.UNICODE)
 def normalize_text(s: str) -> str:
     return _word_re.sub(" ", (s or "").lower()).strip()
+
+# --- Compact keyset cursors for callback_data: (starts_ts, id) -> "base36.base36" ---
+_B36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def _to36(n: int) -> str:
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = _B36[r] + out
+        if not n:
+            return out
+
+def encode_cursor(ts: int, row_id: int) -> str:
+    return f"{_to36(int(ts))}.{_to36(int(row_id))}"
+
+def decode_cursor(s: str) -> tuple[int, int]:
+    ts, row_id = s.split(".")
+    return int(ts, 36), int(row_id, 36)
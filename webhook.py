@@ -0,0 +1,169 @@
+# webhook.py
+# Webhook serving mode (BOT_MODE=webhook): a small ASGI app, served by uvicorn,
+# that feeds POSTed updates into the Application's update queue.
+#
+#   POST {WEBHOOK_PATH}  Telegram update JSON; needs the secret-token header
+#   GET  /healthz        200 while serving, 503 while draining
+#   GET  /metrics        Prometheus text, Bearer METRICS_TOKEN (not served without one:
+#                        this port is public)
+#
+# Local test (no WEBHOOK_URL = setWebhook is skipped):
+#   BOT_MODE=webhook WEBHOOK_SECRET=dev python bot.py
+#   curl -H 'X-Telegram-Bot-Api-Secret-Token: dev' -H 'Content-Type: application/json' \
+#        -d @update.json http://localhost:8080/telegram
+import os, hmac, json, asyncio, logging
+
+from telegram import Update
+from telegram.ext import Application
+
+import outbox
+import metrics
+
+log = logging.getLogger("booking-bot.webhook")
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # public base URL; empty = don't call setWebhook
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or os.urandom(16).hex()
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # Telegram allows 1-100
+WEBHOOK_DRAIN_SEC = int(os.getenv("WEBHOOK_DRAIN_SEC", "20"))
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8080"))  # Render/Fly inject PORT
+
+MAX_BODY = 1 << 20  # updates are a few KB; anything bigger is not from Telegram
+
+
+class WebhookApp:
+    """ASGI app: lifespan drives the Application, HTTP feeds its update_queue."""
+    def __init__(self, application: Application, secret: str = WEBHOOK_SECRET, path: str = WEBHOOK_PATH):
+        self.application = application
+        self.secret = secret.encode()
+        self.path = path
+        self.draining = False
+        self.in_flight = 0  # requests between headers received and update queued
+
+    # ---------- lifespan ----------
+    async def startup(self):
+        app = self.application
+        await app.initialize()
+        if app.post_init:
+            await app.post_init(app)
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL + self.path, secret_token=self.secret.decode(),
+                max_connections=WEBHOOK_MAX_CONNECTIONS, allowed_updates=Update.ALL_TYPES,
+            )
+            log.info("webhook set: %s%s (max_connections=%d)", WEBHOOK_URL, self.path, WEBHOOK_MAX_CONNECTIONS)
+        await app.start()
+
+    async def shutdown(self):
+        # new POSTs now get 503 (Telegram retries them on the next instance);
+        # everything already accepted is handled before we exit
+        self.draining = True
+        for _ in range(WEBHOOK_DRAIN_SEC * 20):
+            if not self.in_flight:
+                break
+            await asyncio.sleep(0.05)
+        app = self.application
+        log.info("draining %d queued updates", app.update_queue.qsize())
+        await app.stop()  # processes what is left in update_queue, waits for handlers
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        # the webhook stays registered: Telegram holds updates until the next start
+
+    async def _lifespan(self, receive, send):
+        while True:
+            msg = await receive()
+            if msg["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as e:
+                    log.exception("startup failed")
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif msg["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # ---------- http ----------
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        method, path = scope["method"], scope["path"]
+        if path == "/healthz" and method in ("GET", "HEAD"):
+            status = 503 if self.draining else 200
+            return await _respond(send, status, {
+                "ok": status == 200, "queued": self.application.update_queue.qsize(),
+                "outbox": outbox.stats()["pending"],
+            })
+        if path == "/metrics" and method == "GET" and metrics.METRICS_TOKEN:
+            if not metrics.authorized(dict(scope["headers"]).get(b"authorization", b"")):
+                return await _respond(send, 403, {"ok": False})
+            body = (await metrics.render()).encode()
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-type", b"text/plain; version=0.0.4"),
+                                    (b"content-length", str(len(body)).encode())]})
+            return await send({"type": "http.response.body", "body": body})
+        if path != self.path:
+            return await _respond(send, 404, {"ok": False})
+        if method != "POST":
+            return await _respond(send, 405, {"ok": False})
+        if self.draining:
+            return await _respond(send, 503, {"ok": False, "error": "shutting down"})
+        headers = dict(scope["headers"])
+        token = headers.get(b"x-telegram-bot-api-secret-token", b"")
+        if not hmac.compare_digest(token, self.secret):
+            return await _respond(send, 403, {"ok": False})
+
+        self.in_flight += 1
+        try:
+            body = await _read_body(receive)
+            if body is None:
+                return await _respond(send, 413, {"ok": False})
+            try:
+                update = Update.de_json(json.loads(body), self.application.bot)
+            except Exception:
+                return await _respond(send, 400, {"ok": False, "error": "bad update"})
+            await self.application.update_queue.put(update)
+        finally:
+            self.in_flight -= 1
+        # acknowledge as soon as it's queued; handlers run on the Application
+        await _respond(send, 200, {"ok": True})
+
+
+async def _read_body(receive):
+    chunks, size = [], 0
+    while True:
+        msg = await receive()
+        if msg["type"] == "http.disconnect":
+            return b"".join(chunks)
+        chunk = msg.get("body", b"")
+        size += len(chunk)
+        if size > MAX_BODY:
+            return None
+        chunks.append(chunk)
+        if not msg.get("more_body"):
+            return b"".join(chunks)
+
+async def _respond(send, status: int, payload: dict):
+    body = json.dumps(payload).encode()
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+def run_webhook(application: Application):
+    import uvicorn
+    if not os.getenv("WEBHOOK_SECRET"):
+        log.warning("WEBHOOK_SECRET not set; using a random one for this process")
+    config = uvicorn.Config(
+        WebhookApp(application), host=HOST, port=PORT, lifespan="on",
+        timeout_graceful_shutdown=WEBHOOK_DRAIN_SEC, log_level="info", access_log=False,
+    )
+    uvicorn.Server(config).run()